@@ -1,293 +1,280 @@
-from typing import Any
-
 from fhir.resources.identifier import Identifier
-from fhir.resources.codeableconcept import CodeableConcept
-from fhir.resources.reference import Reference
 from fhir.resources.extension import Extension
-from fhir.resources.patient import Patient
-from fhir.resources.specimen import Specimen, SpecimenCollection
-from fhir.resources.documentreference import DocumentReference
 from fhir.resources.group import Group
 from fhir.resources.researchstudy import ResearchStudy
-from fhir.resources.researchsubject import ResearchSubject
-from uuid import uuid3, uuid5, NAMESPACE_DNS
-import uuid
-from pathlib import Path
-import importlib.resources
+import numpy as np
 import pandas as pd
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import os
+from itertools import chain
 import mimetypes
+from fhir_etl import cache
+from fhir_etl import utils
+from fhir_etl import shards
+from fhir_etl import builder
+from fhir_etl import report
+from fhir_etl import groups
+from fhir_etl import sources
 
 GTEX_SITE = 'gtexportal.org/home/'
-
-class IDHelper: # pilfered from https://github.com/FHIR-Aggregator/CDA2FHIR/blob/7660b8ee9a7b815855a826bfb78aee62eb39cf27/cda2fhir/transformer.py#L34
-    def __init__(self):
-        self.project_id = 'GTEX'
-        self.namespace = uuid3(NAMESPACE_DNS, GTEX_SITE)
-
-    @staticmethod
-    def is_valid_uuid(value: str) -> bool:
-        if value is None:
-            return False
-        try:
-            _obj = uuid.UUID(value, version=5)
-        except ValueError:
-            return False
-        return True
-
-    def mint_id(self, identifier: Identifier | str, resource_type: str = None) -> str: 
-        """create a UUID from an identifier. - mint id via Walsh's convention
-        https://github.com/ACED-IDP/g3t_etl/blob/d095895b0cf594c2fd32b400e6f7b4f9384853e2/g3t_etl/__init__.py#L61"""
-        # dispatch on type
-        if isinstance(identifier, Identifier):
-            assert resource_type, "resource_type is required for Identifier"
-            identifier = f"{resource_type}/{identifier.system}|{identifier.value}"
-        return self._mint_id(identifier)
-    
-    def _mint_id(self, identifier_string: str) -> str:
-        """create a UUID from an identifier, insert project_id."""
-        return str(uuid5(self.namespace, f"{self.project_id}/{identifier_string}"))
-
-def retrieve_paginated_gtex_data(api_endpoint):
-    if api_endpoint == 'https://gtexportal.org/api/v2/dataset/fileList':
+GTEX_SAMPLE_ATTRIBUTES_URL = 'https://storage.googleapis.com/adult-gtex/annotations/v10/metadata-files/GTEx_Analysis_v10_Annotations_SampleAttributesDS.txt'
+GTEX_SUBJECT_ENDPOINT = 'https://gtexportal.org/api/v2/dataset/subject'
+GTEX_SAMPLE_ENDPOINT = 'https://gtexportal.org/api/v2/dataset/sample'
+GTEX_FILE_ENDPOINT = 'https://gtexportal.org/api/v2/dataset/fileList'
+GTEX_DATASET_ID = 'gtex_v10'
+GTEX_ITEMS_PER_PAGE = 100
+GTEX_MAX_WORKERS = 8 # concurrent page requests per endpoint; GTEx starts throttling well above this
+
+GTEX_METADATA_SYSTEM = "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"])
+IDMakerInstance = utils.get_id_helper('GTEX', GTEX_SITE)
+
+# the columns the converters read out of the subject and sample API records and the annotation table
+SUBJECT_SCHEMA = sources.SourceSchema('GTEx subject', {
+    'subjectId': 'str',
+    'sex': 'category',
+    'ageBracket': 'category',
+    'hardyScale': 'category',
+})
+SAMPLE_SCHEMA = sources.SourceSchema('GTEx sample', {
+    'aliquotId': 'str',
+    'subjectId': 'category',  # ~45 samples per subject
+    'dataType': 'category',
+    'freezeType': 'category',
+})
+SAMPLE_ATTRIBUTES_SCHEMA = sources.SourceSchema('GTEx SampleAttributesDS', {'SAMPID': 'str'})
+
+def gtex_session(pool_size=GTEX_MAX_WORKERS):
+    """requests Session with a keep-alive connection pool sized for the concurrent page fetchers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_gtex_page(session, api_endpoint, page):
+    return cache.fetch_json(api_endpoint, params={'datasetId': GTEX_DATASET_ID, 'itemsPerPage': GTEX_ITEMS_PER_PAGE, 'page': page}, session=session)
+
+def retrieve_paginated_gtex_data(api_endpoint, session=None, max_workers=GTEX_MAX_WORKERS, schema=None):
+    """Every page of a GTEx API endpoint as one DataFrame, of the schema columns only (all of them without a schema)."""
+    if api_endpoint == GTEX_FILE_ENDPOINT:
         return 
 
-    page = 0
-    all_data = []
+    if session is None:
+        session = gtex_session(max_workers)
 
-    try: # there is a chance that GTEx's API is down for a particular parameter set. If this happens, coming back the next day *usually* solves the problem. Or adjust 'datasetId' on both line 49 and 60 to gtex_v8
-        response = requests.get(api_endpoint, params={'datasetId': 'gtex_v10', 'itemsPerPage': 100, 'page': page}).json()
-    except requests.exceptions.RequestException as e:
-        raise SystemExit(e)
-    max_pages = response['paging_info']['numberOfPages'] # 436 for sample
-    print(f"Aggregating {api_endpoint} data through a total of {max_pages} pages")
-    print(f"Page {page}")
-    all_data.extend(response['data'])
+    with report.stage(f"fetch GTEx {api_endpoint.rsplit('/', 1)[-1]}") as stage:
+        try: # there is a chance that GTEx's API is down for a particular parameter set. If this happens, coming back the next day *usually* solves the problem. Or adjust GTEX_DATASET_ID to gtex_v8
+            response = fetch_gtex_page(session, api_endpoint, 0)
+            max_pages = response['paging_info']['numberOfPages'] # 436 for sample
+            print(f"Aggregating {api_endpoint} data through a total of {max_pages} pages")
 
-    while page < max_pages:
-        page += 1
-        print(f"Page {page}")
-        next_response = requests.get(api_endpoint, params={'datasetId': 'gtex_v10', 'itemsPerPage': 100, 'page': page}).json()
-        all_data.extend(next_response['data'])
+            # pages 1..max_pages-1 are fetched concurrently; executor.map yields results in submission order,
+            # so the pages are reassembled in page order regardless of which request finishes first, and
+            # each page is reduced to the schema columns as it arrives.
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                remaining_pages = report.progress(executor.map(lambda page: fetch_gtex_page(session, api_endpoint, page), range(1, max_pages)),
+                                                  desc=api_endpoint.rsplit('/', 1)[-1], total=max_pages - 1, unit='page')
+                data_frame = sources.from_pages((page['data'] for page in chain([response], remaining_pages)), schema)
+        except requests.exceptions.RequestException as e:
+            raise SystemExit(e)
 
-    return pd.DataFrame(all_data)
+        print(f"Retrieved {len(data_frame)} records from {api_endpoint}")
+
+        stage.rows_out = len(data_frame)
+        stage.bytes_downloaded = cache.get_cache().downloaded_bytes(api_endpoint)
+        return data_frame
 
 def retrieve_file_gtex_data(api_endpoint):
-    file_df_init = pd.DataFrame(requests.get(api_endpoint).json())
+    with report.stage(f"fetch GTEx {api_endpoint.rsplit('/', 1)[-1]}") as stage:
+        file_df_init = pd.DataFrame(cache.fetch_json(api_endpoint))
+        stage.bytes_downloaded = cache.get_cache().downloaded_bytes(api_endpoint)
     file_df_v8 = file_df_init.loc[file_df_init['name'] == 'GTEx Analysis V8']
 
     fileset_list_dict_intermed = file_df_v8['filesets'].values[0]
     fileset_intermediate = pd.DataFrame(fileset_list_dict_intermed)
     fileset_final = fileset_intermediate.drop([0]) # drop protected and raw data row, not useful for our purposes.
-   
+    stage.rows_out = len(fileset_final)
+
     return fileset_final
 
-def group_identifier(sample_json_dict):
-    IDMakerInstance = IDHelper()
-
-    sampleAttributesDS_df = pd.read_csv('https://storage.googleapis.com/adult-gtex/annotations/v10/metadata-files/GTEx_Analysis_v10_Annotations_SampleAttributesDS.txt', low_memory = False, sep = '\t')
-    sampleAttributesDS_sampid_stripped = set()
-    for index, row in sampleAttributesDS_df.iterrows():
-        stripped_init = row['SAMPID'].split('-')[-2] # 'SM'
-        stripped_end = row['SAMPID'].split('-')[-1] # '4JBJ3'
-        sampleAttributesDS_sampid_stripped.add(f"{stripped_init}-{stripped_end}")
-    
-    sample_ids_from_api = set()
-    for record in sample_json_dict:
-        sample_ids_from_api.add(record['identifier'][0]['value'])
-
-    intersection_ids = sampleAttributesDS_sampid_stripped.intersection(sample_ids_from_api)
+def group_identifier(sample_ids):
+    """Member array (groups.member_keys) of the Specimens whose API aliquot id also appears in SampleAttributesDS."""
+    # only SAMPID is needed out of the annotation table, e.g. GTEX-1117F-0003-SM-58Q7G -> SM-58Q7G
+    sampids = sources.read_table(cache.fetch(GTEX_SAMPLE_ATTRIBUTES_URL), SAMPLE_ATTRIBUTES_SCHEMA)['SAMPID']
+    sampid_stripped = sampids.dropna().str.extract(r'([^-]*-[^-]*)$', expand=False).dropna().unique()
+
+    # sorted and unique, like the Specimen references always were
+    intersection_ids = np.intersect1d(np.asarray(sampid_stripped, dtype=str), np.asarray(sample_ids, dtype=str))
     print(f"intersection id count: {len(intersection_ids)}")
-    specimen_ids = ["Specimen/"+ IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(id)}), "Specimen") for id in intersection_ids]
-    
-    return specimen_ids
-
-def output_to_ndjson(json_str_list, filename, meta_path):
-    output_path = os.path.join(meta_path, f"{filename}.ndjson")
-
-    if filename == 'ResearchStudy' or filename == 'Group':
-        with open(output_path, 'w') as f:
-            json_string = json.dumps(json_str_list)
-            f.write(json_string + "\n")
-    else:
-        with open(output_path, 'w') as f:
-            for entry in json_str_list:
-                json_string = json.dumps(entry)
-                f.write(json_string + "\n")
-    print(f"Conversion complete, see output dir for {output_path}")
-
-def convert_to_fhir_subject(input_row):
-    IDMakerInstance = IDHelper()
-    ncpi_participant = Patient(**{
-        "resourceType": "Patient",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['subjectId'])}), "Patient"),
-        "identifier": [{"use":"official", "system": "https://gtexportal.org/home/downloads/adult-gtex/metadata", "value": input_row['subjectId']}],
-        "meta":{
-            "profile": [
-                "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-participant.html"
-            ]
-        },
-        "deceasedBoolean": pd.notna(input_row['hardyScale'])
-        }
-    )
+    return groups.member_keys(mint_ids(intersection_ids.tolist(), "Specimen"))
+
+def output_to_ndjson(resources, filename, meta_path):
+    """Stream resources (or serialized lines) to <meta_path>/<filename>.ndjson (or its --shards); a single ResearchStudy or Group model may be passed as is."""
+    if isinstance(resources, (ResearchStudy, Group)):
+        resources = [resources]
+    with report.stage(f"write {filename}.ndjson") as stage:
+        count, output_paths = shards.write(resources, meta_path, filename)
+        stage.rows_out = count
+        stage.bytes_written = sum(os.path.getsize(output_path) for output_path in output_paths)
+    print(f"Conversion complete, {count} resources, see output dir for {', '.join(output_paths)}")
+    return count
+
+def mint_ids(values, resource_type):
+    return IDMakerInstance.mint_ids(values, resource_type, GTEX_METADATA_SYSTEM)
+
+def study_reference():
+    return "ResearchStudy/" + IDMakerInstance.mint(GTEX_METADATA_SYSTEM, "GTEX_V10", "ResearchStudy")
+
+def prepare_subject_columns(subject_df):
+    """Compute every per-row field of the Patient and ResearchSubject converters column by column.
+    Rows of the result are consumed as plain tuples via itertuples()."""
+    hardy_scale = utils.na_to_none(subject_df['hardyScale'])
+    deceased = subject_df['hardyScale'].notna()
+
+    # age is displayed in the form of 60-69 in input phenotype data as an example. Final year estimate should look like 1964 - 1975.
+    # only the living get a birth year range, the deceased get their death circumstance instead.
+    age_bounds = subject_df['ageBracket'].astype(object).str.extract(r'(\d+)-(\d+)').astype(float)
+    has_age = ~deceased & age_bounds.notna().all(axis=1)
+    birth_years = ((2025 - age_bounds.loc[has_age, 1]).astype(int).astype(str) + " - " + (2025 - age_bounds.loc[has_age, 0]).astype(int).astype(str)).reindex(subject_df.index)
+
+    return pd.DataFrame({
+        'subject_id': subject_df['subjectId'].astype(object),
+        'patient_id': mint_ids(subject_df['subjectId'], "Patient"),
+        'researchsubject_id': mint_ids(subject_df['subjectId'], "ResearchSubject"),
+        'sex': utils.na_to_none(subject_df['sex']),
+        'deceased': deceased,
+        'hardy_scale': hardy_scale,
+        'birth_years': utils.na_to_none(birth_years),
+    })
 
-    extensions = []
-    birth_sex = input_row['sex']
-    if pd.notna(birth_sex):
-        extensions.append(Extension(**{
-            "url": "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-sex.html", "valueString": birth_sex})
-        )
-
-    death_circumstance = input_row['hardyScale']
-
-    if pd.isna(death_circumstance):
-        extensions.append(Extension(**
-            {"url": "https://hl7.org/fhir/extensions/SearchParameter-patient-extensions-Patient-age.html",
-            "valueString": f"{2025 - int(input_row['ageBracket'].split('-')[1])} - {2025 - int(input_row['ageBracket'].split('-')[0])}" # age is displayed in the form of 60-69 in input phenotype data as an example. Final year estimate should look like 1964 - 1975.
-            })
-        )
-    if pd.notna(death_circumstance):
-        extensions.append(Extension(**
-            {"url": "https://hl7.org/fhir/R4B/extension-condition-dueto.html", "valueString": death_circumstance})
-        )
-
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": 
-        {"reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")}})
-        )
-
-    if extensions:
-        ncpi_participant.extension = extensions
-
-    return json.dumps(ncpi_participant.model_dump(), indent = 4)
-
-def convert_to_fhir_researchsubject(input_row):
-    IDMakerInstance = IDHelper()
-    ncpi_studyparticipant = ResearchSubject(**{
-        "resourceType": "ResearchSubject",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['subjectId'])}), "ResearchSubject"),
-        "identifier": [{"use":"official", "system": "https://gtexportal.org/home/downloads/adult-gtex/metadata", "value": input_row['subjectId']}],
-        "subject": {
-            "reference": "Patient/" + str(IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['subjectId'])}), "Patient"))
-        },
-        "status": "on-study",
-        "study": {
-            "reference": "ResearchStudy/" + str(IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy"))
-        }}
-    )
+def prepare_specimen_columns(sample_df):
+    """Compute every per-row field of the Specimen converter column by column."""
+    has_subject = sample_df['subjectId'].notna()
+    subject_reference = ("Patient/" + mint_ids(sample_df.loc[has_subject, 'subjectId'], "Patient")).reindex(sample_df.index)
+
+    return pd.DataFrame({
+        'aliquot_id': sample_df['aliquotId'].astype(object),
+        'specimen_id': mint_ids(sample_df['aliquotId'], "Specimen"),
+        'data_type': utils.fill_na(sample_df['dataType'], 'None'),
+        'subject_reference': utils.na_to_none(subject_reference),
+        'freeze_type': sample_df['freezeType'].astype(object),
+    })
 
+def prepare_docref_columns(file_df):
+    """Flatten the per-fileset 'files' lists into one row per file, and compute every per-row field of the
+    DocumentReference converter column by column (replaces the nested iterrows over file_df)."""
+    filesets = file_df[['name', 'subpath', 'files']].rename(columns={'name': 'fileset_name', 'subpath': 'fileset_subpath'}).explode('files', ignore_index=True)
+    filesets = filesets[filesets['files'].notna()].reset_index(drop=True)
+    files = pd.DataFrame.from_records(filesets['files'].tolist())
+
+    return pd.DataFrame({
+        'name': files['name'].astype(object),
+        'docref_id': mint_ids(files['name'], "DocumentReference"),
+        'release': files['release'].astype(object),
+        'type': files['type'].astype(object),
+        'size': files['size'].astype(object),
+        'content_type': files['name'].map(lambda name: mimetypes.guess_type(name, strict=False)[0] or 'Unknown'),
+        'fileset_name': filesets['fileset_name'].astype(object),
+        'fileset_subpath': filesets['fileset_subpath'].astype(object),
+    })
+
+# -------------------------
+# resource templates: constant parts are built once and shared by every emitted resource (see fhir_etl.builder)
+# -------------------------
+STUDY_REFERENCE = study_reference()
+STUDY_EXTENSION = {"url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", "valueReference": {"reference": STUDY_REFERENCE}}
+PARTICIPANT_META = {"profile": ["https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-participant.html"]}
+SAMPLE_META = {"profile": ["https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-sample.html"]}
+IDENTIFIER_SYSTEM = "https://gtexportal.org/home/downloads/adult-gtex/metadata"
+SEX_URL = "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-sex.html"
+AGE_URL = "https://hl7.org/fhir/extensions/SearchParameter-patient-extensions-Patient-age.html"
+DUE_TO_URL = "https://hl7.org/fhir/R4B/extension-condition-dueto.html"
+FILE_SIZE_URL = "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-file-size.html"
+
+def convert_to_fhir_subject(row):
+    """row: one tuple of prepare_subject_columns()"""
     extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_studyparticipant.extension = extensions
+    if row.sex is not None:
+        extensions.append({"url": SEX_URL, "valueString": row.sex})
+    if row.birth_years is not None:
+        extensions.append({"url": AGE_URL, "valueString": row.birth_years})
+    if row.hardy_scale is not None:
+        extensions.append({"url": DUE_TO_URL, "valueString": row.hardy_scale})
+    extensions.append(STUDY_EXTENSION)
+
+    return builder.checked({
+        "resourceType": "Patient",
+        "id": row.patient_id,
+        "meta": PARTICIPANT_META,
+        "extension": extensions,
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.subject_id}],
+        "deceasedBoolean": bool(row.deceased),
+    })
 
-    return json.dumps(ncpi_studyparticipant.model_dump(), indent = 4)
+def convert_to_fhir_researchsubject(row):
+    """row: one tuple of prepare_subject_columns()"""
+    return builder.checked({
+        "resourceType": "ResearchSubject",
+        "id": row.researchsubject_id,
+        "extension": [STUDY_EXTENSION],
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.subject_id}],
+        "status": "on-study",
+        "study": {"reference": STUDY_REFERENCE},
+        "subject": {"reference": "Patient/" + row.patient_id},
+    })
 
-def convert_to_fhir_specimen(input_row):
-    IDMakerInstance = IDHelper()
+def convert_to_fhir_specimen(row):
+    """row: one tuple of prepare_specimen_columns()"""
 
     # problem: do not *want* to use a Reference style of reprsentation for bodySite at this juncture (lack of familiartiy with HL7 bodySite codes mostly and don't feel like learning, 
     # also am not sure GTeX's representation of bodySites would corrspond neatly to HL7's codes either). 
     # Want to use Concept style of presentation, but latest version of fhir.resources requires bodySite be of a CodeableReference type
     # see https://github.com/nazrulworld/fhir.resources/blob/main/fhir/resources/specimen.py#L296
-    # solution: force a concept kind of presentation for a CodeableReference using the above and below.
-
-    ncpi_sample = Specimen(**{
+    # had to remove bodySite for compliance with the R4B validator in https://github.com/FHIR-Aggregator/submission/blob/main/fhir_aggregator_submission/prep.py#L115. Either fix how bodySite is coded to satisfy R5 *and* R4B or suggest a change to prep.py at some later point.
+    #"bodySite": {"concept": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v2-0163.html", "code": row.tissue_site_detail_id, "display": row.tissue_site_detail}]}}
+    specimen = {
         "resourceType": "Specimen",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['aliquotId'])}), "Specimen"),
-        "identifier": [{"use": "official", "system": "https://gtexportal.org/home/downloads/adult-gtex/metadata", "value": input_row['aliquotId']}],
-        "meta":{
-            "profile": [
-                "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-sample.html"
-            ]
-        },
-        "type": { # why can't I just do method and bodySite like I can do type right here (without a CodeableConcept object declaration? why god? I'm going to find a way. Note that it's a codeableConcept type like method: 
-            # https://github.com/nazrulworld/fhir.resources/blob/main/fhir/resources/specimen.py#L241
-            "coding": [
-                    {
-                    "system": "https://terminology.hl7.org/CodeSystem-v3-SpecimenType.html",
-                    "code": input_row['dataType'] if pd.notna(input_row['dataType']) else 'None',
-                    "display": input_row['dataType'] if pd.notna(input_row['dataType']) else 'None',
-                    }
-                ]
-            },
-        "subject": {"reference": "Patient/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['subjectId'])}), "Patient")} if pd.notna(input_row['subjectId']) else "Not specified",
-        "collection": SpecimenCollection(**{         
-            "method": CodeableConcept(**{
-                "coding": [
-                    {
-                    "system": "https://terminology.hl7.org/CodeSystem-v2-0488.html",
-                    "code": input_row['freezeType'],
-                    "display": input_row['freezeType']
-                    }
-                ]})
-            #"bodySite": CodeableReference(**{ # had to remove bodySite for compliance with the R4B validator in https://github.com/FHIR-Aggregator/submission/blob/main/fhir_aggregator_submission/prep.py#L115. Either fix how bodySite is coded to satisfy R5 *and* R4B or suggest a change to prep.py at some later point.
-            #    "concept" : CodeableConcept(**{
-            #    "coding": [
-            #        {
-            #            "system": "https://terminology.hl7.org/CodeSystem-v2-0163.html",
-            #            "code": input_row['tissueSiteDetailId'],
-            #            "display": input_row['tissueSiteDetail']
-            #        }
-            #    ]})
-            #})
-        })
-    })
-
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")
-            }
-        })
-    )
-
-    ncpi_sample.extension = extensions
-    return json.dumps(ncpi_sample.model_dump(), indent = 4)
-
-def convert_to_fhir_docref(fileset_desc_df, input_row, group_id):
-    #print(fileset_desc_df)
-    #print(input_row)
-    IDMakerInstance = IDHelper()
-
-    ncpi_file = DocumentReference(**{
+        "id": row.specimen_id,
+        "meta": SAMPLE_META,
+        "extension": [STUDY_EXTENSION],
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.aliquot_id}],
+        "type": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v3-SpecimenType.html", "code": row.data_type, "display": row.data_type}]},
+    }
+    if row.subject_reference is not None:
+        specimen["subject"] = {"reference": row.subject_reference}
+    specimen["collection"] = {"method": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v2-0488.html", "code": row.freeze_type, "display": row.freeze_type}]}}
+
+    return builder.checked(specimen)
+
+def convert_to_fhir_docref(row, group_id):
+    """row: one tuple of prepare_docref_columns()"""
+    return builder.checked({
         "resourceType": "DocumentReference",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": str(input_row['name'])}), "DocumentReference"),
-        "identifier": [{"use": "official", "system": "https://gtexportal.org/home/downloads/adult-gtex/metadata", "value": input_row['name']}],
-        "version": input_row['release'],
+        "id": row.docref_id,
+        "extension": [
+            {"url": FILE_SIZE_URL, "valueString": row.size}, # in bytes
+            STUDY_EXTENSION,
+        ],
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.name}],
+        "version": row.release,
         "status": "superseded", # the latest gtex release at time of writing is v10, but v10's file associations are not available from the gtex api, so we have to use v8's. too bad!,
-        "subject": Reference(**{"reference": f"Group/{group_id}"}),
-        "type" : {
-            "coding": [
-                {
-                    "system": "https://gtexportal.org/api/v2/dataset/fileList",
-                    "code": input_row['type'],
-                    "display": input_row['type']
-                }
-            ]
-        }, # i opt to not include category because the information that would be contained in it is detailed in 'profile' below.
+        "type": {"coding": [{"system": "https://gtexportal.org/api/v2/dataset/fileList", "code": row.type, "display": row.type}]}, # i opt to not include category because the information that would be contained in it is detailed in 'profile' below.
+        "subject": {"reference": f"Group/{group_id}"},
         "content": [
             {
                 "attachment": {
-                    "contentType": mimetypes.guess_type(input_row['name'], strict=False)[0] or 'Unknown',
-                    "url": f"https://storage.googleapis.com/adult-gtex/{fileset_desc_df['subpath']}/v8/",
-                    "title": input_row['name']
+                    "contentType": row.content_type,
+                    "url": f"https://storage.googleapis.com/adult-gtex/{row.fileset_subpath}/v8/",
+                    "title": row.name
                 },
                 "profile": [
                     {
                         "valueCoding": {
                             "system": "https://gtexportal.org/home/downloads/adult-gtex/overview",
-                            "code": fileset_desc_df['subpath'],
-                            "display": fileset_desc_df['name']
+                            "code": row.fileset_subpath,
+                            "display": row.fileset_name
                         },
                     }
                 ]
@@ -295,129 +282,123 @@ def convert_to_fhir_docref(fileset_desc_df, input_row, group_id):
         ],
     })
 
-    extensions = []
-    extensions.append(Extension(**
-        {"url": "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-file-size.html",
-        "valueString": input_row['size']} # in bytes
-    ))
-
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_file.extension = extensions
+# -------------------------
+# stages (registered in fhir_etl.pipeline)
+# -------------------------
+# resources are converted lazily (in the shared process pool with --workers) and streamed straight into their
+# NDJSON files; with --incremental, outputs built from unchanged sources are skipped and their columns are
+# never prepared, and only the rows that changed since the last run are converted
 
-    return json.dumps(ncpi_file.model_dump(), indent = 4)
+def fetch_subjects(context):
+    return retrieve_paginated_gtex_data(GTEX_SUBJECT_ENDPOINT, schema=SUBJECT_SCHEMA)
 
-def transform_gtex(verbose):
-    subject_endpoint = "https://gtexportal.org/api/v2/dataset/subject"
-    sample_endpoint = "https://gtexportal.org/api/v2/dataset/sample"
-    file_endpoint = "https://gtexportal.org/api/v2/dataset/fileList"
+def fetch_samples(context):
+    return retrieve_paginated_gtex_data(GTEX_SAMPLE_ENDPOINT, schema=SAMPLE_SCHEMA)
 
-    #subject_df.to_csv('gtex_subject.csv', index = False)
-    #subject_df = pd.read_csv('fhir_etl/gtex/gtex_subject.csv')
-    #sample_df.to_csv('gtex_sample.csv', index = False)
-    #sample_df = pd.read_csv('fhir_etl/gtex/gtex_sample.csv')
-    #file_df.to_csv('gtex_file.csv', index = False)
-    #file_df = pd.read_csv('fhir_etl/gtex/gtex_file.csv')
+def fetch_files(context):
+    return retrieve_file_gtex_data(GTEX_FILE_ENDPOINT)
 
-    subject_df = retrieve_paginated_gtex_data(subject_endpoint)
-    sample_df = retrieve_paginated_gtex_data(sample_endpoint)
-    file_df = retrieve_file_gtex_data(file_endpoint)
+def group_id():
+    return IDMakerInstance.mint(GTEX_METADATA_SYSTEM, "GTEX_V10", "Group")
 
-    IDMakerInstance = IDHelper()
+def write_study(context):
+    manifest = context.manifest
+    study_inputs = manifest.inputs()
+    if manifest.is_current('ResearchStudy', study_inputs):
+        return
     ncpi_researchstudy = ResearchStudy(**{
-            "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy"),
-            "identifier": [Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"})],
+            "id": IDMakerInstance.mint(GTEX_METADATA_SYSTEM, "GTEX_V10", "ResearchStudy"),
+            "identifier": [Identifier(**{"system": GTEX_METADATA_SYSTEM, "value": "GTEX_V10"})],
             "title": "GTEX Analysis v10 Adult Sample and Subject Metadata",
             "status": "active"
         }
     )
-    rstudy_extensions = []
-    rstudy_extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_researchstudy.extension = rstudy_extensions
-
-    if verbose:
-        #print(ncpi_researchstudy)
+    ncpi_researchstudy.extension = [Extension(**STUDY_EXTENSION)]
+    print("Converting researchstudy to ResearchStudy.ndjson")
+    output_to_ndjson(manifest.resources('ResearchStudy', [ncpi_researchstudy], study_inputs), 'ResearchStudy', context.meta_path)
+
+def convert_subjects(context):
+    subject_df = context.results['fetch_subjects']
+    manifest = context.manifest
+    subject_inputs = manifest.inputs(GTEX_SUBJECT_ENDPOINT)
+    rebuild = {resource_type: not manifest.is_current(resource_type, subject_inputs) for resource_type in ('Patient', 'ResearchSubject')}
+    if not any(rebuild.values()):
+        return
+    if context.verbose:
         print("Subject dataframe:")
         print(subject_df.head(10))
         print("Converting subject df to fhirized json")
-
-    subject_json_strings = []
-    researchsubject_json_strings =[]
-    for index, row in subject_df.iterrows():
-        subject_json_strings.append(convert_to_fhir_subject(row))
-        researchsubject_json_strings.append(convert_to_fhir_researchsubject(row))
-    subject_json_dict_list: list[Any] = [json.loads(json_str) for json_str in subject_json_strings]
-    researchsubject_json_dict_list = [json.loads(json_str) for json_str in researchsubject_json_strings]
-
-    if verbose:
+    subject_columns = sources.PreparedChunks(subject_df, prepare_subject_columns, "prepare subject columns")
+
+    if rebuild['Patient']:
+        print("Converting subjects to Patient.ndjson")
+        output_to_ndjson(report.timed("convert Patient", manifest.rows('Patient', subject_columns, convert_to_fhir_subject, inputs=subject_inputs, id_column='patient_id', executor=context.executor, row_name='SubjectRow'), rows_in=len(subject_columns)), 'Patient', context.meta_path)
+    if rebuild['ResearchSubject']:
+        print("Converting subjects to ResearchSubject.ndjson")
+        output_to_ndjson(report.timed("convert ResearchSubject", manifest.rows('ResearchSubject', subject_columns, convert_to_fhir_researchsubject, inputs=subject_inputs, id_column='researchsubject_id', executor=context.executor, row_name='SubjectRow'), rows_in=len(subject_columns)), 'ResearchSubject', context.meta_path)
+
+def convert_samples(context):
+    sample_df = context.results['fetch_samples']
+    manifest = context.manifest
+    sample_inputs = manifest.inputs(GTEX_SAMPLE_ENDPOINT)
+    if manifest.is_current('Specimen', sample_inputs):
+        return
+    if context.verbose:
         print("Sample dataframe")
         print(sample_df.head(10))
         print("Converting sample df to fhirized json")
-
-    sample_json_strings = []
-    for index, row in sample_df.iterrows():
-        sample_json_strings.append(convert_to_fhir_specimen(row))
-    sample_json_dict_list = [json.loads(json_str) for json_str in sample_json_strings]
-
-    if verbose:
-        print("Preparing Group resource")
-    specimen_intersection = group_identifier(sample_json_dict_list)
-
-    group_id = IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "Group")
-    ncpi_group = Group(**{
-            "id": group_id,
-            "identifier": [Identifier(**{"system": "".join([f"https://storage.googleapis.com/adult-gtex/", "annotations/v10/metadata-files/GTEx_Analysis_v10_Annotations_SampleAttributesDS.txt"]), "value": "GTEX_V10"})],
-            "membership": "definitional",
-            "type": "specimen",
-            "member": [{"entity": {"reference": specimen_id}} for specimen_id in specimen_intersection]
-        }
-    )
-
-    group_extensions = []
-    group_extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{GTEX_SITE}", "downloads/adult-gtex/metadata"]), "value": "GTEX_V10"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_group.extension = group_extensions
-
-    if verbose:
+    specimen_columns = sources.PreparedChunks(sample_df, prepare_specimen_columns, "prepare specimen columns")
+
+    print("Converting samples to Specimen.ndjson")
+    output_to_ndjson(report.timed("convert Specimen", manifest.rows('Specimen', specimen_columns, convert_to_fhir_specimen, inputs=sample_inputs, id_column='specimen_id', executor=context.executor, row_name='SpecimenRow'), rows_in=len(specimen_columns)), 'Specimen', context.meta_path)
+
+def convert_files(context):
+    file_df = context.results['fetch_files']
+    manifest = context.manifest
+    file_inputs = manifest.inputs(GTEX_FILE_ENDPOINT)
+    if manifest.is_current('DocumentReference', file_inputs):
+        return
+    if context.verbose:
         print("File dataframe:")
         print(file_df.head())
         print("Converting file df to fhirized json")
+    with report.stage("prepare docref columns", rows_in=len(file_df)) as stage:
+        docref_columns = prepare_docref_columns(file_df)
+        stage.rows_out = len(docref_columns)
+
+    print("Converting files to DocumentReference.ndjson")
+    output_to_ndjson(report.timed("convert DocumentReference", manifest.rows('DocumentReference', docref_columns, convert_to_fhir_docref, group_id(), inputs=file_inputs, id_column='docref_id', executor=context.executor, row_name='DocumentReferenceRow'), rows_in=len(docref_columns)), 'DocumentReference', context.meta_path)
 
-    file_json_strings = []
-    for index, row in file_df.iterrows(): # nested iterrows... maybe fix this later. this is supposedly a performance black hole.
-        fileset_desc_df = row[['name', 'subpath']] # descrptivie metadata that is useful later
-        fileset_detail_df = pd.DataFrame.from_dict(row['files'])
-        for index, row in fileset_detail_df.iterrows():
-            file_json_strings.append(convert_to_fhir_docref(fileset_desc_df, row, group_id))
-    file_json_dict_list = [json.loads(json_str) for json_str in file_json_strings]
-
-    meta_path = str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'GTEx' / 'META' ))
-
-    print("Converting subject_json_dict to Patient.ndjson")
-    output_to_ndjson(subject_json_dict_list, 'Patient', meta_path)
-    print("Converting researchsubject_json_dict to ResearchSubject.ndjson")
-    output_to_ndjson(researchsubject_json_dict_list, 'ResearchSubject', meta_path)
-    print("Converting sample_json_dict to Specimen.ndjson")
-    output_to_ndjson(sample_json_dict_list, 'Specimen', meta_path)
-    print("Converting file_json_dict to DocumentReference.ndjson")
-    output_to_ndjson(file_json_dict_list, 'DocumentReference', meta_path)
-    print("Converting researchstudy_json_dict to ResearchStudy.ndjson")
-    output_to_ndjson(ncpi_researchstudy.model_dump(), 'ResearchStudy', meta_path)
-    print("Converting group_json_dict to Group.ndjson")
-    output_to_ndjson(ncpi_group.model_dump(), 'Group', meta_path)
\ No newline at end of file
+def build_group(context):
+    sample_df = context.results['fetch_samples']
+    manifest = context.manifest
+    if context.verbose:
+        print("Preparing Group resource")
+    with report.stage("collect Group members", rows_in=len(sample_df)) as stage:
+        specimen_intersection = group_identifier(sample_df['aliquotId'].dropna().astype(str))
+        stage.rows_out = len(specimen_intersection)
+        stage.bytes_downloaded = cache.get_cache().downloaded_bytes(GTEX_SAMPLE_ATTRIBUTES_URL)
+    # the Group only depends on its member list, not on every sample page
+    manifest.record_sources(GTEX_SAMPLE_ATTRIBUTES_URL)
+    group_inputs = manifest.inputs(extra=[groups.members_digest(specimen_intersection), context.group_max_members])
+    if manifest.is_current('Group', group_inputs):
+        return
+
+    # serialized straight from the member array, split into sub-Groups with --group-max-members
+    ncpi_group = {
+        "resourceType": "Group",
+        "id": group_id(),
+        "extension": [STUDY_EXTENSION],
+        "identifier": [{"system": GTEX_SAMPLE_ATTRIBUTES_URL, "value": "GTEX_V10"}],
+        "type": "specimen",
+        "membership": "definitional",
+    }
+    group_lines = groups.group_lines(ncpi_group, "Specimen", specimen_intersection, max_members=context.group_max_members,
+                                     part_id=lambda number: IDMakerInstance.mint(GTEX_METADATA_SYSTEM, f"GTEX_V10-part-{number}", "Group"))
+    print("Converting group to Group.ndjson")
+    output_to_ndjson(report.timed("build Group", manifest.serialized('Group', group_lines, group_inputs), rows_in=len(specimen_intersection)), 'Group', context.meta_path)
+
+def transform_gtex(verbose, workers=1, incremental=False, group_max_members=None):
+    """Every GTEx stage, as `fhir_etl transform -p gtex`."""
+    from fhir_etl import pipeline
+    pipeline.run(['gtex'], verbose=verbose, workers=workers, incremental=incremental, group_max_members=group_max_members)
@@ -0,0 +1,548 @@
+import io
+import os
+import json
+import time
+import random
+import logging
+import sys
+import shutil
+import platform
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+import pandas as pd
+
+from fhir_etl import cache
+from fhir_etl import utils
+from fhir_etl import parallel
+from fhir_etl import groups
+from fhir_etl import loader
+from fhir_etl import shards
+from fhir_etl.sources import read_table
+from fhir_etl.GTEx import gtex_fhirizer as gtex
+from fhir_etl.oneKgenomes import oneKg_fhirizer as onek
+from fhir_etl.oneKgenomes import document_references
+
+# -------------------------
+# benchmark suite
+# -------------------------
+# Replays a recorded source cache (any --cache-dir of a real transform run) or synthetic fixtures through a
+# local HTTP stand-in and, when pyftpdlib is installed, a local FTP stand-in, and times every stage of both
+# fhirizers on its own: fetch, prepare/convert_to_fhir_*, clean_resources, create_or_extend and
+# output_to_ndjson (also with --shards). Timings are the best of `repeat` runs; peak memory comes from one
+# extra run under tracemalloc so tracing does not skew the timings. Results are saved as JSON to compare runs over time.
+
+DEFAULT_SCALE = 0.1  # 1.0 is roughly a full release: 980 GTEx subjects, 43,000 GTEx samples, 3,500 1000 Genomes samples
+GTEX_SUBJECTS = 980
+GTEX_SAMPLES = 43000
+ONEK_SAMPLES = 3500
+RELEASE_FILES = 23
+
+
+# -------------------------
+# synthetic fixtures
+# -------------------------
+
+def _gtex_pages(endpoint, records):
+    pages = max(1, -(-len(records) // gtex.GTEX_ITEMS_PER_PAGE))
+    for page in range(pages):
+        key = cache.SourceCache.request_key(endpoint, {'datasetId': gtex.GTEX_DATASET_ID, 'itemsPerPage': gtex.GTEX_ITEMS_PER_PAGE, 'page': page})
+        data = records[page * gtex.GTEX_ITEMS_PER_PAGE:(page + 1) * gtex.GTEX_ITEMS_PER_PAGE]
+        yield key, json.dumps({'data': data, 'paging_info': {'numberOfPages': pages, 'numberOfItemsPerPage': gtex.GTEX_ITEMS_PER_PAGE}}).encode()
+
+
+def synthetic_sources(scale=DEFAULT_SCALE, seed=0) -> dict:
+    """Deterministic stand-ins for every source of both fhirizers, as {cache key: payload}."""
+    rng = random.Random(seed)
+    sources = {}
+
+    subjects = [{'subjectId': f"GTEX-{i:05X}",
+                 'sex': rng.choice(['male', 'female']),
+                 'ageBracket': rng.choice(['20-29', '30-39', '40-49', '50-59', '60-69', '70-79']),
+                 'hardyScale': rng.choice(['Ventilator case', 'Fast death - natural causes', 'Slow death', None, None]),
+                 'datasetId': gtex.GTEX_DATASET_ID}
+                for i in range(max(1, int(GTEX_SUBJECTS * scale)))]
+    samples = [{'aliquotId': f"SM-{i:05X}",
+                'sampleId': f"{subject['subjectId']}-{i % 100:04d}-SM-{i:05X}",
+                'subjectId': subject['subjectId'],
+                'tissueSiteDetailId': rng.choice(['Whole_Blood', 'Lung', 'Muscle_Skeletal', 'Brain_Cortex']),
+                'dataType': rng.choice(['RNASEQ', 'WGS', 'WES', None]),
+                'freezeType': rng.choice(['PAXgene', 'Frozen', 'OCT']),
+                'datasetId': gtex.GTEX_DATASET_ID}
+               for i, subject in ((i, subjects[i % len(subjects)]) for i in range(max(1, int(GTEX_SAMPLES * scale))))]
+    sources.update(_gtex_pages(gtex.GTEX_SUBJECT_ENDPOINT, subjects))
+    sources.update(_gtex_pages(gtex.GTEX_SAMPLE_ENDPOINT, samples))
+
+    filesets = [{'name': 'Protected Data', 'subpath': 'protected', 'files': []}] + [
+        {'name': name, 'subpath': subpath,
+         'files': [{'name': f"GTEx_Analysis_v8_{subpath}_{j}{suffix}", 'release': 'v8', 'type': file_type, 'size': f"{rng.randrange(10 ** 6, 10 ** 9)}"}
+                   for j in range(20)]}
+        for name, subpath, suffix, file_type in [('Annotations', 'annotations', '.txt', 'annotation'),
+                                                 ('Bulk tissue expression', 'bulk-gex', '.gct.gz', 'expression'),
+                                                 ('Variants', 'variants', '.vcf.gz', 'vcf')]]
+    sources[gtex.GTEX_FILE_ENDPOINT] = json.dumps([{'name': 'GTEx Analysis V8', 'filesets': filesets}]).encode()
+    # two out of three samples are part of the annotation table
+    sources[gtex.GTEX_SAMPLE_ATTRIBUTES_URL] = ("SAMPID\tSMTS\tSMTSD\n" + "".join(
+        f"{sample['sampleId']}\tBlood\t{sample['tissueSiteDetailId']}\n" for i, sample in enumerate(samples) if i % 3)).encode()
+
+    onek_samples = pd.DataFrame([{'Sample': f"HG{i:05d}",
+                                  'Family ID': f"F{i // 3:04d}",
+                                  'Population': rng.choice(['GBR', 'FIN', 'CHS', 'PUR', 'YRI']),
+                                  'Population Description': rng.choice(['British in England and Scotland', 'Finnish in Finland', 'Yoruba in Ibadan, Nigeria']),
+                                  'Gender': rng.choice(['male', 'female']),
+                                  'DNA Source from Coriell': rng.choice(['LCL', 'Blood', None]),
+                                  'Main project LC platform': rng.choice(['ILLUMINA', 'ABI_SOLID', None]),
+                                  'Total LC Sequence': rng.random() * 1e10}
+                                 for i in range(max(1, int(ONEK_SAMPLES * scale)))])
+    buffer = io.StringIO()
+    onek_samples.to_csv(buffer, sep='\t', index=False)
+    sources[onek.SAMPLE_INFO_URL] = buffer.getvalue().encode()
+    sources[document_references.RELEASE_HEADER_URL] = ("##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+                                                       + "\t".join(onek_samples['Sample']) + "\n").encode()
+    listing = [{'file': f"ALL.chr{chromosome}.phase3_shapeit2_mvncall_integrated_v5.20130502.genotypes.vcf.gz",
+                'size': rng.randrange(10 ** 8, 10 ** 9), 'last_modified': '2014-09-12T14:21:07'}
+               for chromosome in [*range(1, RELEASE_FILES), 'X']]
+    sources[f"ftp://{document_references.RELEASE_FTP_SERVER}{document_references.RELEASE_FTP_DIRECTORY}"] = json.dumps(listing).encode()
+    return sources
+
+
+def seed_fixtures(path, scale=DEFAULT_SCALE) -> cache.SourceCache:
+    """Write synthetic_sources into a source cache at path, usable by `transform --offline --cache-dir path`."""
+    fixtures = cache.SourceCache(path)
+    for key, content in synthetic_sources(scale).items():
+        fixtures.put(key, content)
+    fixtures.flush()
+    return fixtures
+
+
+# -------------------------
+# local stand-ins
+# -------------------------
+
+def local_url(base_url, url) -> str:
+    """Route an upstream url through the HTTP stand-in: https://host/path -> <base_url>/host/path."""
+    return f"{base_url}/{url.split('://', 1)[1]}"
+
+
+@contextlib.contextmanager
+def http_stand_in(fixtures: cache.SourceCache):
+    """Serve the recorded payloads of fixtures over HTTP on localhost; yields the base url for local_url."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            key = cache.SourceCache.request_key("https:/" + parts.path, dict(parse_qsl(parts.query)))
+            content = fixtures.get(key)
+            if content is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def fhir_stand_in(received=None, bundles=None, status=None):
+    """
+    Accept transaction Bundles POSTed to a FHIR server base url on localhost; yields the base url.
+    received (a dict) counts the resources of every accepted Bundle by type, bundles (a list) gets the
+    request urls of every accepted Bundle in the order they arrived. status(urls) may pick the HTTP status
+    of the reply to a Bundle (default 200); a Bundle answered with another status is not accepted.
+    """
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            bundle = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            entries = bundle.get('entry', [])
+            urls = [entry['request']['url'] for entry in entries]
+            code = status(urls) if status else 200
+            if code >= 300:
+                content = json.dumps({'resourceType': 'OperationOutcome',
+                                      'issue': [{'severity': 'error', 'code': 'transient' if code in loader.RETRY_STATUSES else 'invalid'}]}).encode()
+            else:
+                with lock:
+                    if received is not None:
+                        for entry in entries:
+                            resource_type = entry['resource']['resourceType']
+                            received[resource_type] = received.get(resource_type, 0) + 1
+                    if bundles is not None:
+                        bundles.append(urls)
+                content = json.dumps({'resourceType': 'Bundle', 'type': 'transaction-response',
+                                      'entry': [{'response': {'status': '200 OK'}} for _ in entries]}).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', loader.FHIR_JSON)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/fhir"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def ftp_stand_in(listing, root, mlsd=True):
+    """
+    Serve an FTP listing as sparse files of the recorded size and mtime over anonymous FTP on localhost
+    (MLSD, unless mlsd is False, and SIZE/MDTM); yields 'host:port' for document_references.iter_release_files,
+    or None without pyftpdlib.
+    """
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+    except ImportError:
+        yield None
+        return
+
+    os.makedirs(root, exist_ok=True)
+    for entry in listing:
+        file_path = os.path.join(root, entry['file'])
+        with open(file_path, 'wb') as file:
+            file.truncate(entry['size'])
+        modified = datetime.fromisoformat(entry['last_modified']).replace(tzinfo=timezone.utc).timestamp()
+        os.utime(file_path, (modified, modified))
+
+    # a handler on the logger keeps pyftpdlib from configuring its own per-command INFO logging
+    logger = logging.getLogger('pyftpdlib')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    proto_cmds = FTPHandler.proto_cmds if mlsd else {cmd: info for cmd, info in FTPHandler.proto_cmds.items() if cmd != 'MLSD'}
+    handler = type('StandInHandler', (FTPHandler,), {'authorizer': authorizer, 'use_gmt_times': True, 'proto_cmds': proto_cmds})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+    thread.start()
+    try:
+        yield f"127.0.0.1:{server.address[1]}"
+    finally:
+        server.close_all()
+
+
+# -------------------------
+# stages
+# -------------------------
+
+def measure(name, func, repeat=1, trace_memory=True) -> dict:
+    """Best wall time of `repeat` runs of func() -> (records, bytes), plus the tracemalloc peak of one more run."""
+    seconds = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            records, size = func()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        peak = None
+        if trace_memory:
+            tracemalloc.start()
+            try:
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return {'stage': name, 'records': records, 'bytes': size, 'seconds': seconds,
+            'records_per_sec': records / seconds if seconds else None, 'peak_memory_bytes': peak}
+
+
+def _file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def run(fixtures_path=None, scale=DEFAULT_SCALE, repeat=1, workers=1, trace_memory=True, progress=None) -> dict:
+    """
+    Run every stage against a recorded source cache (fixtures_path) or synthetic fixtures of the given scale.
+    progress(result) is called after each stage. Returns the report saved by `fhir_etl bench`.
+    """
+    workdir = tempfile.mkdtemp(prefix='fhir_etl_bench_')
+    results = []
+    state = {}
+    fixtures = replay = None
+
+    def stage(name, func):
+        result = measure(name, func, repeat=repeat, trace_memory=trace_memory)
+        results.append(result)
+        if progress:
+            progress(result)
+
+    def fresh_dir(name):
+        path = tempfile.mkdtemp(prefix=name, dir=workdir)
+        return path
+
+    try:
+        if fixtures_path is None:
+            fixtures_path = os.path.join(workdir, 'fixtures')
+            fixtures = seed_fixtures(fixtures_path, scale)
+        else:
+            fixtures = cache.SourceCache(fixtures_path, offline=True)
+        listing_key = f"ftp://{document_references.RELEASE_FTP_SERVER}{document_references.RELEASE_FTP_DIRECTORY}"
+
+        # fetch: every download goes into a fresh (empty) source cache so nothing is served from disk
+        with http_stand_in(fixtures) as base_url, \
+                ftp_stand_in(json.loads(fixtures.get(listing_key) or b'[]'), os.path.join(workdir, 'ftp')) as ftp_server:
+            def fetch_pages(endpoint, key, schema):
+                def func():
+                    cache.configure(path=fresh_dir('cache'))
+                    state[key] = gtex.retrieve_paginated_gtex_data(local_url(base_url, endpoint), schema=schema)
+                    return len(state[key]), sum(entry['size'] for entry in cache.get_cache().index.values())
+                return func
+
+            def fetch_file(url, key=None):
+                def func():
+                    cache.configure(path=fresh_dir('cache'))
+                    content = cache.fetch(local_url(base_url, url))
+                    if key:
+                        state[key] = content
+                    return content.count(b"\n") or 1, len(content)
+                return func
+
+            def fetch_listing():
+                cache.configure(path=fresh_dir('cache'))
+                state['release_files'] = list(document_references.iter_release_files(ftp_server, '/'))
+                return len(state['release_files']), 0
+
+            stage("fetch gtex subject pages", fetch_pages(gtex.GTEX_SUBJECT_ENDPOINT, 'subject_df', gtex.SUBJECT_SCHEMA))
+            stage("fetch gtex sample pages", fetch_pages(gtex.GTEX_SAMPLE_ENDPOINT, 'sample_df', gtex.SAMPLE_SCHEMA))
+            stage("fetch gtex fileList", fetch_file(gtex.GTEX_FILE_ENDPOINT))
+            stage("fetch gtex SampleAttributesDS", fetch_file(gtex.GTEX_SAMPLE_ATTRIBUTES_URL))
+            stage("fetch 1kgenomes sample_info", fetch_file(onek.SAMPLE_INFO_URL, 'sample_info'))
+            stage("fetch 1kgenomes VCF header", fetch_file(document_references.RELEASE_HEADER_URL))
+            if ftp_server is not None:
+                stage("fetch 1kgenomes FTP listing", fetch_listing)
+            else:
+                state['release_files'] = json.loads(fixtures.get(listing_key) or b'[]')
+
+        # everything downstream of fetch reads the fixtures the way an --offline transform does
+        replay = cache.configure(path=fixtures_path, offline=True)
+        file_df = gtex.retrieve_file_gtex_data(gtex.GTEX_FILE_ENDPOINT)
+        sample_df = read_table(state['sample_info'], onek.SAMPLE_INFO_SCHEMA)
+
+        with parallel.pool(workers) as executor:
+            def prepare(key, preparer, frame):
+                def func():
+                    state[key] = preparer(frame)
+                    return len(state[key]), 0
+                return func
+
+            def convert(key, columns, converter, *args, row_name='Row'):
+                def func():
+                    state[key] = list(parallel.convert_rows(state[columns], converter, *args, executor=executor, row_name=row_name))
+                    return len(state[key]), 0
+                return func
+
+            def group_identifier():
+                state['group_members'] = gtex.group_identifier(state['sample_df']['aliquotId'].dropna().astype(str))
+                return len(state['group_members']), 0
+
+            def group_line():
+                group = {"resourceType": "Group", "id": group_id, "extension": [gtex.STUDY_EXTENSION],
+                         "identifier": [{"system": gtex.GTEX_SAMPLE_ATTRIBUTES_URL, "value": "GTEX_V10"}],
+                         "type": "specimen", "membership": "definitional"}
+                return len(state['group_members']), len(groups.group_line(group, "Specimen", state['group_members']))
+
+            def document_reference():
+                state['onek_docrefs'] = [document_references.create_document_reference(file_row) for file_row in state['release_files']]
+                return len(state['onek_docrefs']), 0
+
+            group_id = gtex.IDMakerInstance.mint(gtex.GTEX_METADATA_SYSTEM, "GTEX_V10", "Group")
+            stage("gtex prepare_subject_columns", prepare('subject_columns', gtex.prepare_subject_columns, state['subject_df']))
+            stage("gtex convert_to_fhir_subject", convert('gtex_patients', 'subject_columns', gtex.convert_to_fhir_subject, row_name='SubjectRow'))
+            stage("gtex convert_to_fhir_researchsubject", convert('gtex_researchsubjects', 'subject_columns', gtex.convert_to_fhir_researchsubject, row_name='SubjectRow'))
+            stage("gtex prepare_specimen_columns", prepare('specimen_columns', gtex.prepare_specimen_columns, state['sample_df']))
+            stage("gtex convert_to_fhir_specimen", convert('gtex_specimens', 'specimen_columns', gtex.convert_to_fhir_specimen, row_name='SpecimenRow'))
+            stage("gtex prepare_docref_columns", prepare('docref_columns', gtex.prepare_docref_columns, file_df))
+            stage("gtex convert_to_fhir_docref", convert('gtex_docrefs', 'docref_columns', gtex.convert_to_fhir_docref, group_id, row_name='DocumentReferenceRow'))
+            stage("gtex group_identifier", group_identifier)
+            stage("gtex group_line", group_line)
+            stage("1kgenomes prepare_sample_columns", prepare('sample_columns', onek.prepare_sample_columns, sample_df))
+            stage("1kgenomes convert_to_fhir_subject", convert('onek_patients', 'sample_columns', onek.convert_to_fhir_subject, row_name='SampleRow'))
+            stage("1kgenomes convert_to_fhir_researchsubject", convert('onek_researchsubjects', 'sample_columns', onek.convert_to_fhir_researchsubject, row_name='SampleRow'))
+            stage("1kgenomes convert_to_fhir_specimen", convert('onek_specimens', 'sample_columns', onek.convert_to_fhir_specimen, row_name='SampleRow'))
+            stage("1kgenomes create_document_reference", document_reference)
+
+            def clean():
+                cleaned = utils.clean_resources(state['gtex_specimens'], executor=executor, errors=[])
+                return len(cleaned), 0
+
+            stage("clean_resources gtex Specimen", clean)
+
+        def output(resources_key, resource_type):
+            def func():
+                meta_path = fresh_dir('output')
+                gtex.output_to_ndjson(iter(state[resources_key]), resource_type, meta_path)
+                return len(state[resources_key]), _file_size(os.path.join(meta_path, f"{resource_type}.ndjson"))
+            return func
+
+        def create_or_extend(update_existing=False):
+            def func():
+                if update_existing:
+                    folder_path = state['merged']
+                else:
+                    folder_path = state['merged'] = fresh_dir('merge')
+                utils.create_or_extend(new_items=state['gtex_specimens'], folder_path=folder_path,
+                                       resource_type='Specimen', update_existing=update_existing)
+                return len(state['gtex_specimens']), _file_size(os.path.join(folder_path, 'Specimen.ndjson'))
+            return func
+
+        def sharded_output(resources_key, resource_type, shard_count):
+            def func():
+                meta_path = fresh_dir('sharded')
+                shards.configure(shards=shard_count)
+                try:
+                    gtex.output_to_ndjson(iter(state[resources_key]), resource_type, meta_path)
+                finally:
+                    shards.configure()
+                return len(state[resources_key]), sum(_file_size(file_path) for file_path in shards.find_outputs(meta_path, resource_type))
+            return func
+
+        stage("output_to_ndjson gtex Patient", output('gtex_patients', 'Patient'))
+        stage("output_to_ndjson gtex Specimen", output('gtex_specimens', 'Specimen'))
+        stage("output_to_ndjson gtex Specimen (8 shards)", sharded_output('gtex_specimens', 'Specimen', 8))
+        stage("create_or_extend gtex Specimen (new file)", create_or_extend())
+        stage("create_or_extend gtex Specimen (unchanged, update_existing)", create_or_extend(update_existing=True))
+
+        load_path = fresh_dir('load')
+        with contextlib.redirect_stdout(io.StringIO()):
+            gtex.output_to_ndjson(iter(state['gtex_specimens']), 'Specimen', load_path)
+
+        def load():
+            with fhir_stand_in() as server:
+                result = loader.load_directory(load_path, server, checkpoint_path=os.path.join(fresh_dir('checkpoint'), loader.CHECKPOINT_NAME))
+            return sum(result.resources.values()), _file_size(os.path.join(load_path, 'Specimen.ndjson'))
+
+        stage("load gtex Specimen (transaction Bundles)", load)
+    finally:
+        # persist access times before the work directory (and synthetic fixtures) go away
+        for source_cache in (fixtures, replay):
+            if source_cache is not None:
+                source_cache.flush()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'fixtures': fixtures_path if fixtures_path and not fixtures_path.startswith(workdir) else f"synthetic (scale {scale})",
+        'repeat': repeat,
+        'workers': workers,
+        'stages': results,
+    }
+
+
+# -------------------------
+# CLI start-up
+# -------------------------
+# Every command is timed in a fresh interpreter (the cost a user pays per invocation), and the heavy
+# dependencies it imported are listed, so a regression to eager imports shows up by name.
+
+STARTUP_COMMANDS = {
+    'import fhir_etl.cli': None,
+    'fhir_etl --help': ['--help'],
+    'fhir_etl transform --help': ['transform', '--help'],
+    'fhir_etl validate --help': ['validate', '--help'],
+    'fhir_etl validate -p <dir>': ['validate', '-w', '1', '-p', '{path}'],  # one Patient, validated serially
+    'fhir_etl bench --help': ['bench', '--help'],
+}
+HEAVY_MODULES = ('pandas', 'numpy', 'requests', 'fhir.resources', 'pydantic', 'tqdm', 'ftplib', 'orjson')
+_STARTUP_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+import fhir_etl.cli
+if {args!r} is not None:
+    sys.argv = ['fhir_etl'] + {args!r}
+    try:
+        fhir_etl.cli.cli()
+    except SystemExit:
+        pass
+sys.stderr.write(json.dumps([sorted(m for m in {heavy!r} if m in sys.modules), time.perf_counter() - start]))
+"""
+
+
+def startup(repeat=5, progress=None) -> dict:
+    """Best wall time of `repeat` cold starts of each STARTUP_COMMANDS entry, in the report format of run()."""
+    results = []
+    meta_path = tempfile.mkdtemp(prefix='fhir_etl-startup-')
+    with open(os.path.join(meta_path, 'Patient.ndjson'), 'w') as f:
+        f.write('{"resourceType": "Patient", "id": "startup"}\n')
+    try:
+        for name, args in STARTUP_COMMANDS.items():
+            args = args and [arg.format(path=meta_path) for arg in args]
+            script = _STARTUP_SCRIPT.format(args=args, heavy=HEAVY_MODULES)
+            seconds = import_seconds = None
+            for _ in range(max(1, repeat)):
+                start = time.perf_counter()
+                completed = subprocess.run([sys.executable, '-c', script], stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.PIPE, check=True, text=True)
+                elapsed = time.perf_counter() - start
+                heavy, in_process = json.loads(completed.stderr.strip().splitlines()[-1])
+                seconds = elapsed if seconds is None else min(seconds, elapsed)
+                import_seconds = in_process if import_seconds is None else min(import_seconds, in_process)
+            result = {'stage': f"startup {name}", 'records': 1, 'bytes': None, 'seconds': seconds,
+                      'records_per_sec': None, 'peak_memory_bytes': None,
+                      'cli_seconds': import_seconds, 'heavy_imports': heavy}
+            results.append(result)
+            if progress:
+                progress(result)
+    finally:
+        shutil.rmtree(meta_path, ignore_errors=True)
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'stages': results,
+    }
+
+
+def compare(report, baseline) -> dict:
+    """stage -> relative change of seconds against a previous report (negative is faster)."""
+    previous = {result['stage']: result for result in baseline.get('stages', [])}
+    changes = {}
+    for result in report['stages']:
+        before = previous.get(result['stage'])
+        if before and before.get('seconds'):
+            changes[result['stage']] = result['seconds'] / before['seconds'] - 1
+    return changes
+
+
+def format_result(result, change=None) -> str:
+    rate = f"{result['records_per_sec']:>12,.0f}/s" if result['records_per_sec'] else f"{'-':>14}"
+    peak = f"{result['peak_memory_bytes'] / 2 ** 20:>8.1f} MiB" if result['peak_memory_bytes'] is not None else f"{'-':>12}"
+    line = f"{result['stage']:<58} {result['records']:>8} {result['seconds']:>9.3f}s {rate} {peak}"
+    if change is not None:
+        line += f" {change:>+8.1%}"
+    if result.get('heavy_imports'):
+        line += f" imports {', '.join(result['heavy_imports'])}"
+    return line
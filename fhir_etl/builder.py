@@ -0,0 +1,86 @@
+import zlib
+import functools
+import importlib
+from contextvars import ContextVar
+
+# -------------------------
+# fast resource building
+# -------------------------
+# The convert_to_fhir_* functions emit plain resource dicts from per-resource-type templates instead of
+# constructing fhir.resources models row by row. Templates share their constant parts (meta, study
+# extension, code systems) between resources, so emitted dicts must be treated as read-only.
+# Full fhir.resources validation runs on the resources of the first VALIDATE_FIRST source rows plus a
+# deterministic sample of the rest keyed on the id; strict mode validates every resource. The source row
+# position is set by parallel.convert_rows, so the same resources are picked whether rows are converted
+# serially or in worker processes, in any chunk order. Resources built outside of a source row (studies,
+# Groups, DocumentReferences of a release listing) are few and always validated.
+# The fhir.resources model classes are imported on first use, so `fhir_etl validate` (which only needs
+# get_resource_class) stays clear of pandas and the source fetching modules.
+
+VALIDATE_FIRST = 100
+SAMPLE_RATE = 0.01
+
+_strict = False
+_validate_first = VALIDATE_FIRST
+_sample_rate = SAMPLE_RATE
+_position = ContextVar('position', default=None)  # source row position of the resource being converted
+
+
+def configure(strict=False, validate_first=VALIDATE_FIRST, sample_rate=SAMPLE_RATE):
+    """Set the validation policy for resources emitted by the fhirizers."""
+    global _strict, _validate_first, _sample_rate
+    _strict = strict
+    _validate_first = validate_first
+    _sample_rate = sample_rate
+
+
+def get_config() -> dict:
+    """Current policy as configure() keyword arguments, e.g. to replay it in worker processes."""
+    return {'strict': _strict, 'validate_first': _validate_first, 'sample_rate': _sample_rate}
+
+
+def set_position(position):
+    """Set the source row position of the resources built next in this thread (None outside of rows); returns
+    a token for reset_position."""
+    return _position.set(position)
+
+
+def reset_position(token):
+    _position.reset(token)
+
+
+def should_validate(resource_id: str, position=None) -> bool:
+    """Strict mode validates everything; otherwise the resources of the first N source rows (and any resource
+    built outside of a row) and a sample of the rest keyed on the id, so the same resources are picked on
+    every run, serially or in worker processes."""
+    if _strict or position is None or position < _validate_first:
+        return True
+    if _sample_rate <= 0:
+        return False
+    return zlib.crc32(resource_id.encode()) % 10000 < _sample_rate * 10000
+
+
+@functools.lru_cache(maxsize=None)
+def get_resource_class(resource_type: str):
+    """Resolve (and cache) the fhir.resources model class for a resource type name."""
+    try:
+        resource_module = importlib.import_module(f"fhir.resources.{resource_type.lower()}")
+        return getattr(resource_module, resource_type)
+    except (ImportError, AttributeError) as e:
+        raise ValueError(f"Invalid resource type: {resource_type}. Error: {str(e)}")
+
+
+def validate_fhir_resource_from_type(resource_type: str, resource_data: dict):
+    """
+    Generalized function to validate any FHIR resource type using its name.
+    """
+    return get_resource_class(resource_type).model_validate(resource_data)
+
+
+def checked(resource: dict) -> dict:
+    """Return resource unchanged, after validating it against its fhir.resources model if it is picked.
+    Raises the model's ValidationError for an invalid resource, as building the model directly would."""
+    resource_type = resource["resourceType"]
+    if should_validate(resource.get("id") or "", _position.get()):
+        validate_fhir_resource_from_type(resource_type, resource)
+    return resource
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import hashlib
+import atexit
+import threading
+from pathlib import Path
+from urllib.parse import urlencode
+
+# -------------------------
+# on-disk source cache
+# -------------------------
+# Every fhirizer downloads its sources (API pages, annotation tables, VCF headers, FTP listings) through
+# this module. Payloads are stored content-addressed (objects/<sha256>) and indexed by request key, so
+# re-runs revalidate with ETag/Last-Modified instead of downloading again, and --offline runs entirely
+# from whatever is on disk. Pointing the cache at a pre-seeded directory replaces the network in tests.
+
+DEFAULT_CACHE_DIR = os.environ.get('FHIR_ETL_CACHE', str(Path.home() / '.cache' / 'fhir_etl'))
+DEFAULT_MAX_BYTES = int(os.environ.get('FHIR_ETL_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 2 GiB
+
+
+class OfflineCacheMiss(LookupError):
+    """Raised in offline mode when a source has never been cached."""
+
+
+class SourceCache:
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.objects_path = self.path / 'objects'
+        self.index_path = self.path / 'index.json'
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.index = self._load_index()
+        self.used = {}  # key -> index entry of every source read or stored during this run
+        self.downloaded = {}  # key -> bytes transferred from upstream during this run
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _matches(key, urls) -> bool:
+        return any(key == url or key.startswith(url + '?') for url in urls)
+
+    def used_sources(self, *urls) -> dict:
+        """{key: {'sha256', 'etag', 'last_modified'}} of the sources used this run for urls, with any query parameters."""
+        with self._lock:
+            return {key: {field: entry[field] for field in ('sha256', 'etag', 'last_modified')}
+                    for key, entry in sorted(self.used.items()) if self._matches(key, urls)}
+
+    def downloaded_bytes(self, *urls) -> int:
+        """Bytes transferred from upstream this run for urls, with any query parameters (revalidated copies count 0)."""
+        with self._lock:
+            return sum(size for key, size in self.downloaded.items() if self._matches(key, urls))
+
+    @staticmethod
+    def request_key(url, params=None) -> str:
+        """Canonical cache key for a url and its query parameters."""
+        if not params:
+            return url
+        return f"{url}?{urlencode(sorted(params.items()))}"
+
+    def _load_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            # a torn index only costs a re-download, the objects themselves are still addressable
+            return {}
+
+    def _object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / digest
+
+    def _read_object(self, entry):
+        try:
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _touch(self, key):
+        self.index[key]['accessed'] = time.time()
+        self._dirty = True
+
+    def flush(self):
+        """Persist the index atomically, if anything changed since the last flush. Called once at the end of a
+        run (and at exit), not per put, so a run with hundreds of API pages rewrites the index once."""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.index_path.with_suffix('.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+
+    def put(self, key, content: bytes, etag=None, last_modified=None):
+        """Store content under key; identical payloads from different keys share one object."""
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if not object_path.exists():
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = object_path.with_suffix(f'.tmp{threading.get_ident()}')
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, object_path)
+
+        with self._lock:
+            self.index[key] = {
+                'sha256': digest,
+                'size': len(content),
+                'etag': etag,
+                'last_modified': last_modified,
+                'accessed': time.time(),
+            }
+            self.used[key] = dict(self.index[key])
+            self._dirty = True
+            self._evict()
+
+    def get(self, key):
+        """Return cached content for key, or None."""
+        with self._lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            content = self._read_object(entry)
+            if content is None:
+                del self.index[key]
+                self._dirty = True
+                return None
+            self._touch(key)
+            self.used[key] = dict(entry)
+            return content
+
+    def _evict(self):
+        """Drop least recently used entries until the unique object bytes fit in max_bytes. Caller holds the lock."""
+        sizes = {entry['sha256']: entry['size'] for entry in self.index.values()}
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+        refcounts = {}
+        for entry in self.index.values():
+            refcounts[entry['sha256']] = refcounts.get(entry['sha256'], 0) + 1
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['accessed']):
+            if total <= self.max_bytes:
+                break
+            del self.index[key]
+            digest = entry['sha256']
+            refcounts[digest] -= 1
+            if refcounts[digest] == 0:
+                total -= sizes[digest]
+                try:
+                    os.remove(self._object_path(digest))
+                except OSError:
+                    pass
+
+    def fetch(self, url, params=None, session=None, timeout=60) -> bytes:
+        """GET url through the cache, revalidating a cached copy with ETag/Last-Modified."""
+        key = self.request_key(url, params)
+        with self._lock:
+            entry = dict(self.index[key]) if key in self.index else None
+
+        if self.offline:
+            content = self.get(key)
+            if content is None:
+                raise OfflineCacheMiss(f"{key} is not in the source cache at {self.path}")
+            return content
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        if session is None:
+            import requests  # only online fetches need it
+            session = requests
+        response = session.get(url, params=params, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            content = self.get(key)
+            if content is not None:
+                return content
+            # object was evicted or removed underneath the index, fetch unconditionally
+            response = session.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+
+        content = response.content
+        self.downloaded[key] = len(content)
+        self.put(key, content, etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+        return content
+
+    def remember(self, key, producer) -> bytes:
+        """Cache the bytes returned by producer() under key, for sources that are not plain HTTP (e.g. FTP listings).
+        Online runs always call producer so the entry stays current, offline runs replay the stored copy."""
+        if self.offline:
+            content = self.get(key)
+            if content is None:
+                raise OfflineCacheMiss(f"{key} is not in the source cache at {self.path}")
+            return content
+        content = producer()
+        self.downloaded[key] = len(content)
+        self.put(key, content)
+        return content
+
+    def remember_records(self, key, producer):
+        """Streaming variant of remember for a JSON list: yields the records of producer() as they arrive and
+        stores the complete list under key once the producer is exhausted. Offline runs replay the stored list."""
+        if self.offline:
+            content = self.get(key)
+            if content is None:
+                raise OfflineCacheMiss(f"{key} is not in the source cache at {self.path}")
+            yield from json.loads(content)
+            return
+        records = []
+        for record in producer():
+            records.append(record)
+            yield record
+        content = json.dumps(records, separators=(',', ':')).encode()
+        self.downloaded[key] = len(content)
+        self.put(key, content)
+
+
+_cache = None
+
+
+def configure(path=None, max_bytes=None, offline=False) -> SourceCache:
+    """Set up the process wide source cache used by the fhirizers."""
+    global _cache
+    if _cache is not None:
+        _cache.flush()
+    _cache = SourceCache(path=path or DEFAULT_CACHE_DIR,
+                         max_bytes=max_bytes or DEFAULT_MAX_BYTES,
+                         offline=offline)
+    return _cache
+
+
+def get_cache() -> SourceCache:
+    global _cache
+    if _cache is None:
+        _cache = SourceCache()
+    return _cache
+
+
+def fetch(url, params=None, session=None) -> bytes:
+    return get_cache().fetch(url, params=params, session=session)
+
+
+def fetch_text(url, params=None, session=None, encoding='utf-8') -> str:
+    return fetch(url, params=params, session=session).decode(encoding)
+
+
+def fetch_json(url, params=None, session=None):
+    return json.loads(fetch(url, params=params, session=session))
@@ -2,11 +2,18 @@ import click
 import os
 import sys
 import json
-from pathlib import Path
-import importlib.resources
-from fhir_etl.oneKgenomes.oneKg_fhirizer import transform_1k
-from fhir_etl.oneKgenomes.document_references import transform_1k_files
-from fhir_etl.GTEx.gtex_fhirizer import transform_gtex
+from datetime import datetime
+from fhir_etl import builder
+from fhir_etl import pipeline
+
+# -------------------------
+# command line
+# -------------------------
+# Fhirizers pull in pandas, requests and the fhir.resources models, so fhir_etl.pipeline names their stages
+# as "module:function" and they are only imported when their project is transformed; every subcommand
+# imports its heavy dependencies inside its callback. Keep module level imports of this file to the
+# standard library, click and light fhir_etl modules (builder, pipeline); `fhir_etl bench --startup`
+# measures start-up time.
 
 
 @click.group()
@@ -19,24 +26,26 @@ def cli():
               help="Run in debug mode.")
 @click.option("-p", "--path", default=None,
               help="Path to read the FHIR NDJSON files.")
-def validate(debug: bool, path):
+@click.option("-w", "--workers", default=os.cpu_count(), show_default=True,
+              help="Worker processes, each validating byte ranges of the NDJSON files.")
+def validate(debug: bool, path, workers):
     """Validate the output FHIR NDJSON files."""
-    from gen3_tracker.git import run_command  # Ensure gen3_tracker is installed
-    from gen3_tracker.meta.validator import validate as validate_dir
-    from halo import Halo
+    from fhir_etl import report
+    from fhir_etl.validator import validate_directory
     INFO_COLOR = "green"
     ERROR_COLOR = "red"
 
     if not os.path.isdir(path):
         raise ValueError(f"Path: '{path}' is not a valid directory.")
 
+    def print_error(err):
+        click.secho(f"{err.path}:{err.offset} {err.exception} {json.dumps(err.json_obj, separators=(',', ':'))}",
+                    fg=ERROR_COLOR, file=sys.stderr)
+
     try:
-        with Halo(text='Validating', spinner='line', placement='right', color='white'):
-            result = validate_dir(path)
+        with report.progress(desc='Validating', unit='B') as bar:
+            result = validate_directory(path, workers=workers, on_error=print_error, on_progress=bar.update)
         click.secho(result.resources, fg=INFO_COLOR, file=sys.stderr)
-        for err in result.exceptions:
-            click.secho(f"{err.path}:{err.offset} {err.exception} {json.dumps(err.json_obj, separators=(',', ':'))}",
-                        fg=ERROR_COLOR, file=sys.stderr)
         if result.exceptions:
             sys.exit(1)
     except Exception as e:
@@ -44,25 +53,188 @@ def validate(debug: bool, path):
         if debug:
             raise
 
+@cli.command('check-refs')
+@click.option("-p", "--path", required=True,
+              help="Path to read the FHIR NDJSON files.")
+@click.option("--examples", default=5, show_default=True,
+              help="Dangling references listed per field.")
+def check_refs(path, examples):
+    """Check that every reference in the output FHIR NDJSON files resolves."""
+    from fhir_etl.validator import ndjson_files
+    from fhir_etl.refcheck import check_references
+    INFO_COLOR = "green"
+    ERROR_COLOR = "red"
+
+    if not os.path.isdir(path):
+        raise ValueError(f"Path: '{path}' is not a valid directory.")
+
+    result = check_references(ndjson_files(path), examples=examples)
+    for dangling in result.dangling:
+        click.secho(f"{dangling.field} -> {dangling.target_type}: {dangling.count} dangling", fg=ERROR_COLOR, file=sys.stderr)
+        for example in dangling.examples:
+            click.secho(f"  {example}", fg=ERROR_COLOR, file=sys.stderr)
+    dangling_count = sum(dangling.count for dangling in result.dangling)
+    click.secho({'summary': result.resources, 'references': result.references, 'dangling': dangling_count,
+                 'skipped': result.skipped}, fg=ERROR_COLOR if dangling_count else INFO_COLOR, file=sys.stderr)
+    if dangling_count:
+        sys.exit(1)
+
+@cli.command('export')
+@click.option("-p", "--path", required=True,
+              help="Path to read the FHIR NDJSON files.")
+@click.option("-o", "--output", required=True,
+              help="Directory to write <Type>.parquet and references.parquet to.")
+@click.option("--format", "export_format", type=click.Choice(['parquet']), default='parquet', show_default=True,
+              help="Output format (parquet needs the pyarrow package).")
+@click.option("--batch-size", default=65536, show_default=True, type=click.IntRange(min=1),
+              help="Rows per Parquet row group.")
+def export(path, output, export_format, batch_size):
+    """Export the output FHIR NDJSON files as flattened tables for analysis."""
+    from fhir_etl.export import export_parquet
+    INFO_COLOR = "green"
+
+    if not os.path.isdir(path):
+        raise ValueError(f"Path: '{path}' is not a valid directory.")
+
+    written = export_parquet(path, output, batch_size=batch_size)
+    click.secho({'format': export_format, 'rows': written}, fg=INFO_COLOR, file=sys.stderr)
+
+@cli.command('load')
+@click.option("-p", "--path", required=True,
+              help="Path to read the FHIR NDJSON files.")
+@click.option("-s", "--server", required=True,
+              help="Base url of the FHIR server, e.g. http://localhost:8080/fhir.")
+@click.option("--bundle-size", default=500, show_default=True, type=click.IntRange(min=1),
+              help="Resources per transaction Bundle.")
+@click.option("-c", "--concurrency", default=4, show_default=True, type=click.IntRange(min=1),
+              help="Bundles posted at the same time.")
+@click.option("--retries", default=5, show_default=True, type=click.IntRange(min=0),
+              help="Retries of a Bundle after a connection error, timeout, 429 or 5xx response.")
+@click.option("-H", "--header", "headers", multiple=True,
+              help="Extra HTTP header, e.g. 'Authorization: Bearer <token>'.")
+@click.option("--checkpoint", default=None,
+              help="Progress file to resume an interrupted load from (default: <path>/load_checkpoint.json).")
+def load(path, server, bundle_size, concurrency, retries, headers, checkpoint):
+    """Load the output FHIR NDJSON files into a FHIR server in transaction Bundles."""
+    from fhir_etl import report
+    from fhir_etl.loader import load_directory
+    INFO_COLOR = "green"
+    ERROR_COLOR = "red"
+
+    if not os.path.isdir(path):
+        raise ValueError(f"Path: '{path}' is not a valid directory.")
+
+    def print_error(failure):
+        click.secho(f"{failure.path} bundle {failure.bundle}: {failure.error}", fg=ERROR_COLOR, file=sys.stderr)
+
+    header_fields = dict((name.strip(), value.strip()) for name, _, value in (header.partition(':') for header in headers))
+    with report.progress(desc='Loading', unit='resource') as bar:
+        result = load_directory(path, server, bundle_size=bundle_size, concurrency=concurrency, retries=retries,
+                                headers=header_fields, checkpoint_path=checkpoint,
+                                on_progress=bar.update, on_error=print_error)
+    click.secho({'summary': result.resources, 'bundles': result.bundles, 'skipped': result.skipped,
+                 'failed': len(result.failed)}, fg=ERROR_COLOR if result.failed else INFO_COLOR, file=sys.stderr)
+    if result.failed:
+        sys.exit(1)
+
 @cli.command('transform')
-@click.option("-p", "--project", default=None,
-              help="Project name 1kgenomes or gtex.")
+@click.option("-p", "--project", required=True,
+              help=f"Project name: {', '.join(sorted(pipeline.FHIRIZERS))}, a registered plugin, or '{pipeline.ALL}' for every project.")
+@click.option("--only", multiple=True,
+              help="Run only this stage or the stage writing this resource type (e.g. Group), with the stages it needs; repeatable.")
 @click.option("-v", "--verbose", is_flag=True, default=False)
-def transformer(project, verbose):
-    assert project in ['1kgenomes', 'gtex']
-
-    if project == "1kgenomes":
-        meta_path = str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'onekgenomes' / 'META' ))
-        if not os.path.isdir(meta_path):
-            os.makedirs(meta_path, exist_ok=True)
-        transform_1k()
-        transform_1k_files()
-
-    if project == "gtex":
-        meta_path = str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'GTEx' / 'META' ))
-        if not os.path.isdir(meta_path):
-            os.makedirs(meta_path, exist_ok=True)
-        transform_gtex(verbose=verbose)
+@click.option("--offline", is_flag=True, default=False,
+              help="Run entirely from the source cache, without network access.")
+@click.option("--cache-dir", default=None,
+              help="Source cache directory (default: $FHIR_ETL_CACHE or ~/.cache/fhir_etl).")
+@click.option("--strict", is_flag=True, default=False,
+              help="Validate every generated resource against its fhir.resources model.")
+@click.option("--validate-first", default=builder.VALIDATE_FIRST, show_default=True,
+              help="Source rows of each output whose resources are fully validated before sampling kicks in.")
+@click.option("--validate-sample", default=builder.SAMPLE_RATE, show_default=True,
+              help="Fraction of the remaining resources fully validated.")
+@click.option("-w", "--workers", default=1, show_default=True,
+              help="Worker processes for row-to-resource conversion.")
+@click.option("--incremental", is_flag=True, default=False,
+              help="Skip outputs whose sources are unchanged since the last run and convert only changed rows.")
+@click.option("--group-max-members", default=None, type=click.IntRange(min=1),
+              help="Split Groups with more members into linked sub-Groups of at most this many members.")
+@click.option("--compress", type=click.Choice(['gzip', 'zstd']), default=None,
+              help="Write compressed <type>.ndjson.gz / .ndjson.zst outputs, on all CPUs (zstd needs the zstandard package).")
+@click.option("--shards", default=1, show_default=True, type=click.IntRange(min=1),
+              help="Split every output into <type>.<k>.ndjson files by a hash of the resource id, listed with their sha256 in manifest.json.")
+@click.option("--report", "report_path", default=None,
+              help="Save per-stage timings, row counts, bytes and peak memory of the run as JSON to this path.")
+@click.option("--trace-memory", is_flag=True, default=False,
+              help="Also record the tracemalloc peak of every stage in the report (slower).")
+def transformer(project, only, verbose, offline, cache_dir, strict, validate_first, validate_sample, workers, incremental,
+                group_max_members, compress, shards, report_path, trace_memory):
+    """Convert the sources of a project (or all of them) to FHIR NDJSON in its META directory."""
+    fhirizers = pipeline.fhirizers()
+    if project != pipeline.ALL and project not in fhirizers:
+        raise click.BadParameter(f"'{project}' is not one of {', '.join(sorted(fhirizers))} or '{pipeline.ALL}'.",
+                                 param_hint="'-p' / '--project'")
+    projects = sorted(fhirizers) if project == pipeline.ALL else [project]
+    from fhir_etl import cache
+    from fhir_etl import report
+    from fhir_etl import compression
+    from fhir_etl import shards as sharding
+    compression.configure(compression=compress)
+    sharding.configure(shards=shards)
+    report.configure(trace_memory=trace_memory)
+    source_cache = cache.configure(path=cache_dir, offline=offline)
+    builder.configure(strict=strict, validate_first=validate_first, sample_rate=validate_sample)
+
+    try:
+        pipeline.run(projects, only=only, verbose=verbose, workers=workers, incremental=incremental,
+                     group_max_members=group_max_members)
+    finally:
+        source_cache.flush()
+
+    if report_path:
+        report.save(report_path, project=project, only=list(only), workers=workers, incremental=incremental, offline=offline)
+        click.secho(f"Run report saved to {report_path}", fg="green", file=sys.stderr)
+
+@cli.command('bench')
+@click.option("--fixtures", default=None,
+              help="Recorded source cache to replay (a --cache-dir of a previous transform); default: synthetic fixtures.")
+@click.option("--scale", default=0.1, show_default=True,
+              help="Size of the synthetic fixtures, 1.0 is roughly a full GTEx / 1000 Genomes release.")
+@click.option("--repeat", default=1, show_default=True,
+              help="Runs per stage, the best time is reported.")
+@click.option("-w", "--workers", default=1, show_default=True,
+              help="Worker processes for the conversion and clean_resources stages.")
+@click.option("--no-memory", is_flag=True, default=False,
+              help="Skip the extra tracemalloc run per stage that measures peak memory.")
+@click.option("-o", "--output", default=None,
+              help="Where to save the JSON results (default: fhir_etl-bench-<timestamp>.json).")
+@click.option("--compare", "baseline", default=None, type=click.Path(exists=True),
+              help="Previous results to compare stage times against.")
+@click.option("--startup", is_flag=True, default=False,
+              help="Only time CLI start-up (fresh interpreter per run, best of --repeat, at least 5).")
+def benchmark(fixtures, scale, repeat, workers, no_memory, output, baseline, startup):
+    """Time every fhirizer stage against local stand-ins of the upstream sources."""
+    from fhir_etl import bench
+
+    baseline_report = None
+    if baseline:
+        with open(baseline) as f:
+            baseline_report = json.load(f)
+
+    def progress(result):
+        changes = bench.compare({'stages': [result]}, baseline_report) if baseline_report else {}
+        click.echo(bench.format_result(result, changes.get(result['stage'])))
+
+    if startup:
+        report = bench.startup(repeat=max(repeat, 5), progress=progress)
+    else:
+        report = bench.run(fixtures_path=fixtures, scale=scale, repeat=repeat, workers=workers,
+                           trace_memory=not no_memory, progress=progress)
+
+    output = output or f"fhir_etl-bench-{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.secho(f"Results saved to {output}", fg="green", file=sys.stderr)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,146 @@
+import io
+import os
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# -------------------------
+# compressed NDJSON
+# -------------------------
+# transform --compress gzip|zstd writes <type>.ndjson.gz / <type>.ndjson.zst instead of <type>.ndjson.
+# gzip output is a series of independent members, one per BLOCK_SIZE of NDJSON, compressed on a thread
+# pool (zlib releases the GIL) and written in order; zstd (needs `pip install zstandard`) uses the
+# library's own worker threads. Either way the output is the same whatever the number of threads, so
+# the manifest hashes and repeated runs stay stable. Any reader that opens NDJSON through open_read()
+# accepts all three forms; multi-member gzip and multi-frame zstd files are read as one stream, which is
+# also how new resources are appended to a compressed file.
+
+CODECS = ('gzip', 'zstd')
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+BLOCK_SIZE = 1 << 20  # 1 MiB of NDJSON per gzip member
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_compression = None
+_threads = os.cpu_count() or 1
+
+
+def configure(compression=None, threads=None):
+    """Set the compression of NDJSON written by the fhirizers (None writes plain NDJSON)."""
+    global _compression, _threads
+    assert compression in (None,) + CODECS, f"Unknown compression: {compression}"
+    if compression == 'zstd':
+        _zstandard()  # fail before transforming rather than at the first write
+    _compression = compression
+    _threads = threads or os.cpu_count() or 1
+
+
+def get_compression():
+    return _compression
+
+
+def get_threads():
+    return _threads
+
+
+def suffix(compression) -> str:
+    return SUFFIXES.get(compression, '')
+
+
+def compression_of(file_path):
+    """Codec of file_path judged by its suffix, None for plain files."""
+    for compression, codec_suffix in SUFFIXES.items():
+        if str(file_path).endswith(codec_suffix):
+            return compression
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression needs the zstandard package: pip install fhir_etl[zstd]")
+    return zstandard
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Binary writer that gzips BLOCK_SIZE blocks as separate members on `threads` threads, keeping them in order."""
+
+    def __init__(self, file, threads=None, level=GZIP_LEVEL, block_size=BLOCK_SIZE):
+        self.file = file
+        self.level = level
+        self.block_size = block_size
+        self.buffer = bytearray()
+        threads = threads or _threads
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.max_in_flight = 2 * threads
+        self.in_flight = deque()
+
+    def writable(self):
+        return True
+
+    def _compress(self, block):
+        return gzip.compress(block, compresslevel=self.level, mtime=0)
+
+    def _submit(self, block):
+        if self.executor is None:
+            self.file.write(self._compress(block))
+            return
+        self.in_flight.append(self.executor.submit(self._compress, block))
+        while len(self.in_flight) >= self.max_in_flight:
+            self.file.write(self.in_flight.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.in_flight:
+                self.file.write(self.in_flight.popleft().result())
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file.close()
+            super().close()
+
+
+def open_write(file_path, compression=None, append=False, threads=None):
+    """
+    Binary file object writing file_path with compression (None: plain, buffered).
+    With append, compressed data goes into a new gzip member / zstd frame after the existing ones.
+    """
+    mode = 'ab' if append else 'wb'
+    if compression is None:
+        return open(file_path, mode, buffering=BLOCK_SIZE)
+    return wrap_write(open(file_path, mode), compression, threads=threads)
+
+
+def wrap_write(file, compression, threads=None):
+    """Binary writer compressing into an open binary file object, which it closes."""
+    if compression == 'gzip':
+        return ParallelGzipWriter(file, threads=threads)
+    if compression == 'zstd':
+        zstandard = _zstandard()
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=max(threads or _threads, 1), write_checksum=True)
+        return compressor.stream_writer(file, closefd=True)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def open_read(file_path):
+    """Binary, line-iterable reader of a plain, .gz or .zst NDJSON file."""
+    compression = compression_of(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rb')
+    if compression == 'zstd':
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(file_path, 'rb'), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader, buffer_size=BLOCK_SIZE)
+    return open(file_path, 'rb')
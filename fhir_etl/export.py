@@ -0,0 +1,190 @@
+import os
+from pathlib import Path
+
+import orjson
+
+from fhir_etl.validator import ndjson_files, NDJSON_SUFFIX
+from fhir_etl.refcheck import iter_references, _iter_resources
+
+# -------------------------
+# Parquet export
+# -------------------------
+# `fhir_etl export --format parquet` writes one <Type>.parquet per <Type>.ndjson(.gz/.zst), one row per
+# resource, plus references.parquet with one row per reference. Resources are flattened into columns
+# named by their path: nested objects are joined with '.', the first item of a list keeps the path
+# (identifier.value, type.coding.code, subject.reference) and item n > 0 gets path[n]; Group.member and
+# any list longer than MAX_LIST_ITEMS become a `<path>.count` column and their references are left to
+# references.parquet. Extensions are pivoted into one column per url, named by the last part of the url
+# (extension.us-core-sex, extension.research-population, extension.part-of-study.reference); the
+# name -> url mapping is kept in the Parquet metadata. Each file is streamed twice: the first pass
+# collects the columns and their types, the second writes row groups of batch_size rows, so memory is
+# one batch. String columns are dictionary encoded. Needs pyarrow (`pip install fhir_etl[parquet]`).
+
+FORMATS = ('parquet',)
+BATCH_SIZE = 65536  # rows per Parquet row group
+MAX_LIST_ITEMS = 5
+COUNTED_LISTS = ('member',)  # keys of lists exported as their length only
+PARQUET_COMPRESSION = 'zstd'
+EXTENSIONS_METADATA = b'fhir_etl.extensions'
+REFERENCES_FILE = 'references.parquet'
+REFERENCE_COLUMNS = ('resourceType', 'id', 'field', 'reference', 'target_type', 'target_id')
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet export needs the pyarrow package: pip install fhir_etl[parquet]")
+    return pyarrow, pyarrow.parquet
+
+
+def extension_name(url: str) -> str:
+    """Column name of an extension url, e.g. .../StructureDefinition/us-core-sex -> us-core-sex."""
+    name = url.rstrip('/').rsplit('/', 1)[-1]
+    name = name.removesuffix('.html').removeprefix('StructureDefinition-')
+    return name or url
+
+
+def _extension_column(path, url, extensions) -> str:
+    name = extension_name(url)
+    if extensions.setdefault(name, url) != url:
+        name = url  # two urls ending alike, keep the second one unambiguous
+        extensions[name] = url
+    return f"{path}.extension.{name}" if path else f"extension.{name}"
+
+
+def _flatten_extensions(items, path, row, extensions):
+    seen = {}
+    for extension in items:
+        if not isinstance(extension, dict) or 'url' not in extension:
+            continue
+        column = _extension_column(path, extension['url'], extensions)
+        index = seen.get(column, 0)
+        seen[column] = index + 1
+        if index:
+            column = f"{column}[{index}]"
+        for key, value in extension.items():
+            if key.startswith('value'):
+                flatten(value, column, row, extensions)
+            elif key == 'extension':
+                _flatten_extensions(value, column, row, extensions)
+
+
+def flatten(value, path='', row=None, extensions=None) -> dict:
+    """{column: scalar} of a resource (or any JSON value under path); extensions collects name -> url."""
+    row = {} if row is None else row
+    extensions = {} if extensions is None else extensions
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'extension' and isinstance(item, list):
+                _flatten_extensions(item, path, row, extensions)
+            else:
+                flatten(item, f"{path}.{key}" if path else key, row, extensions)
+    elif isinstance(value, list):
+        if len(value) > MAX_LIST_ITEMS or path.rpartition('.')[2] in COUNTED_LISTS:
+            row[f"{path}.count"] = len(value)
+            return row
+        for index, item in enumerate(value):
+            flatten(item, f"{path}[{index}]" if index else path, row, extensions)
+    elif value is not None:
+        row[path] = value
+    return row
+
+
+def _arrow_type(pa, types):
+    if types == {bool}:
+        return pa.bool_()
+    if types <= {int}:
+        return pa.int64()
+    if types <= {int, float}:
+        return pa.float64()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def _text(value):
+    return value if value is None or isinstance(value, str) else orjson.dumps(value).decode()
+
+
+def _table(pa, schema, rows):
+    arrays = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array([_text(value) for value in values], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def resource_schema(file_path):
+    """First pass: the pyarrow schema of the flattened resources in file_path."""
+    pa, _ = _pyarrow()
+    types = {}
+    extensions = {}
+    for resource in _iter_resources([file_path]):
+        for column, value in flatten(resource, extensions=extensions).items():
+            types.setdefault(column, set()).add(type(value))
+    schema = pa.schema([pa.field(column, _arrow_type(pa, column_types)) for column, column_types in types.items()])
+    return schema.with_metadata({EXTENSIONS_METADATA: orjson.dumps(extensions)})
+
+
+def _output_path(directory_path, file_path, output_path) -> Path:
+    relative = Path(file_path).relative_to(Path(directory_path).expanduser())
+    name = relative.name[:relative.name.index(NDJSON_SUFFIX)]
+    return Path(output_path) / relative.parent / f"{name}.parquet"
+
+
+def export_parquet(directory_path, output_path, batch_size=BATCH_SIZE) -> dict:
+    """
+    Write every NDJSON file under directory_path as Parquet under output_path, and all references as
+    references.parquet. Returns {written file: rows}.
+    """
+    pa, pq = _pyarrow()
+    written = {}
+    files = ndjson_files(directory_path)
+    os.makedirs(output_path, exist_ok=True)
+
+    for file_path in files:
+        schema = resource_schema(file_path)
+        parquet_path = _output_path(directory_path, file_path, output_path)
+        parquet_path.parent.mkdir(parents=True, exist_ok=True)
+        rows = 0
+        with pq.ParquetWriter(parquet_path, schema, compression=PARQUET_COMPRESSION) as writer:
+            extensions = {}
+            resources = (flatten(resource, extensions=extensions) for resource in _iter_resources([file_path]))
+            for batch in _batches(resources, batch_size):
+                writer.write_table(_table(pa, schema, batch), row_group_size=batch_size)
+                rows += len(batch)
+        written[str(parquet_path)] = rows
+
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    reference_schema = pa.schema([
+        pa.field('resourceType', dictionary), pa.field('id', pa.string()), pa.field('field', dictionary),
+        pa.field('reference', pa.string()), pa.field('target_type', dictionary), pa.field('target_id', pa.string()),
+    ])
+    references_path = Path(output_path) / REFERENCES_FILE
+    rows = 0
+    with pq.ParquetWriter(references_path, reference_schema, compression=PARQUET_COMPRESSION) as writer:
+        references = (
+            dict(zip(REFERENCE_COLUMNS, (resource['resourceType'], resource['id'], field, reference,
+                                         *reference.partition('/')[::2])))
+            for resource in _iter_resources(files)
+            for field, reference in iter_references(resource, resource['resourceType'])
+        )
+        for batch in _batches(references, batch_size):
+            writer.write_table(_table(pa, reference_schema, batch), row_group_size=batch_size)
+            rows += len(batch)
+    written[str(references_path)] = rows
+    return written
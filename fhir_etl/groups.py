@@ -0,0 +1,82 @@
+import uuid
+import hashlib
+
+import numpy as np
+import orjson
+
+from fhir_etl import builder
+
+# -------------------------
+# streamed Group resources
+# -------------------------
+# Group membership is carried as a sorted array of 16-byte specimen uuids (np 'S16', 16 bytes a member)
+# instead of reference strings or a pydantic Group with one GroupMember model per member. The Group line
+# is serialized directly: the resource without its members goes through orjson, and the member array is
+# spliced in from a byte template, so the output matches what the Group model produced. The resource
+# minus its members (plus the first member) is validated through builder.checked.
+# With max_members, a larger Group is split into sub-Groups (<identifier value>-part-<n>) of at most
+# max_members specimens each. The Group itself keeps its id, type and characteristics, so references to
+# it (e.g. DocumentReference.subject) are unchanged, but lists no members: its `quantity` is the total
+# number of members and a PART_EXTENSION_URL extension references each sub-Group, in order. Group.member
+# only ever holds entities of the Group's type.
+
+MEMBER_TEMPLATE = '{"entity":{"reference":"%s/%s"}}'
+PART_EXTENSION_URL = "http://fhir-aggregator.org/fhir/StructureDefinition/group-part"
+_MEMBERS_PLACEHOLDER = "__members__"
+
+
+def member_keys(ids) -> np.ndarray:
+    """Compact member array of minted uuid strings, in the given order."""
+    return np.array([uuid.UUID(member_id).bytes for member_id in ids], dtype='S16')
+
+
+def members_digest(keys) -> str:
+    """Fingerprint of a member array, for the incremental manifest."""
+    return hashlib.sha256(np.ascontiguousarray(keys).tobytes()).hexdigest()
+
+
+def _uuid_string(key: bytes) -> str:
+    return str(uuid.UUID(bytes=key.ljust(16, b"\0")))
+
+
+def _members(member_type, keys):
+    """JSON array of member entries for keys."""
+    template = MEMBER_TEMPLATE.replace('%s', member_type, 1)
+    return ("[" + ",".join(template % _uuid_string(key) for key in keys.tolist()) + "]").encode()
+
+
+def group_line(group: dict, member_type, keys) -> bytes:
+    """
+    The NDJSON line of `group` (a Group resource dict without `member`) with a member entry
+    {"entity": {"reference": "<member_type>/<uuid>"}} for every key.
+    """
+    sample = [orjson.loads(MEMBER_TEMPLATE % (member_type, _uuid_string(key))) for key in keys[:1].tolist()]
+    builder.checked({**group, "member": sample} if sample else group)
+    if not len(keys):
+        return orjson.dumps(group)
+    line = orjson.dumps({**group, "member": _MEMBERS_PLACEHOLDER})
+    return line.replace(orjson.dumps(_MEMBERS_PLACEHOLDER), _members(member_type, keys), 1)
+
+
+def group_lines(group: dict, member_type, keys, max_members=None, part_id=None):
+    """
+    (id, line) of the Group, or with more than max_members members, of the Group (without members, linked
+    to its parts) followed by its sub-Groups. part_id(n) mints the id of sub-Group n (from 1), e.g. from its
+    identifier.
+    """
+    if not max_members or len(keys) <= max_members:
+        yield group["id"], group_line(group, member_type, keys)
+        return
+
+    parts = []
+    for number, start in enumerate(range(0, len(keys), max_members), start=1):
+        part = dict(group)
+        part["id"] = part_id(number)
+        part["identifier"] = [{**identifier, "value": f"{identifier['value']}-part-{number}"} for identifier in group.get("identifier", [])]
+        parts.append((part, keys[start:start + max_members]))
+
+    part_extensions = [{"url": PART_EXTENSION_URL, "valueReference": {"reference": f"Group/{part['id']}"}} for part, _ in parts]
+    parent = {**group, "extension": group.get("extension", []) + part_extensions, "quantity": len(keys)}
+    yield group["id"], group_line(parent, member_type, keys[:0])
+    for part, part_members in parts:
+        yield part["id"], group_line(part, member_type, part_members)
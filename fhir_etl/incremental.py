@@ -0,0 +1,184 @@
+import os
+import hashlib
+
+import orjson
+import pandas as pd
+
+from fhir_etl import cache
+from fhir_etl import utils
+from fhir_etl import parallel
+from fhir_etl import shards
+from fhir_etl import compression
+
+# -------------------------
+# incremental transforms
+# -------------------------
+# Every transform writes <META>/transform_manifest.json next to its output: the fingerprint of each source it
+# used (content sha256, ETag, Last-Modified; FTP MDTM values are part of the cached listing) and, per
+# resource type, the fingerprint of the inputs it was built from, the sha256 of the written file and a
+# [id, row hash, content hash] entry per resource. With --incremental an output whose inputs and file are
+# unchanged is skipped, and an output whose inputs changed only converts the rows whose prepared values
+# changed; every other line is copied from the previous file. Hashes are of the NDJSON itself, so --compress
+# outputs are hashed decompressed. With --shards the shard count is part of the inputs, the files are checked
+# against the sha256 in manifest.json (see fhir_etl.shards) and previous lines are found by content hash.
+# Code changes are not fingerprinted, run without --incremental after upgrading.
+
+MANIFEST_NAME = 'transform_manifest.json'
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def fingerprint(*parts) -> str:
+    """Stable digest of JSON-ready parts (anything else is fingerprinted by its repr)."""
+    return hashlib.sha256(orjson.dumps(parts, default=repr, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def file_sha256(file_path) -> str:
+    """sha256 of the (decompressed) NDJSON in file_path."""
+    digest = hashlib.sha256()
+    with compression.open_read(file_path) as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def row_hashes(frame) -> list:
+    """Per-row digest of the prepared converter columns."""
+    return [format(value, '016x') for value in pd.util.hash_pandas_object(frame, index=False)]
+
+
+class Manifest:
+    def __init__(self, meta_path, incremental=False):
+        self.meta_path = meta_path
+        self.path = os.path.join(meta_path, MANIFEST_NAME)
+        self.incremental = incremental
+        previous = self._load()
+        # entries of outputs that are not rebuilt this run are carried over unchanged
+        self.sources = previous.get('sources', {})
+        self.outputs = previous.get('outputs', {})
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'rb') as file:
+                manifest = orjson.loads(file.read())
+        except (OSError, orjson.JSONDecodeError):
+            return {}
+        return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps({'version': MANIFEST_VERSION, 'sources': self.sources, 'outputs': self.outputs}))
+        os.replace(tmp_path, self.path)
+
+    def output_path(self, resource_type) -> str:
+        return utils.ndjson_path(self.meta_path, resource_type)
+
+    def record_sources(self, *urls) -> dict:
+        """Record the sources used this run for urls."""
+        sources = cache.get_cache().used_sources(*urls)
+        self.sources.update(sources)
+        return sources
+
+    def inputs(self, *urls, extra=()) -> str:
+        """Fingerprint of an output built from the sources of urls (recorded as well) and any extra values."""
+        sharding = [shards.get_shards()] if shards.get_shards() > 1 else []
+        return fingerprint(self.record_sources(*urls), list(extra), *sharding)
+
+    def is_current(self, resource_type, inputs) -> bool:
+        """In incremental mode, whether <resource_type>.ndjson was built from the same inputs and is untouched since."""
+        if not self.incremental:
+            return False
+        entry = self.outputs.get(resource_type)
+        if not entry or entry.get('inputs') != inputs:
+            return False
+        if shards.get_shards() > 1:
+            if not shards.is_intact(self.meta_path, resource_type):
+                return False
+        else:
+            output_path = self.output_path(resource_type)
+            if not os.path.exists(output_path) or file_sha256(output_path) != entry.get('sha256'):
+                return False
+        print(f"{resource_type}.ndjson is up to date, skipping")
+        return True
+
+    def _previous_lines(self, resource_type, args) -> dict:
+        """row hash -> line of the previous output (in one file or in shards), for lines that still match a recorded content hash."""
+        entry = self.outputs.get(resource_type)
+        if not entry or entry.get('args') != args:
+            return {}
+        row_hashes_by_digest = {digest: row_hash for _, row_hash, digest in entry.get('resources', []) if row_hash is not None}
+        lines = {}
+        for output_path in shards.find_outputs(self.meta_path, resource_type):
+            with compression.open_read(output_path) as file:
+                for line in file:
+                    line = line.rstrip(b"\n")
+                    row_hash = row_hashes_by_digest.get(utils.content_hash(line))
+                    if row_hash is not None:
+                        lines[row_hash] = line
+        return lines
+
+    def _record(self, resource_type, inputs, args, lines):
+        """Pass serialized lines through to the writer, hashing them on the way; the entry is stored once they are all written."""
+        resources = []
+        digest = hashlib.sha256()
+        for resource_id, row_hash, line in lines:
+            resources.append([resource_id, row_hash, utils.content_hash(line)])
+            digest.update(line)
+            digest.update(b"\n")
+            yield line
+        self.outputs[resource_type] = {'inputs': inputs, 'args': args, 'sha256': digest.hexdigest(),
+                                       'count': len(resources), 'resources': resources}
+
+    def rows(self, resource_type, frame, converter, *args, inputs, id_column, executor=None, row_name='Row'):
+        """
+        Serialized converter(row, *args) lines for every row of frame, in source order, for write_ndjson.
+        frame may also be an iterable of frames (e.g. sources.PreparedChunks), converted one after another.
+        In incremental mode rows whose hash (and converter arguments) match the previous run reuse their
+        previous line and only the remaining rows go through parallel.convert_rows.
+        """
+        frames = [frame] if isinstance(frame, pd.DataFrame) else frame
+        args_fingerprint = fingerprint(converter.__module__, converter.__qualname__, list(args))
+        previous = self._previous_lines(resource_type, args_fingerprint) if self.incremental else {}
+
+        def lines():
+            rows = changed_rows = 0
+            for chunk in frames:
+                hashes = row_hashes(chunk)
+                changed = [row_hash not in previous for row_hash in hashes]
+                rows += len(hashes)
+                changed_rows += sum(changed)
+                positions = range(rows - len(hashes), rows)
+                converted = parallel.convert_rows(chunk[changed] if previous else chunk, converter, *args,
+                                                  executor=executor, row_name=row_name,
+                                                  positions=[position for position, is_changed in zip(positions, changed) if is_changed] if previous else positions)
+                for resource_id, row_hash, is_changed in zip(chunk[id_column], hashes, changed):
+                    yield resource_id, row_hash, utils.dump_resource(next(converted)) if is_changed else previous[row_hash]
+            if self.incremental:
+                print(f"{resource_type}: {changed_rows} of {rows} rows changed since the last run")
+
+        return self._record(resource_type, inputs, args_fingerprint, lines())
+
+    def resources(self, resource_type, resources, inputs):
+        """Serialized lines for resources built outside of rows() (ResearchStudy, Group)."""
+        def lines():
+            for resource in resources:
+                resource = utils.to_resource_dict(resource)
+                yield resource.get('id'), None, utils.dump_resource(resource)
+
+        return self._record(resource_type, inputs, None, lines())
+
+    def serialized(self, resource_type, lines, inputs):
+        """Record (id, line) pairs serialized elsewhere, e.g. by groups.group_lines."""
+        return self._record(resource_type, inputs, None, ((resource_id, None, line) for resource_id, line in lines))
+
+    def record(self, resource_type, inputs):
+        """Record an output that was merged in place by utils.create_or_extend (per shard), from its sidecar indexes."""
+        output_paths = shards.find_outputs(self.meta_path, resource_type)
+        resources = []
+        for output_path in output_paths:
+            records = utils.load_ndjson_index(output_path)['records']
+            resources += [[resource_id, None, digest] for resource_id, (_, _, digest) in sorted(records.items(), key=lambda item: item[1][0])]
+        sha256 = file_sha256(output_paths[0]) if len(output_paths) == 1 else fingerprint([file_sha256(output_path) for output_path in output_paths])
+        self.outputs[resource_type] = {'inputs': inputs, 'args': None, 'sha256': sha256,
+                                       'count': len(resources), 'resources': resources}
@@ -0,0 +1,241 @@
+import os
+import time
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import orjson
+
+from fhir_etl import shards
+from fhir_etl import compression
+from fhir_etl.validator import ndjson_files, NDJSON_SUFFIX
+from fhir_etl.refcheck import iter_references
+
+# -------------------------
+# bulk loading into a FHIR server
+# -------------------------
+# `fhir_etl load` PUTs every resource of a META directory into a FHIR server in transaction Bundles of
+# bundle_size entries, so retrying a bundle or loading twice is idempotent. Resource types are loaded one
+# after another in LOAD_ORDER, so references always point at resources that are already on the server;
+# within a type, resources referencing the same type (a Group listing its sub-Groups) go after the rest,
+# across all the <type>.<k>.ndjson files of a --shards output.
+# The bundles of a type are posted by `concurrency` threads over one pooled requests.Session, with at
+# most 2 * concurrency bundles in flight. A bundle that fails with a connection error, a timeout, 429 or
+# 5xx is retried with exponential backoff; any other response fails it. Every bundle that is done is
+# recorded in <META>/load_checkpoint.json, and a new run against the same server skips those bundles,
+# unless their file changed: by the sha256 of shards listed in manifest.json (so a shard rewritten with
+# the same content is still skipped), by size and mtime otherwise. The load stops after the first
+# resource type with failed bundles.
+
+LOAD_ORDER = ('ResearchStudy', 'Patient', 'ResearchSubject', 'Specimen', 'Group', 'DocumentReference')
+BUNDLE_SIZE = 500
+CONCURRENCY = 4
+RETRIES = 5
+BACKOFF_SECONDS = 1.0
+TIMEOUT = 300
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+CHECKPOINT_NAME = 'load_checkpoint.json'
+CHECKPOINT_VERSION = 1
+FHIR_JSON = 'application/fhir+json'
+
+BundleFailure = namedtuple('BundleFailure', ['path', 'bundle', 'error'])
+LoadResult = namedtuple('LoadResult', ['resources', 'bundles', 'skipped', 'failed'])
+
+
+class BundleError(RuntimeError):
+    """A transaction Bundle was rejected, or still failed after its retries."""
+
+
+def resource_type_of(file_path) -> str:
+    """Resource type of <type>.ndjson or of a shard <type>.<k>.ndjson (in any compression)."""
+    name = Path(file_path).name
+    return name[:name.index(NDJSON_SUFFIX)].split('.')[0]
+
+
+def load_order(files) -> list:
+    """files sorted by the LOAD_ORDER of their resource type, other types last."""
+    def key(file_path):
+        resource_type = resource_type_of(file_path)
+        rank = LOAD_ORDER.index(resource_type) if resource_type in LOAD_ORDER else len(LOAD_ORDER)
+        return rank, resource_type, str(file_path)
+    return sorted(files, key=key)
+
+
+def transaction_entries(file_path, self_references=False):
+    """
+    Bundle entry (bytes) of every resource in file_path that does (self_references) or does not reference
+    a resource of its own type.
+    """
+    resource_type = resource_type_of(file_path)
+    prefix = f"{resource_type}/"
+    with compression.open_read(file_path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            resource = orjson.loads(line)
+            references = (reference for _, reference in iter_references(resource, resource['resourceType']))
+            if any(reference.startswith(prefix) for reference in references) != self_references:
+                continue
+            url = f"{resource['resourceType']}/{resource['id']}".encode()
+            yield b'{"resource":' + line + b',"request":{"method":"PUT","url":"' + url + b'"}}'
+
+
+def transaction_bundles(entries, bundle_size=BUNDLE_SIZE):
+    """(entries in bundle, transaction Bundle bytes) of every bundle_size entries."""
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= bundle_size:
+            yield len(batch), _bundle(batch)
+            batch = []
+    if batch:
+        yield len(batch), _bundle(batch)
+
+
+def _bundle(entries) -> bytes:
+    return b'{"resourceType":"Bundle","type":"transaction","entry":[' + b",".join(entries) + b"]}"
+
+
+def session(concurrency=CONCURRENCY, headers=None):
+    """requests.Session keeping up to `concurrency` connections to the server open."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    http = requests.Session()
+    http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency))
+    http.headers.update({'Content-Type': FHIR_JSON, 'Accept': FHIR_JSON, **(headers or {})})
+    return http
+
+
+def post_bundle(http, server, body, retries=RETRIES, backoff=None, timeout=TIMEOUT):
+    """POST a transaction Bundle to the server base url, retrying transient failures (after backoff, default
+    BACKOFF_SECONDS, doubled on every attempt)."""
+    import requests
+    backoff = BACKOFF_SECONDS if backoff is None else backoff
+    error = None
+    for attempt in range(retries + 1):
+        delay = backoff * 2 ** attempt
+        try:
+            response = http.post(server, data=body, timeout=timeout)
+        except requests.RequestException as e:
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if response.status_code < 300:
+                return response
+            error = f"HTTP {response.status_code}: {response.text[:500]}"
+            if response.status_code not in RETRY_STATUSES:
+                raise BundleError(error)
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        if attempt < retries:
+            time.sleep(delay)
+    raise BundleError(f"{error} (after {retries} retries)")
+
+
+class Checkpoint:
+    def __init__(self, path, server, bundle_size):
+        self.path = path
+        self.server = server
+        self.bundle_size = bundle_size
+        previous = self._load()
+        self.files = previous.get('files', {}) if (previous.get('server'), previous.get('bundle_size')) == (server, bundle_size) else {}
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'rb') as file:
+                checkpoint = orjson.loads(file.read())
+        except (OSError, orjson.JSONDecodeError):
+            return {}
+        return checkpoint if checkpoint.get('version') == CHECKPOINT_VERSION else {}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps({'version': CHECKPOINT_VERSION, 'server': self.server,
+                                     'bundle_size': self.bundle_size, 'files': self.files}))
+        os.replace(tmp_path, self.path)
+
+    def done(self, name, file_path) -> set:
+        """Bundles of file_path already loaded; a file that changed since starts over."""
+        stat = os.stat(file_path)
+        state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': shards.file_sha256(file_path)}
+        entry = self.files.get(name)
+        if not entry or not _same_file(entry, state):
+            entry = self.files[name] = {**state, 'done': []}
+        else:
+            entry.update(state)
+        return set(entry['done'])
+
+    def mark_done(self, name, bundle):
+        self.files[name]['done'].append(bundle)
+        self.save()
+
+
+def _same_file(entry, state) -> bool:
+    if entry.get('sha256') and state['sha256']:
+        return entry['sha256'] == state['sha256']
+    return (entry['size'], entry['mtime_ns']) == (state['size'], state['mtime_ns'])
+
+
+def load_directory(directory_path, server, bundle_size=BUNDLE_SIZE, concurrency=CONCURRENCY, retries=RETRIES,
+                   headers=None, checkpoint_path=None, on_progress=None, on_error=None) -> LoadResult:
+    """
+    Load every NDJSON file under directory_path into the FHIR server at `server` (its base url).
+    on_progress(resources) is called after every bundle that is loaded or skipped, on_error(failure) for
+    every BundleFailure. Returns resources={resource type: resources loaded this run}, bundle counts and failures.
+    """
+    server = server.rstrip('/')
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(directory_path, CHECKPOINT_NAME), server, bundle_size)
+    http = session(concurrency, headers)
+    resources = {}
+    bundles = skipped = 0
+    failed = []
+
+    def finish(resource_type, in_flight, futures):
+        for future in futures:
+            name, bundle, count = in_flight.pop(future)
+            try:
+                future.result()
+            except BundleError as e:
+                failure = BundleFailure(name, bundle, str(e))
+                failed.append(failure)
+                if on_error:
+                    on_error(failure)
+                continue
+            checkpoint.mark_done(name, bundle)
+            resources[resource_type] = resources.get(resource_type, 0) + count
+            if on_progress:
+                on_progress(count)
+
+    files_by_type = {}
+    for file_path in load_order(ndjson_files(directory_path)):
+        files_by_type.setdefault(resource_type_of(file_path), []).append(file_path)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for resource_type, file_paths in files_by_type.items():
+            names = {file_path: str(file_path.relative_to(Path(directory_path).expanduser())) for file_path in file_paths}
+            done = {file_path: checkpoint.done(names[file_path], file_path) for file_path in file_paths}
+            numbers = dict.fromkeys(file_paths, 0)
+            # resources referencing their own type go after everything they can reference, in every shard
+            for self_references in (False, True):
+                in_flight = {}
+                for file_path in file_paths:
+                    for count, body in transaction_bundles(transaction_entries(file_path, self_references), bundle_size):
+                        numbers[file_path] += 1
+                        if numbers[file_path] in done[file_path]:
+                            skipped += 1
+                            if on_progress:
+                                on_progress(count)
+                            continue
+                        bundles += 1
+                        in_flight[executor.submit(post_bundle, http, server, body, retries)] = (names[file_path], numbers[file_path], count)
+                        if len(in_flight) >= 2 * concurrency:
+                            finish(resource_type, in_flight, wait(in_flight, return_when=FIRST_COMPLETED).done)
+                finish(resource_type, in_flight, wait(in_flight).done)
+            if failed:
+                break
+
+    checkpoint.save()
+    return LoadResult(resources=resources, bundles=bundles, skipped=skipped, failed=failed)
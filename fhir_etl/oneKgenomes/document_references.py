@@ -1,20 +1,18 @@
-import orjson
+import os
 import ftplib
-import pandas as pd
 import json
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fhir_etl import utils
+from fhir_etl import shards
+from fhir_etl import cache
+from fhir_etl import builder
+from fhir_etl import report
+from fhir_etl import compression
+from fhir_etl import groups
 
-from fhir.resources.extension import Extension
-from fhir.resources.group import Group
-from fhir.resources.documentreference import DocumentReference
-from fhir.resources.identifier import Identifier
-from fhir.resources.reference import Reference
 
-from pathlib import Path
-import importlib.resources
-import importlib
 
 import mimetypes
 mimetypes.add_type('text/vcf', '.vcf')
@@ -22,7 +20,19 @@ mimetypes.add_type('text/vcf', '.vcf')
 # -------------------------
 # global
 # -------------------------
-IDMakerInstance = utils.IDHelper()
+RELEASE_FTP_SERVER = "ftp.1000genomes.ebi.ac.uk"
+RELEASE_FTP_DIRECTORY = "/vol1/ftp/release/20130502/supporting/vcf_with_sample_level_annotation/"
+RELEASE_HEADER_URL = "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/release/20130502/supporting/vcf_with_sample_level_annotation/header"
+FTP_WORKERS = 4
+FTP_TIMEOUT = 60
+IDMakerInstance = utils.get_id_helper('1KG', utils.THOUSAND_GENOMES)
+SAMPLE_INFO_SYSTEM = "".join([f"https://{utils.THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"])
+STUDY_EXTENSION = {
+    "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
+    "valueReference": {
+        "reference": "ResearchStudy/" + IDMakerInstance.mint(SAMPLE_INFO_SYSTEM, "1KG", "ResearchStudy")
+    }
+}
 
 # -------------------------
 # create DocumentReference from VCFs
@@ -62,19 +72,10 @@ def create_document_reference(file_row):
     if file_size > 0:
         attachment["size"] = file_size
 
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
-        "valueReference": {
-            "reference": f"ResearchStudy/{IDMakerInstance.mint_id(Identifier(**{'system': ''.join([f'https://{utils.THOUSAND_GENOMES}', 'technical/working/20130606_sample_info/']), 'value': '1KG'}), 'ResearchStudy')}"
-        }
-    }))
-    doc_ref_identifier = Identifier(
-        **{"system": ftp_directory,
-           "value": file_name})
-    doc_ref_id = IDMakerInstance.mint_id(doc_ref_identifier, "DocumentReference")
+    doc_ref_id = IDMakerInstance.mint(ftp_directory, file_name, "DocumentReference")
 
-    return DocumentReference(**{
+    return builder.checked({
+        "resourceType": "DocumentReference",
         "id": doc_ref_id,
         "identifier": [
             {
@@ -110,59 +111,197 @@ def create_document_reference(file_row):
                 ]
             }
         ],
-        "extension": extensions
+        "extension": [STUDY_EXTENSION]
     })
 
 
-def transform_1k_files():
-    specimen_file = str(Path(importlib.resources.files('fhir_etl').parent /'fhir_etl' / 'oneKgenomes' / 'META' / 'Specimen.ndjson'))
-    assert specimen_file, "don't have Specimen.ndjson to derive file subject from..."
-
-    ftp_server = "ftp.1000genomes.ebi.ac.uk"
-    ftp_directory = "/vol1/ftp/release/20130502/supporting/vcf_with_sample_level_annotation/"
-    base_url = "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/release/20130502/supporting/vcf_with_sample_level_annotation"
-
-    ftp = ftplib.FTP(ftp_server)
+def _ftp_session(ftp_server, ftp_directory):
+    # ftp_server may carry a port, e.g. a local stand-in at 127.0.0.1:2121
+    host, _, port = ftp_server.partition(':')
+    ftp = ftplib.FTP(timeout=FTP_TIMEOUT)
+    ftp.connect(host, int(port or ftplib.FTP_PORT))
     ftp.login()  # Anonymous login
     ftp.cwd(ftp_directory)
-    files = ftp.nlst()
+    return ftp
 
-    file_info = []
-    for file in files:
-        # only files that contain 'vcf' (e.g., vcf or vcf.gz)
-        if "vcf" not in file.lower():
-            continue
 
-        # file size; default to 0 if unavailable
-        try:
-            size = ftp.size(file)
-            if size is None:
-                size = 0
-        except Exception:
-            size = 0
+def _quit(ftp):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def _is_release_file(file):
+    # only files that contain 'vcf' (e.g., vcf or vcf.gz)
+    return "vcf" in file.lower()
 
-        # last modified date using MDTM command
+
+def _mlsd_file_info(file, facts):
+    """file row from an MLSD entry, 'modify' is YYYYMMDDHHMMSS[.sss] like an MDTM reply."""
+    try:
+        size = int(facts.get('size') or 0)
+    except ValueError:
+        size = 0
+    modify = facts.get('modify')
+    last_modified = utils.parse_mdtm("213 " + modify[:14]) if modify else datetime.now().isoformat()
+    return {'file': file, 'size': size, 'last_modified': last_modified}
+
+
+def _iter_mlsd(ftp):
+    """(name, facts) of every MLSD entry as its line arrives on the data connection; ftplib's FTP.mlsd only
+    yields once the whole listing is read. Raises ftplib.error_perm when the server has no MLSD."""
+    ftp.sendcmd('TYPE A')
+    with ftp.transfercmd('MLSD') as connection, connection.makefile('r', encoding=ftp.encoding) as listing:
+        for line in listing:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            facts_found, _, name = line.partition(' ')
+            facts = {}
+            for fact in facts_found[:-1].split(';'):
+                key, _, value = fact.partition('=')
+                facts[key.lower()] = value
+            yield name, facts
+    ftp.voidresp()
+
+
+def _stat_file_info(ftp, file):
+    """file row from per-file SIZE and MDTM commands, for servers without MLSD."""
+    # file size; default to 0 if unavailable
+    try:
+        size = ftp.size(file)
+        if size is None:
+            size = 0
+    except Exception:
+        size = 0
+
+    # last modified date using MDTM command
+    try:
+        mdtm_response = ftp.sendcmd("MDTM " + file)
+        last_modified = utils.parse_mdtm(mdtm_response)
+    except Exception:
+        last_modified = datetime.now().isoformat()
+
+    return {'file': file, 'size': size, 'last_modified': last_modified}
+
+
+def _stat_release_files(ftp_server, ftp_directory, files, workers):
+    """SIZE/MDTM over a small pool of anonymous sessions, one per thread, yielded in listing order."""
+    local = threading.local()
+    sessions = []
+    lock = threading.Lock()
+
+    def stat(file):
+        ftp = getattr(local, 'ftp', None)
+        if ftp is None:
+            ftp = local.ftp = _ftp_session(ftp_server, ftp_directory)
+            ftp.voidcmd('TYPE I')  # servers may refuse SIZE in ASCII mode
+            with lock:
+                sessions.append(ftp)
+        return _stat_file_info(ftp, file)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(stat, files)
+    finally:
+        for ftp in sessions:
+            _quit(ftp)
+
+
+def iter_release_files(ftp_server, ftp_directory, workers=FTP_WORKERS):
+    """
+    Yield {'file', 'size', 'last_modified'} for every VCF in ftp_directory as the listing arrives.
+    A single MLSD (default facts include type, size and modify) covers every entry; servers that reject MLSD are listed
+    with NLST and the per-file SIZE/MDTM round-trips are spread over `workers` parallel sessions.
+    """
+    ftp = _ftp_session(ftp_server, ftp_directory)
+    try:
         try:
-            mdtm_response = ftp.sendcmd("MDTM " + file)
-            last_modified = utils.parse_mdtm(mdtm_response)
-        except Exception:
-            last_modified = datetime.now().isoformat()
+            for file, facts in _iter_mlsd(ftp):
+                if facts.get('type', 'file') == 'file' and _is_release_file(file):
+                    yield _mlsd_file_info(file, facts)
+            return
+        except ftplib.error_perm:
+            # 500/502, MLSD not implemented
+            files = [file for file in ftp.nlst() if _is_release_file(file)]
+    finally:
+        _quit(ftp)
+
+    yield from _stat_release_files(ftp_server, ftp_directory, files, workers)
+
+
+def _files_size(file_paths):
+    return sum(os.path.getsize(file_path) for file_path in file_paths if os.path.exists(file_path))
+
+
+def _lines(file_paths):
+    """Lines of NDJSON files (the shards of an output) in any compression, one file after another."""
+    for file_path in file_paths:
+        with compression.open_read(file_path) as file:
+            yield from file
 
-        file_info.append({'file': file, 'size': size, 'last_modified': last_modified})
 
-    ftp.quit()
+def group_id():
+    return IDMakerInstance.mint(SAMPLE_INFO_SYSTEM, RELEASE_HEADER_URL, "Group")
 
-    df_release = pd.DataFrame(file_info)
-    df_release = df_release.dropna(subset=["file"])
 
-    doc_refs = [create_document_reference(row) for _, row in df_release.iterrows()]
+# -------------------------
+# stages (registered in fhir_etl.pipeline)
+# -------------------------
+# DocumentReference and Group are merged into META by create_or_extend. Group members are the samples of
+# the VCF header that are in Specimen.ndjson, so the group stage runs after the Specimen output is written
+# (or reads the one in META with --only Group).
+
+def build_document_references(context):
+    ftp_server = RELEASE_FTP_SERVER
+    ftp_directory = RELEASE_FTP_DIRECTORY
+    listing_key = f"ftp://{ftp_server}{ftp_directory}"
+
+    # the listing is cached like any other source so --offline runs can rebuild DocumentReferences,
+    # online runs build each DocumentReference as soon as its listing entry arrives
+    release_files = cache.get_cache().remember_records(listing_key, lambda: iter_release_files(ftp_server, ftp_directory))
+    with report.stage("convert DocumentReference") as stage:
+        doc_refs = [create_document_reference(file_row) for file_row in report.timed("fetch release listing", release_files, unit='file')]
+        stage.rows_in = stage.rows_out = len(doc_refs)
+
+    # skip the merge when the listing is unchanged; the Group they point to is named after the header url, whatever
+    # its content (fetched by the group stage, which may run at the same time)
+    manifest = context.manifest
+    inputs = manifest.inputs(listing_key)
+    if manifest.is_current('DocumentReference', inputs):
+        return
+
+    for doc_ref in doc_refs:
+        doc_ref["subject"] = {"reference": f"Group/{group_id()}"}
+
+    fhir_document_references = list({_doc_ref["id"]: _doc_ref for _doc_ref in doc_refs if _doc_ref}.values())
+    validation_errors = []
+    with report.stage("clean DocumentReference", rows_in=len(fhir_document_references)) as stage:
+        cleaned_fhir_document_references = utils.clean_resources(fhir_document_references, errors=validation_errors)
+        stage.rows_out = len(cleaned_fhir_document_references)
+    size_before = _files_size(shards.find_outputs(context.meta_path, 'DocumentReference'))
+    with report.stage("write DocumentReference.ndjson", rows_in=len(cleaned_fhir_document_references)) as stage:
+        output_paths = shards.create_or_extend(new_items=cleaned_fhir_document_references, folder_path=context.meta_path,
+                                               resource_type='DocumentReference', update_existing=False)
+        stage.bytes_written = _files_size(output_paths) - size_before
+    manifest.record('DocumentReference', inputs)
+
+    for failure in validation_errors:
+        print(f"Validation failed for {failure.resource_type}/{failure.resource_id}: {failure.error}")
+
+
+def build_group(context):
+    specimen_files = shards.find_outputs(context.meta_path, 'Specimen')
+    assert specimen_files, "don't have Specimen.ndjson to derive file subject from..."
+
     # -------------------------
     # extract Sample IDs from VCF Header
     # -------------------------
-    header_url = "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/release/20130502/supporting/vcf_with_sample_level_annotation/header"
-    response = requests.get(header_url)
-    response.raise_for_status()
-    header_text = response.text
+    header_url = RELEASE_HEADER_URL
+    with report.stage("fetch VCF header") as stage:
+        header_text = cache.fetch_text(header_url)
+        stage.bytes_downloaded = cache.get_cache().downloaded_bytes(header_url)
 
     vcf_header_line = None
     for line in header_text.splitlines():
@@ -177,6 +316,13 @@ def transform_1k_files():
     if len(columns) <= 9:
         raise Exception("Expected sample IDs after the first 9 columns, but found none.")
 
+    # skip the Group when the header and the Specimen output it was derived from are unchanged
+    manifest = context.manifest
+    specimen_output = manifest.outputs.get('Specimen', {}).get('sha256')
+    inputs = manifest.inputs(header_url, extra=[specimen_output, context.group_max_members])
+    if manifest.is_current('Group', inputs):
+        return
+
     sample_ids_from_header = columns[9:]
     print(f"Extracted {len(sample_ids_from_header)} sample IDs from header:")
     print(sample_ids_from_header)
@@ -187,11 +333,13 @@ def transform_1k_files():
     specimen_system = "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/"
 
     specimen_sample_ids = set()
-    with open(specimen_file, "r") as f:
-        for line in f:
+    with report.stage("read Specimen.ndjson") as stage:
+        stage.rows_in = 0
+        for line in _lines(specimen_files):
             line = line.strip()
             if not line:
                 continue
+            stage.rows_in += 1
             try:
                 specimen = json.loads(line)
             except json.JSONDecodeError:
@@ -203,6 +351,7 @@ def transform_1k_files():
                         value = identifier.get("value")
                         if value:
                             specimen_sample_ids.add(value)
+        stage.rows_out = len(specimen_sample_ids)
 
     print(f"Found {len(specimen_sample_ids)} sample IDs in Specimen.ndjson.")
 
@@ -215,44 +364,30 @@ def transform_1k_files():
     print(f"Sample IDs found in Specimen.ndjson: {len(found_ids)}")
     print(f"Sample IDs missing in Specimen.ndjson: {len(missing_ids)}")
 
-    specimen_ids = ["Specimen/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{utils.THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": str(_id)}), "Specimen") for _id in found_ids]
-
-    group_identifier = Identifier(**{"system": "".join([f"https://{utils.THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": header_url})
-    group_id = IDMakerInstance.mint_id(group_identifier, "Group")
-
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
-        "valueReference": {
-            "reference": f"ResearchStudy/{IDMakerInstance.mint_id(Identifier(**{'system': ''.join([f'https://{utils.THOUSAND_GENOMES}', 'technical/working/20130606_sample_info/']), 'value': '1KG'}), 'ResearchStudy')}"
+    # the Group is serialized straight from the member array, split into sub-Groups with --group-max-members
+    with report.stage("build Group", rows_in=len(found_ids)) as stage:
+        specimen_keys = groups.member_keys(IDMakerInstance.mint_ids(sorted(found_ids), "Specimen", SAMPLE_INFO_SYSTEM))
+        group_resource = {
+            "resourceType": "Group",
+            "id": group_id(),
+            "extension": [STUDY_EXTENSION],
+            "identifier": [{"system": SAMPLE_INFO_SYSTEM, "value": header_url}],
+            "type": "specimen",
+            "membership": "definitional",
         }
-    }))
-
-    group_resource = Group(**{
-        "id": group_id,
-        "identifier": [group_identifier],
-        "membership": "definitional",
-        "type": "specimen",
-        "member": [{"entity": {"reference": sid}} for sid in specimen_ids],
-        "extension": extensions
-        })
-
-    for doc_ref in doc_refs:
-        doc_ref.subject = Reference(**{"reference": f"Group/{group_resource.id}"})
-
-    # -------------------------
-    # output to ndjson files
-    # -------------------------
-    folder_path = str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'oneKgenomes' / 'META' ))
-
-    document_references = {_doc_ref.id: _doc_ref for _doc_ref in doc_refs if _doc_ref}.values()
-    fhir_document_references = [orjson.loads(doc_ref.json()) for doc_ref in document_references]
-    cleaned_fhir_document_references = utils.clean_resources(fhir_document_references)
-    utils.create_or_extend(new_items=cleaned_fhir_document_references, folder_path=folder_path,
-                           resource_type='DocumentReference', update_existing=False)
-
-    fhir_group = [orjson.loads(group.json()) for group in [group_resource]]
-    cleaned_fhir_groups = utils.clean_resources(fhir_group)
-    utils.create_or_extend(new_items=cleaned_fhir_groups, folder_path=folder_path,
-                           resource_type='Group', update_existing=False)
-
+        group_lines = list(groups.group_lines(
+            group_resource, "Specimen", specimen_keys, max_members=context.group_max_members,
+            part_id=lambda number: IDMakerInstance.mint(SAMPLE_INFO_SYSTEM, f"{header_url}-part-{number}", "Group")))
+        stage.rows_out = len(group_lines)
+
+    # written in full: a changed split must not leave a stale parent or stale parts behind
+    with report.stage("write Group.ndjson", rows_in=len(group_lines)) as stage:
+        count, output_paths = shards.write(manifest.serialized('Group', group_lines, inputs), context.meta_path, 'Group')
+        stage.rows_out = count
+        stage.bytes_written = _files_size(output_paths)
+
+
+def transform_1k_files(incremental=False, group_max_members=None):
+    """The 1000 Genomes DocumentReference and Group stages, from the Specimen.ndjson in META."""
+    from fhir_etl import pipeline
+    pipeline.run(['1kgenomes'], only=('docref', 'group'), incremental=incremental, group_max_members=group_max_members)
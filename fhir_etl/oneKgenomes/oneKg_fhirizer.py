@@ -1,141 +1,122 @@
 import os
-import json
 import pandas as pd
+from fhir_etl import cache
+from fhir_etl import utils
+from fhir_etl import shards
+from fhir_etl import builder
+from fhir_etl import report
+from fhir_etl import sources
 
 from fhir.resources.identifier import Identifier
-from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.extension import Extension
-from fhir.resources.patient import Patient
-from fhir.resources.specimen import Specimen, SpecimenCollection
 from fhir.resources.researchstudy import ResearchStudy
-from fhir.resources.researchsubject import ResearchSubject
 from pathlib import Path
 import importlib.resources
 
-import uuid
-from uuid import uuid3, uuid5, NAMESPACE_DNS
 
 
 THOUSAND_GENOMES = 'https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/'
+SAMPLE_INFO_URL = 'https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/20130606_sample_info.txt'
+
+SAMPLE_INFO_SYSTEM = "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"])
+IDMakerInstance = utils.get_id_helper('1KG', THOUSAND_GENOMES)
+
+# the sample_info columns prepare_sample_columns reads
+SAMPLE_INFO_SCHEMA = sources.SourceSchema('1000 Genomes sample info', {
+    'Sample': 'str',
+    'Gender': 'category',
+    'Population': 'category',
+    'Population Description': 'category',
+    'DNA Source from Coriell': 'category',
+    'Main project LC platform': 'category',
+})
+
+def meta_path():
+    return str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'oneKgenomes' / 'META' ))
+
+def output_to_ndjson(resources, filename, folder=None):
+    """Stream resources (or serialized lines) to <folder, default META>/<filename>.ndjson (or its --shards); a single ResearchStudy model may be passed as is."""
+    if isinstance(resources, ResearchStudy):
+        resources = [resources]
+    with report.stage(f"write {filename}.ndjson") as stage:
+        count, output_paths = shards.write(resources, folder or meta_path(), filename)
+        stage.rows_out = count
+        stage.bytes_written = sum(os.path.getsize(output_path) for output_path in output_paths)
+    print(f"Conversion complete, {count} resources, see output dir for {', '.join(output_paths)}")
+    return count
+
+def mint_ids(values, resource_type):
+    return IDMakerInstance.mint_ids(values, resource_type, SAMPLE_INFO_SYSTEM)
+
+def study_reference():
+    return "ResearchStudy/" + IDMakerInstance.mint(SAMPLE_INFO_SYSTEM, "1KG", "ResearchStudy")
+
+def prepare_sample_columns(sample_df):
+    """Compute every per-row field of the Patient, ResearchSubject and Specimen converters column by column.
+    Rows of the result are consumed as plain tuples via itertuples()."""
+    dna_source = sample_df['DNA Source from Coriell']
+    patient_id = mint_ids(sample_df['Sample'], "Patient")
+
+    return pd.DataFrame({
+        'sample': sample_df['Sample'].astype(object),
+        'patient_id': patient_id,
+        'researchsubject_id': mint_ids(sample_df['Sample'], "ResearchSubject"),
+        'specimen_id': mint_ids(sample_df['Sample'], "Specimen"),
+        'subject_reference': utils.na_to_none(("Patient/" + patient_id).where(sample_df['Sample'].notna())),
+        'gender': utils.na_to_none(sample_df['Gender']),
+        'race': utils.na_to_none(sample_df['Population Description']),
+        'population': utils.na_to_none(sample_df['Population']),
+        'specimen_type_code': utils.fill_na(dna_source, "Whole blood"),
+        'specimen_type_display': (dna_source == 'LCL').map({True: "Lymphoblastoid Cell Line", False: "Whole blood"}).astype(object),
+        'collection_method': utils.fill_na(sample_df['Main project LC platform'], 'Not specified'),
+    })
 
-class IDHelper: # pilfered from https://github.com/FHIR-Aggregator/CDA2FHIR/blob/7660b8ee9a7b815855a826bfb78aee62eb39cf27/cda2fhir/transformer.py#L34
-    def __init__(self):
-        self.project_id = '1KG'
-        self.namespace = uuid3(NAMESPACE_DNS, THOUSAND_GENOMES)
-
-    @staticmethod
-    def is_valid_uuid(value: str) -> bool:
-        if value is None:
-            return False
-        try:
-            _obj = uuid.UUID(value, version=5)
-        except ValueError:
-            return False
-        return True
-
-    def mint_id(self, identifier: Identifier | str, resource_type: str = None) -> str: 
-        """create a UUID from an identifier. - mint id via Walsh's convention
-        https://github.com/ACED-IDP/g3t_etl/blob/d095895b0cf594c2fd32b400e6f7b4f9384853e2/g3t_etl/__init__.py#L61"""
-        # dispatch on type
-        if isinstance(identifier, Identifier):
-            assert resource_type, "resource_type is required for Identifier"
-            identifier = f"{resource_type}/{identifier.system}|{identifier.value}"
-        return self._mint_id(identifier)
-    
-    def _mint_id(self, identifier_string: str) -> str:
-        """create a UUID from an identifier, insert project_id."""
-        return str(uuid5(self.namespace, f"{self.project_id}/{identifier_string}"))
-
-def output_to_ndjson(json_str_list, filename):
-    meta_path = str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl' /'onekgenomes' / 'META' ))
-    output_path = os.path.join(meta_path, f"{filename}.ndjson")
-
-    if filename == 'ResearchStudy':
-        with open(output_path, 'w') as f:
-            json_string = json.dumps(json_str_list)
-            f.write(json_string + "\n")
-    else:
-        with open(output_path, 'w') as f:
-            for entry in json_str_list:
-                json_string = json.dumps(entry)
-                f.write(json_string + "\n")
-    print(f"Conversion complete, see output dir for {output_path}")
-
-def convert_to_fhir_subject(input_row):
-    IDMakerInstance = IDHelper()
-    ncpi_participant = Patient(**{
-        "resourceType": "Patient",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": str(input_row['Sample'])}), "Patient"),
-        "identifier": [{"use":"official", "system": "https://gtexportal.org/home/downloads/adult-gtex/metadata", "value": input_row['Sample']}],
-        "meta":{
-            "profile": [
-                "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-participant.html"
-            ]
-        }}
-    )
-
+# -------------------------
+# resource templates: constant parts are built once and shared by every emitted resource (see fhir_etl.builder)
+# -------------------------
+STUDY_REFERENCE = study_reference()
+STUDY_EXTENSION = {"url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", "valueReference": {"reference": STUDY_REFERENCE}}
+PARTICIPANT_META = {"profile": ["https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-participant.html"]}
+SAMPLE_META = {"profile": ["https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-sample.html"]}
+IDENTIFIER_SYSTEM = "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/"
+PATIENT_IDENTIFIER_SYSTEM = "https://gtexportal.org/home/downloads/adult-gtex/metadata"
+SEX_URL = "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-sex.html"
+RACE_URL = "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-race.html"
+POPULATION_URL = "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-research-population.html"
+
+def convert_to_fhir_subject(row):
+    """row: one tuple of prepare_sample_columns()"""
     extensions = []
-    birth_sex = input_row['Gender']
-    if pd.notna(birth_sex):
-        extensions.append(Extension(**{
-            "url": "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-sex.html", "valueString": birth_sex})
-        )
-
-    race = input_row['Population Description']
-    if pd.notna(race):
-        extensions.append(Extension(**{
-            "url": "https://hl7.org/fhir/us/core/STU3.1.1/StructureDefinition-us-core-race.html", "valueString": race})
-        )
-
-    population = input_row['Population']
-    if pd.notna(population):
-        extensions.append(Extension(**{
-            "url": "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-research-population.html", "valueString": population})
-        )
-
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(
-                **{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]),
-                   "value": "1KG"}), "ResearchStudy")
-        }
-    }))
-
-    if extensions:
-        ncpi_participant.extension = extensions
-
-    return json.dumps(ncpi_participant.dict(), indent=4)
+    if row.gender is not None:
+        extensions.append({"url": SEX_URL, "valueString": row.gender})
+    if row.race is not None:
+        extensions.append({"url": RACE_URL, "valueString": row.race})
+    if row.population is not None:
+        extensions.append({"url": POPULATION_URL, "valueString": row.population})
+    extensions.append(STUDY_EXTENSION)
+
+    return builder.checked({
+        "resourceType": "Patient",
+        "id": row.patient_id,
+        "meta": PARTICIPANT_META,
+        "extension": extensions,
+        "identifier": [{"use": "official", "system": PATIENT_IDENTIFIER_SYSTEM, "value": row.sample}],
+    })
 
-def convert_to_fhir_researchsubject(input_row):
-    IDMakerInstance = IDHelper()
-    ncpi_studyparticipant = ResearchSubject(**{
+def convert_to_fhir_researchsubject(row):
+    """row: one tuple of prepare_sample_columns()"""
+    return builder.checked({
         "resourceType": "ResearchSubject",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": str(input_row['Sample'])}), "ResearchSubject"),
-        "identifier": [{"use":"official", "system": "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/", "value": input_row['Sample']}],
-        "subject": {
-            "reference": "Patient/" + str(IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": str(input_row['Sample'])}), "Patient"))
-        },
+        "id": row.researchsubject_id,
+        "extension": [STUDY_EXTENSION],
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.sample}],
         "status": "on-study",
-        "study": {
-            "reference": "ResearchStudy/" + str(IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": "1KG"}), "ResearchStudy"))
-        }
+        "study": {"reference": STUDY_REFERENCE},
+        "subject": {"reference": "Patient/" + row.patient_id},
     })
 
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": "1KG"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_studyparticipant.extension = extensions
-
-    return json.dumps(ncpi_studyparticipant.dict(), indent = 4)
-
-def convert_to_fhir_specimen(input_row):
-    IDMakerInstance = IDHelper()
+def convert_to_fhir_specimen(row):
+    """row: one tuple of prepare_sample_columns()"""
     sequencing_center_dict = {'454MSC': '454 Rocher', 'ABI': 'ABI Life Sciences', 'BCM': 'Baylor College of Medicine', 'BGI': 'Beijing Genome Institute', 'BI': 'The Broad Institute', 'ILLUMINA': 'Illumina',
     'MPIMG': 'Max Planck Institute for Molecular Genetics', 'SC': 'The Sanger Instute', 'WUGSC': 'Washington University Genome Sequencing Center', '': 'Not provided'}
 
@@ -143,117 +124,82 @@ def convert_to_fhir_specimen(input_row):
     # also am not sure GTeX's representation of bodySites would corrspond neatly to HL7's codes either). 
     # Want to use Concept style of presentation, but latest version of fhir.resources requires bodySite be of a CodeableReference type
     # see https://github.com/nazrulworld/fhir.resources/blob/main/fhir/resources/specimen.py#L296
-    # solution: force a concept kind of presentation for a CodeableReference using the above and below.
-
-    ncpi_sample = Specimen(**{
+    # had to remove bodySite for compliance with the R4B validator in https://github.com/FHIR-Aggregator/submission/blob/main/fhir_aggregator_submission/prep.py#L115. Either fix how bodySite is coded to satisfy R5 *and* R4B or suggest a change to prep.py at some later point.
+    #"bodySite": {"concept": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v2-0163.html", "code": "Blood", "display": "Whole blood"}]}}
+    # possibly fix the below element later
+    #"container": {
+    #    "device": {"reference": "Device/not-provided-by-1KG"},
+    #    "location": {"reference": sequencing_center_dict[row.sequencing_center]},
+    #    "specimenQuantity": {"value": row.total_lc_sequence, "unit": "Low coverage whole genome sequencing count"}
+    #}
+    specimen = {
         "resourceType": "Specimen",
-        "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": str(input_row['Sample'])}), "Specimen"),
-        "identifier": [{"use": "official", "system": "https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/", "value": input_row['Sample']}],
-        "meta":{
-            "profile": [
-                "https://nih-ncpi.github.io/ncpi-fhir-ig-2/StructureDefinition-ncpi-sample.html"
-            ]
-        },
-        "type": { # why can't I just do method and bodySite like type? why god? I'm going to find a way. Note that it's a codeableConcept type like method: 
-            # https://github.com/nazrulworld/fhir.resources/blob/main/fhir/resources/specimen.py#L241
-            "coding": [
-                    {
-                    "system": "https://terminology.hl7.org/CodeSystem-v3-SpecimenType.html",
-                    "code": input_row['DNA Source from Coriell'] if pd.notna(input_row['DNA Source from Coriell']) else "Whole blood",
-                    "display": "Lymphoblastoid Cell Line" if input_row['DNA Source from Coriell'] == 'LCL' else "Whole blood",
-                    }
-                ]
-            },
-        "subject": {
-            "reference": f"Patient/{IDMakerInstance.mint_id(Identifier(**{'system': ''.join([f'https://{THOUSAND_GENOMES}', 'technical/working/20130606_sample_info/']), 'value': str(input_row['Sample'])}), 'Patient')}"
-        } if pd.notna(input_row['Sample']) else "Not specified",
-        "collection": SpecimenCollection(**{
-            "method": CodeableConcept(**{
-                "coding": [
-                    {
-                    "system": "https://terminology.hl7.org/CodeSystem-v2-0488.html",
-                    "code": input_row['Main project LC platform'] if pd.notna(input_row['Main project LC platform']) else 'Not specified',
-                    "display": input_row['Main project LC platform'] if pd.notna(input_row['Main project LC platform']) else 'Not specified'
-                    }
-                ]}) # had to remove bodySite for compliance with the R4B validator in https://github.com/FHIR-Aggregator/submission/blob/main/fhir_aggregator_submission/prep.py#L115. Either fix how bodySite is coded to satisfy R5 *and* R4B or suggest a change to prep.py at some later point.
-            #"bodySite": CodeableReference(
-            #    concept = CodeableConcept(**{
-            #    "coding": [
-            #        {
-            #            "system": "https://terminology.hl7.org/CodeSystem-v2-0163.html",
-            #            "code": "Blood",
-            #            "display": "Whole blood"
-            #        }
-            #    ]})
-            })
-        # possibly fix the below element later
-        #"container": SpecimenContainer(**{
-        #    "device": ReferenceType(**{
-        #        "reference": "Device/not-provided-by-1KG"
-        #        }),
-        #    "location": ReferenceType(**{
-        #        "reference": sequencing_center_dict[input_row["Main project LC Centers"]]
-        #        }),
-        #    "specimenQuantity": QuantityType(**{
-        #        "value": input_row['Total LC Sequence'],
-        #        "unit": "Low coverage whole genome sequencing count"
-        #        })
-        #})
-    })
-
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study",
-        "valueReference": {
-            "reference": f"ResearchStudy/{IDMakerInstance.mint_id(Identifier(**{'system': ''.join([f'https://{THOUSAND_GENOMES}', 'technical/working/20130606_sample_info/']), 'value': '1KG'}), 'ResearchStudy')}"
-        }
-    }))
-
-    ncpi_sample.extension = extensions
-    return json.dumps(ncpi_sample.dict(), indent = 4)
-
-def transform_1k():
-    sample_df = pd.read_csv('https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20130606_sample_info/20130606_sample_info.txt', sep='\t') 
+        "id": row.specimen_id,
+        "meta": SAMPLE_META,
+        "extension": [STUDY_EXTENSION],
+        "identifier": [{"use": "official", "system": IDENTIFIER_SYSTEM, "value": row.sample}],
+        "type": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v3-SpecimenType.html", "code": row.specimen_type_code, "display": row.specimen_type_display}]},
+    }
+    if row.subject_reference is not None:
+        specimen["subject"] = {"reference": row.subject_reference}
+    specimen["collection"] = {"method": {"coding": [{"system": "https://terminology.hl7.org/CodeSystem-v2-0488.html", "code": row.collection_method, "display": row.collection_method}]}}
+
+    return builder.checked(specimen)
+
+# -------------------------
+# stages (registered in fhir_etl.pipeline)
+# -------------------------
+# each resource type is converted lazily from the prepared columns (in the shared process pool with --workers)
+# and streamed straight into its NDJSON file; with --incremental unchanged outputs are skipped and only
+# changed samples are converted
+
+def fetch_sample_info(context):
+    with report.stage("fetch 1kgenomes sample_info") as stage:
+        sample_df = sources.read_table(cache.fetch(SAMPLE_INFO_URL), SAMPLE_INFO_SCHEMA)
+        stage.rows_out = len(sample_df)
+        stage.bytes_downloaded = cache.get_cache().downloaded_bytes(SAMPLE_INFO_URL)
     # sample_df.to_csv('20130606_sample_info.csv', index=False)
+    return sample_df
 
-    IDMakerInstance = IDHelper()
+def write_study(context):
+    manifest = context.manifest
+    study_inputs = manifest.inputs()
+    if manifest.is_current('ResearchStudy', study_inputs):
+        return
     ncpi_researchstudy = ResearchStudy(
         **{
-            "id": IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": "1KG"}), "ResearchStudy"),
-            "identifier": [Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": "1KG"})],
+            "id": IDMakerInstance.mint(SAMPLE_INFO_SYSTEM, "1KG", "ResearchStudy"),
+            "identifier": [Identifier(**{"system": SAMPLE_INFO_SYSTEM, "value": "1KG"})],
             "title": "1000 Genomes Project Sample Metadata",
             "status": "active"
         }
     )
-    extensions = []
-    extensions.append(Extension(**{
-        "url": "http://fhir-aggregator.org/fhir/StructureDefinition/part-of-study", 
-        "valueReference": {
-            "reference": "ResearchStudy/" + IDMakerInstance.mint_id(Identifier(**{"system": "".join([f"https://{THOUSAND_GENOMES}", "technical/working/20130606_sample_info/"]), "value": "1KG"}), "ResearchStudy")
-            }
-        })
-    )
-    ncpi_researchstudy.extension = extensions
-
+    ncpi_researchstudy.extension = [Extension(**STUDY_EXTENSION)]
+    print("Converting researchstudy to ResearchStudy.ndjson")
+    output_to_ndjson(manifest.resources('ResearchStudy', [ncpi_researchstudy], study_inputs), 'ResearchStudy', context.meta_path)
+
+def convert_samples(context):
+    sample_df = context.results['fetch']
+    manifest = context.manifest
+    sample_inputs = manifest.inputs(SAMPLE_INFO_URL)
     print(sample_df.head(10))
     print("Converting sample df to fhirized json")
-    subject_json_strings = []
-    researchsubject_json_strings =[]
-    sample_json_strings = []
-    for index, row in sample_df.iterrows():
-        subject_json_strings.append(convert_to_fhir_subject(row))
-        researchsubject_json_strings.append(convert_to_fhir_researchsubject(row))
-        sample_json_strings.append(convert_to_fhir_specimen(row))
-
-    subject_json_dict_list = [json.loads(json_str) for json_str in subject_json_strings]
-    researchsubject_json_dict_list = [json.loads(json_str) for json_str in researchsubject_json_strings]
-    sample_json_dict_list = [json.loads(json_str) for json_str in sample_json_strings]
-
-    print("Converting subject_json_dict to Patient.ndjson")
-    output_to_ndjson(subject_json_dict_list, 'Patient')
-    print("Converting researchsubject_json_dict to ResearchSubject.ndjson")
-    output_to_ndjson(researchsubject_json_dict_list, 'ResearchSubject')
-    print("Converting sample_json_dict to Specimen.ndjson")
-    output_to_ndjson(sample_json_dict_list, 'Specimen')
-    print("Converting researchstudy_json_dict to ResearchStudy.ndjson")
-    output_to_ndjson(ncpi_researchstudy.dict(), 'ResearchStudy')
+    rebuild = {resource_type: not manifest.is_current(resource_type, sample_inputs) for resource_type in ('Patient', 'ResearchSubject', 'Specimen')}
+    if not any(rebuild.values()):
+        return
+    sample_columns = sources.PreparedChunks(sample_df, prepare_sample_columns, "prepare sample columns")
+
+    if rebuild['Patient']:
+        print("Converting samples to Patient.ndjson")
+        output_to_ndjson(report.timed("convert Patient", manifest.rows('Patient', sample_columns, convert_to_fhir_subject, inputs=sample_inputs, id_column='patient_id', executor=context.executor, row_name='SampleRow'), rows_in=len(sample_columns)), 'Patient', context.meta_path)
+    if rebuild['ResearchSubject']:
+        print("Converting samples to ResearchSubject.ndjson")
+        output_to_ndjson(report.timed("convert ResearchSubject", manifest.rows('ResearchSubject', sample_columns, convert_to_fhir_researchsubject, inputs=sample_inputs, id_column='researchsubject_id', executor=context.executor, row_name='SampleRow'), rows_in=len(sample_columns)), 'ResearchSubject', context.meta_path)
+    if rebuild['Specimen']:
+        print("Converting samples to Specimen.ndjson")
+        output_to_ndjson(report.timed("convert Specimen", manifest.rows('Specimen', sample_columns, convert_to_fhir_specimen, inputs=sample_inputs, id_column='specimen_id', executor=context.executor, row_name='SampleRow'), rows_in=len(sample_columns)), 'Specimen', context.meta_path)
+
+def transform_1k(workers=1, incremental=False):
+    """The 1000 Genomes sample stages (ResearchStudy, Patient, ResearchSubject, Specimen)."""
+    from fhir_etl import pipeline
+    pipeline.run(['1kgenomes'], only=('study', 'convert'), workers=workers, incremental=incremental)
@@ -0,0 +1,74 @@
+import os
+import importlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from fhir_etl import builder
+
+# -------------------------
+# process-pool conversion of prepared row chunks
+# -------------------------
+# The source DataFrame (already reduced to converter fields by prepare_*_columns) is split into chunks
+# that are converted in worker processes. Results are yielded chunk by chunk in source order, so the
+# written NDJSON is byte-identical to a serial run.
+
+DEFAULT_CHUNK_SIZE = 2000
+PRELOAD_RESOURCE_TYPES = ('Patient', 'ResearchSubject', 'Specimen', 'DocumentReference', 'Group', 'ResearchStudy')
+
+
+def _init_worker(validation_config):
+    """Runs once per worker: import the fhir.resources models up front and mirror the parent's validation policy."""
+    for resource_type in PRELOAD_RESOURCE_TYPES:
+        importlib.import_module(f"fhir.resources.{resource_type.lower()}")
+    builder.configure(**validation_config)
+
+
+@contextmanager
+def pool(workers: int):
+    """Process pool for convert_rows, or None when running serially (workers <= 1)."""
+    if not workers or workers <= 1:
+        yield None
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(builder.get_config(),)) as executor:
+        yield executor
+
+
+def _convert_rows(frame, converter, args, row_name, positions):
+    for position, row in zip(positions, frame.itertuples(index=False, name=row_name)):
+        token = builder.set_position(position)
+        try:
+            resource = converter(row, *args)
+        finally:
+            builder.reset_position(token)
+        yield resource
+
+
+def _convert_chunk(converter, chunk, args, row_name, positions):
+    return list(_convert_rows(chunk, converter, args, row_name, positions))
+
+
+def convert_rows(frame, converter, *args, executor=None, chunk_size=None, max_in_flight=None, row_name='Row',
+                 positions=None):
+    """
+    Yield converter(row, *args) for every row of frame, in source order.
+    positions are the source row positions of the rows of frame (default 0, 1, ...), which pick the resources
+    builder.checked validates. With an executor, chunks are converted in parallel with at most max_in_flight
+    chunks (default two per CPU) outstanding, so memory stays bounded when the consumer (the NDJSON writer)
+    is slower than the pool.
+    """
+    positions = range(len(frame)) if positions is None else positions
+    if executor is None:
+        yield from _convert_rows(frame, converter, args, row_name, positions)
+        return
+
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    max_in_flight = max_in_flight or 2 * (os.cpu_count() or 1)
+    in_flight = deque()
+    for start in range(0, len(frame), chunk_size):
+        in_flight.append(executor.submit(_convert_chunk, converter, frame.iloc[start:start + chunk_size], args, row_name,
+                                         positions[start:start + chunk_size]))
+        if len(in_flight) >= max_in_flight:
+            yield from in_flight.popleft().result()
+    while in_flight:
+        yield from in_flight.popleft().result()
@@ -0,0 +1,178 @@
+import importlib
+import importlib.resources
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# -------------------------
+# fhirizer registry and stage runner
+# -------------------------
+# A fhirizer is a project (its META directory) and its stages. A stage names a "module:function" entry
+# point, the stages whose results it needs (context.results[name]), the stages it has to run after because
+# it reads their NDJSON output, and the resource types it writes. Entry points are only imported when
+# their stage runs, so this module stays light enough for the CLI to import at start-up.
+# run() executes the stages of one or more fhirizers on a thread pool as soon as their dependencies are
+# done: fetches overlap, and the conversions of independent outputs share one --workers process pool.
+# Conversion streams into the NDJSON writer, so every output stage also writes its files; the incremental
+# manifest of a fhirizer is saved once all of its stages are done.
+# With `only` (stage names or resource types) just those stages run, plus the stages whose results they
+# need; outputs they read are taken from META as written by an earlier run, and fetches from the source
+# cache. Other packages can add fhirizers with an entry point in the `fhir_etl.fhirizers` group that
+# points at a Fhirizer.
+
+ENTRY_POINT_GROUP = 'fhir_etl.fhirizers'
+ALL = 'all'
+
+Stage = namedtuple('Stage', ['name', 'entry_point', 'needs', 'after', 'outputs'], defaults=((), (), ()))
+Fhirizer = namedtuple('Fhirizer', ['name', 'meta_path', 'stages'])
+
+FHIRIZERS = {}
+
+
+def register(fhirizer: Fhirizer) -> Fhirizer:
+    """Add fhirizer to the registry, replacing one of the same name."""
+    stage_names = {stage.name for stage in fhirizer.stages}
+    for stage in fhirizer.stages:
+        unknown = (set(stage.needs) | set(stage.after)) - stage_names
+        assert not unknown, f"{fhirizer.name} stage {stage.name} depends on unknown stages {sorted(unknown)}"
+    FHIRIZERS[fhirizer.name] = fhirizer
+    return fhirizer
+
+
+ONEK = 'fhir_etl.oneKgenomes.oneKg_fhirizer'
+ONEK_FILES = 'fhir_etl.oneKgenomes.document_references'
+GTEX = 'fhir_etl.GTEx.gtex_fhirizer'
+
+register(Fhirizer('1kgenomes', ('oneKgenomes', 'META'), (
+    Stage('fetch', f'{ONEK}:fetch_sample_info'),
+    Stage('study', f'{ONEK}:write_study', outputs=('ResearchStudy',)),
+    Stage('convert', f'{ONEK}:convert_samples', needs=('fetch',), outputs=('Patient', 'ResearchSubject', 'Specimen')),
+    Stage('group', f'{ONEK_FILES}:build_group', after=('convert',), outputs=('Group',)),
+    Stage('docref', f'{ONEK_FILES}:build_document_references', outputs=('DocumentReference',)),
+)))
+
+register(Fhirizer('gtex', ('GTEx', 'META'), (
+    Stage('fetch_subjects', f'{GTEX}:fetch_subjects'),
+    Stage('fetch_samples', f'{GTEX}:fetch_samples'),
+    Stage('fetch_files', f'{GTEX}:fetch_files'),
+    Stage('study', f'{GTEX}:write_study', outputs=('ResearchStudy',)),
+    Stage('convert_subjects', f'{GTEX}:convert_subjects', needs=('fetch_subjects',), outputs=('Patient', 'ResearchSubject')),
+    Stage('convert_samples', f'{GTEX}:convert_samples', needs=('fetch_samples',), outputs=('Specimen',)),
+    Stage('docref', f'{GTEX}:convert_files', needs=('fetch_files',), outputs=('DocumentReference',)),
+    Stage('group', f'{GTEX}:build_group', needs=('fetch_samples',), outputs=('Group',)),
+)))
+
+
+def fhirizers() -> dict:
+    """Registered fhirizers, built in and from installed packages, by name."""
+    import importlib.metadata
+    for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name not in FHIRIZERS:
+            register(entry_point.load())
+    return FHIRIZERS
+
+
+def load_entry_point(entry_point):
+    """Import the function named by a "module:function" entry point."""
+    module_name, function_name = entry_point.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def meta_path(fhirizer: Fhirizer) -> str:
+    return str(Path(importlib.resources.files('fhir_etl').parent / 'fhir_etl').joinpath(*fhirizer.meta_path))
+
+
+def select(fhirizer: Fhirizer, only=()) -> list:
+    """The stages to run: every stage, or those named (by stage or output type) in only and the stages they need."""
+    if not only:
+        return list(fhirizer.stages)
+    stages = {stage.name: stage for stage in fhirizer.stages}
+    selected = {stage.name for stage in fhirizer.stages if stage.name in only or set(stage.outputs) & set(only)}
+    pending = list(selected)
+    while pending:
+        for name in stages[pending.pop()].needs:
+            if name not in selected:
+                selected.add(name)
+                pending.append(name)
+    return [stage for stage in fhirizer.stages if stage.name in selected]
+
+
+class Context:
+    """What a stage function is called with: the run options, its fhirizer's META path and manifest, the
+    shared process pool (None without --workers) and the results of the stages it needs."""
+
+    def __init__(self, fhirizer, meta_path, manifest, executor, verbose=False, workers=1, incremental=False,
+                 group_max_members=None):
+        self.fhirizer = fhirizer
+        self.meta_path = meta_path
+        self.manifest = manifest
+        self.executor = executor
+        self.verbose = verbose
+        self.workers = workers
+        self.incremental = incremental
+        self.group_max_members = group_max_members
+        self.results = {}
+
+
+def run(names, only=(), workers=1, incremental=False, **options) -> list:
+    """
+    Run the (selected) stages of the fhirizers in names concurrently, each once its dependencies are done.
+    Returns [(fhirizer name, stage name)] in the order the stages finished.
+    """
+    from fhir_etl import parallel
+    from fhir_etl.incremental import Manifest
+
+    registry = fhirizers()
+    known = {key for name in names for stage in registry[name].stages for key in (stage.name,) + tuple(stage.outputs)}
+    unknown = [key for key in only if key not in known]
+    if unknown:
+        raise ValueError(f"No stage or output named {', '.join(unknown)} in {', '.join(names)}")
+    plans = {name: select(registry[name], only) for name in names}
+
+    finished = []
+    with parallel.pool(workers) as executor:
+        if executor is not None:
+            executor.submit(int).result()  # start the workers before any stage thread is running
+        contexts = {}
+        pending = {}
+        for name, stages in plans.items():
+            path = meta_path(registry[name])
+            Path(path).mkdir(parents=True, exist_ok=True)
+            contexts[name] = Context(name, path, Manifest(path, incremental=incremental), executor,
+                                     workers=workers, incremental=incremental, **options)
+            for stage in stages:
+                pending[(name, stage.name)] = stage
+        remaining = {name: len(stages) for name, stages in plans.items()}
+        selected = set(pending)
+        done = set()
+        running = {}
+        error = None
+
+        def ready(name, stage):
+            return all((name, dependency) in done or (name, dependency) not in selected
+                       for dependency in stage.needs + stage.after)
+
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as threads:
+            while (pending and error is None) or running:
+                for key, stage in list(pending.items()):
+                    if error is None and ready(key[0], stage):
+                        del pending[key]
+                        function = load_entry_point(stage.entry_point)
+                        running[threads.submit(function, contexts[key[0]])] = key
+                if not running:
+                    raise ValueError(f"Stages {sorted(pending)} depend on each other")
+                for future in wait(running, return_when=FIRST_COMPLETED).done:
+                    name, stage_name = running.pop(future)
+                    try:
+                        contexts[name].results[stage_name] = future.result()
+                    except BaseException as e:
+                        error = error or e
+                        continue
+                    done.add((name, stage_name))
+                    finished.append((name, stage_name))
+                    remaining[name] -= 1
+                    if not remaining[name]:
+                        contexts[name].manifest.save()
+        if error is not None:
+            raise error
+    return finished
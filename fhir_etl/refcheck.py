@@ -0,0 +1,95 @@
+import uuid
+from collections import namedtuple
+
+import orjson
+
+from fhir_etl import compression
+
+# -------------------------
+# referential integrity
+# -------------------------
+# Two streaming passes over the *.ndjson files of a META directory. The first builds one id set per
+# resource type, holding each minted uuid as its 16 raw bytes (ids that are not uuids are kept as their
+# UTF-8 bytes); the second resolves every relative reference (Specimen.subject, ResearchSubject.study,
+# Group.member.entity, DocumentReference.subject, ...) against those sets. Only one line is held at a
+# time, so memory is the id sets plus the dangling reference counts; time is linear in the input.
+
+EXAMPLES_PER_FIELD = 5
+
+DanglingReferences = namedtuple('DanglingReferences', ['field', 'target_type', 'count', 'examples'])
+RefCheckResult = namedtuple('RefCheckResult', ['resources', 'references', 'skipped', 'dangling'])
+
+
+def id_key(resource_id: str) -> bytes:
+    """Compact set key of a resource id: 16 bytes for a uuid, the UTF-8 bytes otherwise."""
+    try:
+        return uuid.UUID(resource_id).bytes
+    except ValueError:
+        return resource_id.encode()
+
+
+def iter_references(value, path):
+    """(field path, reference) for every string `reference` in value, e.g. ('Group.member.entity', 'Specimen/...')."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str):
+                yield path, item
+            elif isinstance(item, (dict, list)):
+                yield from iter_references(item, f"{path}.{key}")
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_references(item, path)
+
+
+def _iter_resources(files):
+    for file_path in files:
+        with compression.open_read(file_path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    resource = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # reported by `fhir_etl validate`
+                if isinstance(resource, dict) and resource.get('resourceType') and resource.get('id'):
+                    yield resource
+
+
+def build_id_sets(files) -> dict:
+    """First pass: resource type -> set of id_key(id)."""
+    id_sets = {}
+    for resource in _iter_resources(files):
+        id_sets.setdefault(resource['resourceType'], set()).add(id_key(resource['id']))
+    return id_sets
+
+
+def check_references(files, examples=EXAMPLES_PER_FIELD) -> RefCheckResult:
+    """
+    Resolve every relative reference in files against the resources they contain.
+    Contained (#...) and absolute references cannot be resolved locally and are only counted as skipped.
+    """
+    id_sets = build_id_sets(files)
+    dangling = {}
+    references = skipped = 0
+    for resource in _iter_resources(files):
+        source = f"{resource['resourceType']}/{resource['id']}"
+        for field, reference in iter_references(resource, resource['resourceType']):
+            target_type, _, target_id = reference.partition('/')
+            if not target_id or '/' in target_id or ':' in target_type or reference.startswith('#'):
+                skipped += 1
+                continue
+            references += 1
+            if id_key(target_id) in id_sets.get(target_type, ()):
+                continue
+            entry = dangling.setdefault((field, target_type), [0, []])
+            entry[0] += 1
+            if len(entry[1]) < examples:
+                entry[1].append(f"{source} -> {reference}")
+
+    return RefCheckResult(
+        resources={resource_type: len(ids) for resource_type, ids in id_sets.items()},
+        references=references,
+        skipped=skipped,
+        dangling=[DanglingReferences(field, target_type, count, found)
+                  for (field, target_type), (count, found) in sorted(dangling.items())],
+    )
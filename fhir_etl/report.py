@@ -0,0 +1,186 @@
+import sys
+import json
+import time
+import threading
+import tracemalloc
+import contextlib
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# -------------------------
+# run report
+# -------------------------
+# The fhirizers wrap each step of a transform in stage(): wall and CPU time, rows in and resources out,
+# bytes downloaded and written, and the process' peak RSS (plus the tracemalloc peak with trace_memory).
+# Conversions stream straight into the NDJSON writers, so they are measured with timed() around the
+# resource iterator; its time is taken out of the enclosing write stage, leaving the writer's own cost.
+# CPU time is that of the thread running the stage, so concurrent stages do not count each other's, and
+# does not include --workers processes. The tracemalloc peak is process wide: a stage that overlaps a stage
+# of another thread is marked `overlapped` and gets no tracemalloc peak. transform --report saves the
+# stages as JSON.
+
+_lock = threading.Lock()
+_local = threading.local()
+_stages = []
+_open = []  # stages in progress, in every thread
+_trace_memory = False
+_started = time.perf_counter()
+_started_cpu = time.process_time()
+_started_at = datetime.now(timezone.utc)
+
+
+class Stage:
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_downloaded = None
+        self.bytes_written = None
+        self.start_seconds = time.perf_counter() - _started
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = None
+        self.tracemalloc_peak_bytes = None
+        self.overlapped = False
+        self._thread = threading.get_ident()
+        self._nested_wall = 0.0
+        self._nested_cpu = 0.0
+        self._nested_peak = 0
+
+    def as_dict(self) -> dict:
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+
+def configure(trace_memory=False):
+    """Start a new report; with trace_memory the tracemalloc peak of every stage is recorded too (slower)."""
+    global _trace_memory, _started, _started_cpu, _started_at
+    _trace_memory = trace_memory
+    _started = time.perf_counter()
+    _started_cpu = time.process_time()
+    _started_at = datetime.now(timezone.utc)
+    with _lock:
+        _stages.clear()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def peak_rss_bytes():
+    """High-water mark of this process' resident set size."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _begin(stage):
+    with _lock:
+        others = [other for other in _open if other._thread != stage._thread]
+        for other in others:
+            other.overlapped = True
+        stage.overlapped = bool(others)
+        _open.append(stage)
+        if _trace_memory and tracemalloc.is_tracing() and not others:
+            tracemalloc.reset_peak()
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def _finish(stage, parent):
+    stage.wall_seconds = max(stage.wall_seconds - stage._nested_wall, 0.0)
+    stage.cpu_seconds = max(stage.cpu_seconds - stage._nested_cpu, 0.0)
+    stage.peak_rss_bytes = peak_rss_bytes()
+    with _lock:
+        _open.remove(stage)
+        if _trace_memory and tracemalloc.is_tracing() and not stage.overlapped:
+            # nested stages reset the peak, so theirs count towards the enclosing stage
+            stage.tracemalloc_peak_bytes = max(tracemalloc.get_traced_memory()[1], stage._nested_peak)
+        if parent is not None:
+            parent._nested_wall += stage.wall_seconds + stage._nested_wall
+            parent._nested_cpu += stage.cpu_seconds + stage._nested_cpu
+            parent._nested_peak = max(parent._nested_peak, stage.tracemalloc_peak_bytes or 0)
+        _stages.append(stage)
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    """Measure the enclosed block; set rows_out, bytes_downloaded and bytes_written on the yielded Stage."""
+    record = Stage(name, rows_in)
+    parent = _begin(record)
+    stack = _stack()
+    stack.append(record)
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record.wall_seconds = time.perf_counter() - start
+        record.cpu_seconds = time.thread_time() - start_cpu
+        stack.pop()
+        _finish(record, parent)
+
+
+def progress(iterable=None, desc=None, total=None, unit='resource'):
+    """tqdm progress bar with rate display; stays quiet when stderr is not a terminal."""
+    from tqdm import tqdm
+    return tqdm(iterable, desc=desc, total=total, unit=unit, unit_scale=True, disable=None, leave=False, file=sys.stderr)
+
+
+def timed(name, iterable, rows_in=None, unit='resource'):
+    """
+    Yield from iterable, measuring only the time spent producing items (e.g. converting rows) as stage `name`,
+    with a progress bar. The time is taken out of the stage the iterator is consumed in.
+    """
+    record = Stage(name, rows_in)
+    parent = _begin(record)
+    stack = _stack()
+    iterator = iter(iterable)
+    count = 0
+    try:
+        with progress(desc=name, total=rows_in, unit=unit) as bar:
+            while True:
+                # stages opened while producing the item (e.g. preparing the next chunk) are nested in this one
+                stack.append(record)
+                start, start_cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    record.wall_seconds += time.perf_counter() - start
+                    record.cpu_seconds += time.thread_time() - start_cpu
+                    stack.pop()
+                count += 1
+                bar.update()
+                yield item
+    finally:
+        record.rows_out = count
+        _finish(record, parent)
+
+
+def stages() -> list:
+    with _lock:
+        return sorted((stage.as_dict() for stage in _stages), key=lambda stage: stage['start_seconds'])
+
+
+def save(path, **fields):
+    """Write the report of the current run to path as JSON; fields (e.g. project, options) are included as is."""
+    report = {
+        **fields,
+        'started': _started_at.isoformat(timespec='seconds'),
+        'wall_seconds': time.perf_counter() - _started,
+        'cpu_seconds': time.process_time() - _started_cpu,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'stages': stages(),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,337 @@
+import io
+import os
+import re
+import zlib
+import hashlib
+import threading
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+
+from fhir_etl import utils
+from fhir_etl import compression
+
+# -------------------------
+# sharded NDJSON
+# -------------------------
+# transform --shards N writes every output as <type>.<k>.ndjson (k = 0..N-1, plus the --compress suffix)
+# instead of one <type>.ndjson. A resource goes to shard crc32(id) % N, so the same id always lands in
+# the same shard and an unchanged resource keeps its shard across runs. Lines are buffered per shard
+# and BLOCK_SIZE blocks are written (and compressed) on a thread pool, one block per shard at a time,
+# so the shards are written in parallel. Every file is hashed as it is written, and
+# <META>/manifest.json lists the records, bytes and sha256 of each shard file by resource type:
+# downstream loaders can fan out per shard and skip shards whose sha256 did not change, without
+# reading them again. Outputs merged by create_or_extend (1000 Genomes DocumentReference and Group)
+# are partitioned the same way and merged per shard; their few files are hashed after the merge.
+# Writing an output with another shard count (or without --shards) removes its stale files.
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+BLOCK_SIZE = compression.BLOCK_SIZE
+HASH_BLOCK_SIZE = 1 << 20
+
+_shards = 1
+_manifest_lock = threading.Lock()
+
+
+def configure(shards=1):
+    """Set the number of shards the fhirizers write every output in (1 writes <type>.ndjson)."""
+    global _shards
+    assert shards >= 1, f"Invalid shard count: {shards}"
+    _shards = shards
+
+
+def get_shards():
+    return _shards
+
+
+def shard_of(resource_id, shards) -> int:
+    return zlib.crc32(resource_id.encode()) % shards
+
+
+def shard_path(folder_path, name, shard) -> str:
+    """<folder_path>/<name>.<shard>.ndjson, with the suffix of the configured compression."""
+    return utils.ndjson_path(folder_path, f"{name}.{shard}")
+
+
+def _existing(folder_path, name) -> list:
+    """(shard or None, path) of every <name>.ndjson and <name>.<k>.ndjson in folder_path, in any compression."""
+    pattern = re.compile(rf"{re.escape(name)}(?:\.(\d+))?{re.escape(utils.NDJSON_SUFFIX)}(?:\.gz|\.zst)?")
+    if not os.path.isdir(folder_path):
+        return []
+    found = []
+    for file_name in os.listdir(folder_path):
+        match = pattern.fullmatch(file_name)
+        if match:
+            shard = match.group(1)
+            found.append((int(shard) if shard is not None else None, os.path.join(folder_path, file_name)))
+    return sorted(found, key=lambda item: (item[0] is not None, item[0] or 0, item[1]))
+
+
+def find_outputs(folder_path, name) -> list:
+    """The existing files of an output, its shards in order or its single <name>.ndjson, whatever they were written with."""
+    shard_files = [path for shard, path in _existing(folder_path, name) if shard is not None]
+    if shard_files:
+        return shard_files
+    file_path = utils.find_ndjson(folder_path, name)
+    return [file_path] if file_path else []
+
+
+def remove_stale(folder_path, name, keep):
+    """Remove the files (and sidecar indexes) of an output that are not in keep, e.g. after a change of --shards."""
+    keep = {str(path) for path in keep}
+    for _, file_path in _existing(folder_path, name):
+        if file_path in keep:
+            continue
+        for stale_path in (file_path, file_path + utils.NDJSON_INDEX_SUFFIX):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+
+# serialized lines start with resourceType and id (builder templates, utils.dump_resource), anything else is parsed
+LEADING_ID = re.compile(rb'\{"resourceType":"[^"]*","id":"([^"\\]*)"')
+
+
+def _resource_id_and_line(resource):
+    if isinstance(resource, bytes):
+        match = LEADING_ID.match(resource)
+        return (match.group(1).decode() if match else orjson.loads(resource)["id"]), resource
+    resource = utils.to_resource_dict(resource)
+    return resource["id"], orjson.dumps(resource, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+# -------------------------
+# shard manifest
+# -------------------------
+
+def _manifest_path(folder_path) -> str:
+    return os.path.join(folder_path, MANIFEST_NAME)
+
+
+def load_manifest(folder_path) -> dict:
+    try:
+        with open(_manifest_path(folder_path), 'rb') as file:
+            manifest = orjson.loads(file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    return manifest if manifest.get('version') == MANIFEST_VERSION else {}
+
+
+def _update_manifest(folder_path, name, entry):
+    """Set (or with entry None, drop) the entry of an output; stages of one run update it from several threads."""
+    with _manifest_lock:
+        outputs = load_manifest(folder_path).get('outputs', {})
+        if entry is None and name not in outputs:
+            return
+        if entry is None:
+            del outputs[name]
+        else:
+            outputs[name] = entry
+        manifest_path = _manifest_path(folder_path)
+        if not outputs:
+            os.remove(manifest_path)
+            return
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps({'version': MANIFEST_VERSION, 'outputs': outputs}, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, manifest_path)
+
+
+def _record(folder_path, name, files):
+    _update_manifest(folder_path, name, {'shards': len(files), 'records': sum(file['records'] for file in files),
+                                         'bytes': sum(file['bytes'] for file in files), 'files': files})
+
+
+def file_entry(file_path, records) -> dict:
+    """Manifest entry of a shard file that is already written."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return {'path': os.path.basename(file_path), 'records': records, 'bytes': os.path.getsize(file_path),
+            'sha256': digest.hexdigest()}
+
+
+def file_sha256(file_path):
+    """sha256 of file_path as recorded in the manifest.json next to it, or None if it is not listed (or its size changed)."""
+    file_path = str(file_path)
+    folder_path, file_name = os.path.split(file_path)
+    for entry in load_manifest(folder_path).get('outputs', {}).values():
+        for file in entry['files']:
+            if file['path'] == file_name:
+                return file['sha256'] if os.path.getsize(file_path) == file['bytes'] else None
+    return None
+
+
+def is_intact(folder_path, name) -> bool:
+    """Whether the shards of an output are the --shards files listed in manifest.json, with their recorded sha256."""
+    entry = load_manifest(folder_path).get('outputs', {}).get(name)
+    if not entry or entry['shards'] != _shards:
+        return False
+    for shard, file in enumerate(entry['files']):
+        file_path = os.path.join(folder_path, file['path'])
+        if file_path != shard_path(folder_path, name, shard) or not os.path.exists(file_path):
+            return False
+        if file_entry(file_path, file['records']) != file:
+            return False
+    return True
+
+
+# -------------------------
+# writers
+# -------------------------
+
+class DigestFile(io.RawIOBase):
+    """Binary file wrapper that counts and sha256-hashes the bytes written through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.file.close()
+        super().close()
+
+
+class ShardedWriter:
+    """Writes lines to the shards of an output, BLOCK_SIZE at a time per shard, on `threads` threads."""
+
+    def __init__(self, folder_path, name, shards, threads=None):
+        codec = compression.get_compression()
+        self.paths = [shard_path(folder_path, name, shard) for shard in range(shards)]
+        self.files = [DigestFile(open(file_path, 'wb')) for file_path in self.paths]
+        # one compression thread per shard, the shards themselves run in parallel
+        self.writers = [compression.wrap_write(file, codec, threads=1) if codec else file for file in self.files]
+        self.buffers = [bytearray() for _ in range(shards)]
+        self.records = [0] * shards
+        self.in_flight = [None] * shards
+        threads = min(shards, threads or compression.get_threads())
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    def write_all(self, resources):
+        """Write resources (models, dicts or serialized lines), each to the shard of its id."""
+        shards = len(self.paths)
+        buffers = self.buffers
+        records = self.records
+        crc32 = zlib.crc32
+        for resource in resources:
+            resource_id, line = _resource_id_and_line(resource)
+            shard = crc32(resource_id.encode()) % shards  # shard_of, inlined
+            buffer = buffers[shard]
+            buffer += line
+            buffer += b"\n"
+            records[shard] += 1
+            if len(buffer) >= BLOCK_SIZE:
+                self._submit(shard)
+
+    def _submit(self, shard):
+        block = bytes(self.buffers[shard])
+        self.buffers[shard].clear()
+        if self.executor is None:
+            self.writers[shard].write(block)
+            return
+        # blocks of a shard are written in order, one at a time
+        if self.in_flight[shard] is not None:
+            self.in_flight[shard].result()
+        self.in_flight[shard] = self.executor.submit(self.writers[shard].write, block)
+
+    def close(self) -> list:
+        """Flush and close every shard; their manifest entries."""
+        try:
+            for shard, buffer in enumerate(self.buffers):
+                if buffer:
+                    self._submit(shard)
+            for future in self.in_flight:
+                if future is not None:
+                    future.result()
+            if self.executor is not None:
+                list(self.executor.map(lambda writer: writer.close(), self.writers))
+        finally:
+            for writer in self.writers:
+                if not writer.closed:
+                    writer.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        return [{'path': os.path.basename(file_path), 'records': records, 'bytes': file.size,
+                 'sha256': file.sha256.hexdigest()}
+                for file_path, records, file in zip(self.paths, self.records, self.files)]
+
+
+def write(resources, folder_path, name) -> tuple:
+    """
+    Stream resources (models, dicts or serialized lines) to the output `name` in folder_path: one
+    <name>.ndjson, or with --shards the <name>.<k>.ndjson shards recorded in manifest.json.
+    Returns (resources written, [files written]).
+    """
+    if _shards <= 1:
+        file_path = utils.ndjson_path(folder_path, name)
+        count = utils.write_ndjson(resources, file_path)
+        remove_stale(folder_path, name, [file_path])
+        _update_manifest(folder_path, name, None)
+        return count, [file_path]
+
+    writer = ShardedWriter(folder_path, name, _shards)
+    try:
+        writer.write_all(resources)
+    finally:
+        files = writer.close()
+    remove_stale(folder_path, name, writer.paths)
+    _record(folder_path, name, files)
+    return sum(writer.records), writer.paths
+
+
+def create_or_extend(new_items, folder_path, resource_type, update_existing=False) -> list:
+    """
+    utils.create_or_extend for every shard of resource_type (or its single file without --shards).
+    When the output was written with another shard count, its records are read back and merged into
+    the new layout (before new_items, so they win unless update_existing). Returns the files of the output.
+    """
+    file_paths = [utils.ndjson_path(folder_path, resource_type)] if _shards <= 1 else \
+        [shard_path(folder_path, resource_type, shard) for shard in range(_shards)]
+    targets = {variant for file_path in file_paths for variant in utils.ndjson_variants(file_path)}
+    existing = [file_path for _, file_path in _existing(folder_path, resource_type)]
+    if any(file_path not in targets for file_path in existing):
+        carried = list(_lines(existing))
+        remove_stale(folder_path, resource_type, [])
+        new_items = chain(carried, new_items)
+
+    if _shards <= 1:
+        utils.create_or_extend(new_items=new_items, folder_path=folder_path, resource_type=resource_type,
+                               update_existing=update_existing)
+        remove_stale(folder_path, resource_type, file_paths)
+        _update_manifest(folder_path, resource_type, None)
+        return file_paths
+
+    buckets = [[] for _ in range(_shards)]
+    for new_item in new_items:
+        resource_id = new_item["id"] if isinstance(new_item, dict) else _resource_id_and_line(new_item)[0]
+        buckets[shard_of(resource_id, _shards)].append(new_item)
+    for shard, items in enumerate(buckets):
+        utils.create_or_extend(new_items=items, folder_path=folder_path, resource_type=resource_type,
+                               update_existing=update_existing, name=f"{resource_type}.{shard}")
+    remove_stale(folder_path, resource_type, file_paths)
+    _record(folder_path, resource_type, [file_entry(file_path, len(utils.load_ndjson_index(file_path)['records']))
+                                         for file_path in file_paths])
+    return file_paths
+
+
+def _lines(file_paths):
+    for file_path in file_paths:
+        with compression.open_read(file_path) as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield line
@@ -0,0 +1,89 @@
+import io
+from itertools import chain
+from collections import namedtuple
+
+import pandas as pd
+
+from fhir_etl import report
+
+# -------------------------
+# source schemas
+# -------------------------
+# Every fhirizer declares a SourceSchema per tabular source: the columns its converters read and their
+# dtypes. Identifiers and free text are 'str' (what pandas infers for them anyway, so ids are minted
+# exactly as before), columns with a handful of distinct values (sex, age bracket, population, data
+# type, ...) are 'category', stored once per value plus a small integer code per row. read_table() and
+# from_pages() load only those columns (usecols), so the frame a stage keeps is a fraction of the full
+# table or list of API records. PreparedChunks feeds conversion in bounded batches: the prepared
+# converter columns (ids, references, display strings, the bulk of the memory) exist for CHUNK_SIZE
+# source rows at a time instead of the whole table.
+
+CHUNK_SIZE = 50000  # source rows prepared and converted at a time
+
+SourceSchema = namedtuple('SourceSchema', ['name', 'dtypes'])
+
+
+def usecols(schema: SourceSchema) -> list:
+    return list(schema.dtypes)
+
+
+def read_table(data: bytes, schema: SourceSchema, sep='\t', chunksize=None):
+    """The schema columns of a delimited text source as a typed DataFrame, or an iterator of chunksize-row DataFrames."""
+    return pd.read_csv(io.BytesIO(data), sep=sep, usecols=usecols(schema), dtype=schema.dtypes, chunksize=chunksize)
+
+
+def from_records(records, schema: SourceSchema) -> pd.DataFrame:
+    """The schema columns of JSON records (dicts) as a typed DataFrame; other keys are dropped."""
+    return from_pages([records], schema)
+
+
+def from_pages(pages, schema=None) -> pd.DataFrame:
+    """
+    The schema columns of JSON records arriving in pages (lists of dicts, e.g. API responses) as a typed
+    DataFrame. Only the schema columns of a page are kept, as it arrives. Without a schema every key is kept.
+    """
+    if schema is None:
+        return pd.DataFrame(list(chain.from_iterable(pages)))
+    columns = {column: [] for column in schema.dtypes}
+    for page in pages:
+        for column, values in columns.items():
+            values.extend(record.get(column) for record in page)
+    return pd.DataFrame({column: pd.Series(values, dtype=schema.dtypes[column]) for column, values in columns.items()})
+
+
+def chunks(frame, chunksize=None):
+    """Consecutive row slices of frame, at most chunksize (default CHUNK_SIZE) rows each."""
+    chunksize = chunksize or CHUNK_SIZE
+    for start in range(0, len(frame), chunksize):
+        yield frame.iloc[start:start + chunksize]
+
+
+class PreparedChunks:
+    """
+    prepare(chunk) for every chunk of a source frame, for Manifest.rows. Re-iterable, one pass per output
+    converted from it: a frame of a single chunk is prepared once, up front (report stage `name`); a larger
+    one is prepared again chunk by chunk on every pass, so only one chunk of prepared columns is alive.
+    """
+
+    def __init__(self, frame, prepare, name, chunksize=None):
+        self.frame = frame
+        self.prepare = prepare
+        self.name = name
+        self.chunksize = chunksize or CHUNK_SIZE
+        self.prepared = self._prepare(frame) if len(frame) <= self.chunksize else None
+
+    def _prepare(self, chunk):
+        with report.stage(self.name, rows_in=len(chunk)) as stage:
+            prepared = self.prepare(chunk)
+            stage.rows_out = len(prepared)
+        return prepared
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __iter__(self):
+        if self.prepared is not None:
+            yield self.prepared
+            return
+        for chunk in chunks(self.frame, self.chunksize):
+            yield self._prepare(chunk)
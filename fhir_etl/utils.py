@@ -1,11 +1,8 @@
 import os
 import orjson
 from fhir.resources import get_fhir_model_class
-import ftplib
 import pandas as pd
-import json
 import re
-import requests
 from datetime import datetime
 
 from fhir.resources.extension import Extension
@@ -13,23 +10,37 @@ from fhir.resources.group import Group
 from fhir.resources.documentreference import DocumentReference
 from fhir.resources.identifier import Identifier
 from fhir.resources.reference import Reference
-from fhir.resources.fhirresourcemodel import FHIRAbstractModel
 
 import uuid
 from uuid import uuid3, uuid5, NAMESPACE_DNS
 
 import decimal
 import importlib
+import functools
+import hashlib
+from collections import namedtuple
+
+from fhir_etl import compression
+from fhir_etl.builder import get_resource_class, validate_fhir_resource_from_type  # noqa: F401, re-exported
 
 import mimetypes
 mimetypes.add_type('text/vcf', '.vcf')
 
 THOUSAND_GENOMES = 'https://ftp.1000genomes.ebi.ac.uk/vol1/ftp/'
 
+MINT_CACHE_SIZE = 1 << 20
+
+
+@functools.lru_cache(maxsize=MINT_CACHE_SIZE)
+def _uuid5(namespace: uuid.UUID, name: str) -> str:
+    """Memoized uuid5; a row mints the same study/patient ids several times across resource types."""
+    return str(uuid5(namespace, name))
+
+
 class IDHelper:  # pilfered from https://github.com/FHIR-Aggregator/CDA2FHIR/blob/7660b8ee9a7b815855a826bfb78aee62eb39cf27/cda2fhir/transformer.py#L34
-    def __init__(self):
-        self.project_id = '1KG'
-        self.namespace = uuid3(NAMESPACE_DNS, THOUSAND_GENOMES)
+    def __init__(self, project_id: str = '1KG', site: str = THOUSAND_GENOMES):
+        self.project_id = project_id
+        self.namespace = uuid3(NAMESPACE_DNS, site)
 
     @staticmethod
     def is_valid_uuid(value: str) -> bool:
@@ -50,9 +61,38 @@ class IDHelper:  # pilfered from https://github.com/FHIR-Aggregator/CDA2FHIR/blo
             identifier = f"{resource_type}/{identifier.system}|{identifier.value}"
         return self._mint_id(identifier)
 
+    def mint(self, system: str, value, resource_type: str) -> str:
+        """mint_id for an Identifier(system, value) without constructing the Identifier model."""
+        return self._mint_id(f"{resource_type}/{system}|{value}")
+
+    def mint_ids(self, values, resource_type: str, system: str):
+        """Batch mint_id over a column of identifier values; each distinct value is hashed once.
+        Returns a Series aligned with values when given a Series, a list otherwise."""
+        if isinstance(values, pd.Series):
+            values = values.astype(str)
+            minted = {value: self.mint(system, value, resource_type) for value in values.unique()}
+            return values.map(minted)
+        return [self.mint(system, str(value), resource_type) for value in values]
+
     def _mint_id(self, identifier_string: str) -> str:
         """create a UUID from an identifier, insert project_id."""
-        return str(uuid5(self.namespace, f"{self.project_id}/{identifier_string}"))
+        return _uuid5(self.namespace, f"{self.project_id}/{identifier_string}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_id_helper(project_id: str, site: str) -> IDHelper:
+    """The shared IDHelper for a project, e.g. get_id_helper('GTEX', 'gtexportal.org/home/')."""
+    return IDHelper(project_id=project_id, site=site)
+
+
+def na_to_none(column: pd.Series) -> pd.Series:
+    """Object column with every NA replaced by None, so row tuples carry plain python values."""
+    return column.astype(object).where(column.notna(), None)
+
+
+def fill_na(column: pd.Series, default) -> pd.Series:
+    """Object column with every NA replaced by default."""
+    return column.astype(object).where(column.notna(), default)
 
 
 def get_data_format(file_name):
@@ -98,33 +138,149 @@ def is_valid_fhir_resource_type(resource_type):
     except KeyError:
         return False
 
-def create_or_extend(new_items, folder_path='META', resource_type='Observation', update_existing=False):
-    assert is_valid_fhir_resource_type(resource_type), f"Invalid resource type: {resource_type}"
+NDJSON_INDEX_SUFFIX = '.idx'
+NDJSON_SUFFIX = '.ndjson'
 
-    file_name = "".join([resource_type, ".ndjson"])
-    file_path = os.path.join(folder_path, file_name)
 
-    file_existed = os.path.exists(file_path)
+def ndjson_path(folder_path, name) -> str:
+    """<folder_path>/<name>.ndjson, with the suffix of the configured compression (.gz, .zst)."""
+    return os.path.join(folder_path, f"{name}{NDJSON_SUFFIX}{compression.suffix(compression.get_compression())}")
 
-    existing_data = {}
 
-    if file_existed:
-        with open(file_path, 'r') as file:
-            for line in file:
-                try:
-                    item = orjson.loads(line)
-                    existing_data[item.get("id")] = item
-                except orjson.JSONDecodeError:
-                    continue
+def ndjson_variants(file_path) -> list:
+    """file_path in its plain and in every compressed form."""
+    base = str(file_path)
+    codec_suffix = compression.suffix(compression.compression_of(base))
+    if codec_suffix:
+        base = base[:-len(codec_suffix)]
+    return [base] + [base + codec_suffix for codec_suffix in compression.SUFFIXES.values()]
 
-    for new_item in new_items:
-        new_item_id = new_item["id"]
-        if new_item_id not in existing_data or update_existing:
-            existing_data[new_item_id] = new_item
 
-    with open(file_path, 'w') as file:
-        for item in existing_data.values():
-            file.write(orjson.dumps(item).decode('utf-8') + '\n')
+def find_ndjson(folder_path, name):
+    """The existing <name>.ndjson in folder_path in any compression, preferring the configured one, or None."""
+    preferred = ndjson_path(folder_path, name)
+    for file_path in [preferred] + ndjson_variants(preferred):
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+def remove_stale_variants(file_path):
+    """Remove the differently compressed copies of file_path, and their sidecar indexes, once it is written."""
+    for variant in ndjson_variants(file_path):
+        if variant == str(file_path):
+            continue
+        for stale_path in (variant, variant + NDJSON_INDEX_SUFFIX):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+
+def content_hash(line: bytes) -> str:
+    return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+
+def scan_ndjson_index(file_path) -> dict:
+    """
+    Build the sidecar index of an NDJSON file in one pass: id -> [offset, length, content hash], where
+    length is the byte length of the record's line (including its newline).
+    Lines that are blank, unparsable, lack an id or are shadowed by a later line with the same id are
+    dead space; dead_bytes is simply file_size minus the bytes held by live slots.
+    Compressed files are scanned through their decompressed stream (offsets are positions in that stream).
+    """
+    records = {}
+    offset = 0
+    with compression.open_read(file_path) as file:
+        for line in file:
+            body = line.rstrip()
+            try:
+                item = orjson.loads(body) if body else None
+            except orjson.JSONDecodeError:
+                item = None
+            if isinstance(item, dict) and item.get("id") is not None:
+                records[item["id"]] = [offset, len(line), content_hash(body)]
+            offset += len(line)
+    return _index_stats(file_path, {'records': records})
+
+
+def _index_stats(file_path, index) -> dict:
+    stat = os.stat(file_path)
+    index['file_size'] = stat.st_size
+    index['mtime_ns'] = stat.st_mtime_ns
+    index['dead_bytes'] = stat.st_size - sum(record[1] for record in index['records'].values())
+    return index
+
+
+def load_ndjson_index(file_path) -> dict:
+    """Sidecar index for file_path, rebuilt by a scan when missing or when the file was rewritten behind its back."""
+    index_path = file_path + NDJSON_INDEX_SUFFIX
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as file:
+                index = orjson.loads(file.read())
+            stat = os.stat(file_path)
+            if index.get('file_size') == stat.st_size and index.get('mtime_ns') == stat.st_mtime_ns:
+                return index
+        except (OSError, orjson.JSONDecodeError):
+            pass
+    return scan_ndjson_index(file_path)
+
+
+def save_ndjson_index(file_path, index):
+    index_path = file_path + NDJSON_INDEX_SUFFIX
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(orjson.dumps(index))
+    os.replace(tmp_path, index_path)
+
+
+def compact_ndjson(file_path, index, replaced=None) -> dict:
+    """Rewrite only the live records, in file order, with the lines in replaced ({id: line}) swapped in for
+    theirs, and re-point the index at them."""
+    replaced = replaced or {}
+    tmp_path = file_path + '.compact'
+    records = {}
+    with open(file_path, 'rb') as source, open(tmp_path, 'wb', buffering=NDJSON_BUFFER_SIZE) as target:
+        offset = 0
+        for item_id, (old_offset, length, digest) in sorted(index['records'].items(), key=lambda item: item[1][0]):
+            if item_id in replaced:
+                line = replaced[item_id] + b"\n"
+            else:
+                source.seek(old_offset)
+                line = source.read(length).rstrip() + b"\n"
+            target.write(line)
+            records[item_id] = [offset, len(line), digest]
+            offset += len(line)
+    os.replace(tmp_path, file_path)
+    return _index_stats(file_path, {'records': records})
+
+
+def create_or_extend(new_items, folder_path='META', resource_type='Observation', update_existing=False, name=None):
+    """
+    Merge new_items into <folder_path>/<resource_type>.ndjson by id, at the cost of the delta rather than the file.
+    A persistent sidecar index (<resource_type>.ndjson.idx) locates every record: new ids are appended, and with
+    update_existing a record is only rewritten when its content hash changes, in place if the new line has the
+    same length. Otherwise the file is rewritten once, at the end, with every changed record in its original
+    position, so the result is byte for byte what writing all records in order would give.
+    Items may also be serialized lines (bytes, e.g. groups.group_lines).
+    With --compress the file is <resource_type>.ndjson.gz/.zst, see
+    _extend_compressed; an existing file in another compression is carried over to the configured one first.
+    name replaces resource_type in the file name, e.g. for the shards of fhir_etl.shards.
+    """
+    assert is_valid_fhir_resource_type(resource_type), f"Invalid resource type: {resource_type}"
+
+    file_path = ndjson_path(folder_path, name or resource_type)
+    file_name = os.path.basename(file_path)
+
+    existing_path = find_ndjson(folder_path, name or resource_type)
+    file_existed = existing_path is not None
+    if file_existed and existing_path != file_path:
+        with compression.open_read(existing_path) as existing:
+            write_ndjson((line.rstrip() for line in existing if line.strip()), file_path)
+
+    if compression.compression_of(file_path):
+        _extend_compressed(file_path, new_items, update_existing)
+    else:
+        _extend_plain(file_path, new_items, update_existing)
 
     if file_existed:
         if update_existing:
@@ -135,6 +291,134 @@ def create_or_extend(new_items, folder_path='META', resource_type='Observation',
         print(f"{file_name} has been created.")
 
 
+def _item_line(new_item):
+    """(id, line) of a resource dict or of an already serialized line."""
+    if isinstance(new_item, bytes):
+        return orjson.loads(new_item)["id"], new_item
+    return new_item["id"], orjson.dumps(new_item)
+
+
+def _extend_plain(file_path, new_items, update_existing):
+    if not os.path.exists(file_path):
+        open(file_path, 'wb').close()
+    index = load_ndjson_index(file_path)
+    records = index['records']
+    replaced = {}  # id -> new line of a record that no longer fits its slot
+
+    with open(file_path, 'r+b') as file:
+        end = file.seek(0, os.SEEK_END)
+        for new_item in new_items:
+            new_item_id, line = _item_line(new_item)
+            existing = records.get(new_item_id)
+            if existing is not None and not update_existing:
+                continue
+
+            digest = content_hash(line)
+            if existing is None:
+                file.seek(end)
+                file.write(line + b"\n")
+                records[new_item_id] = [end, len(line) + 1, digest]
+                end += len(line) + 1
+                continue
+            offset, length, existing_digest = existing
+            if existing_digest == digest:
+                continue
+            records[new_item_id] = [offset, length, digest]
+            if len(line) + 1 == length:
+                file.seek(offset)
+                file.write(line + b"\n")
+                replaced.pop(new_item_id, None)
+            else:
+                replaced[new_item_id] = line
+
+    index = _index_stats(file_path, index)
+    if replaced or index['dead_bytes']:
+        # a stale slot is only ever dead in the index, the file never keeps it past this call
+        index = compact_ndjson(file_path, index, replaced)
+    save_ndjson_index(file_path, index)
+
+
+def _extend_compressed(file_path, new_items, update_existing):
+    """
+    create_or_extend for a .gz/.zst file: there are no slots to rewrite in place, so new ids are appended
+    as a new gzip member / zstd frame, and only changed records (update_existing) cost a rewrite of the file.
+    """
+    codec = compression.compression_of(file_path)
+    records = scan_ndjson_index(file_path)['records'] if os.path.exists(file_path) else {}
+    appended = {}
+    updated = {}
+    for new_item in new_items:
+        new_item_id, line = _item_line(new_item)
+        existing = records.get(new_item_id)
+        if existing is not None and not update_existing:
+            continue
+        digest = content_hash(line)
+        if existing is not None and existing[2] == digest:
+            continue
+        if existing is not None and new_item_id not in appended:
+            updated[new_item_id] = line
+        else:
+            appended[new_item_id] = line
+        records[new_item_id] = [None, len(line) + 1, digest]
+
+    if updated:
+        tmp_path = file_path + '.tmp'
+        with compression.open_read(file_path) as source, compression.open_write(tmp_path, codec) as target:
+            for line in source:
+                body = line.rstrip()
+                if not body:
+                    continue
+                try:
+                    item_id = orjson.loads(body).get("id")
+                except (orjson.JSONDecodeError, AttributeError):
+                    item_id = None
+                target.write(updated.get(item_id, body) + b"\n")
+            for line in appended.values():
+                target.write(line + b"\n")
+        os.replace(tmp_path, file_path)
+    elif appended or not os.path.exists(file_path):
+        with compression.open_write(file_path, codec, append=True) as target:
+            for line in appended.values():
+                target.write(line + b"\n")
+
+
+NDJSON_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+
+def to_resource_dict(resource) -> dict:
+    """Plain JSON-ready dict for a fhir.resources model or a resource dict."""
+    if hasattr(resource, "model_dump"):
+        return resource.model_dump(mode="json")
+    return resource
+
+
+def dump_resource(resource) -> bytes:
+    """The NDJSON line (without newline) write_ndjson emits for a model or dict."""
+    return orjson.dumps(to_resource_dict(resource), option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def write_ndjson(resources, file_path, buffer_size=NDJSON_BUFFER_SIZE) -> int:
+    """
+    Stream an iterable (typically a generator) of models or dicts to file_path, one orjson line per
+    resource, through a large write buffer. Only the resource being written is held in memory.
+    Items that are already serialized (bytes, see dump_resource) are written as they are.
+    A .gz/.zst file_path (see ndjson_path) is compressed on the fly, and any differently compressed copy of
+    the file is removed afterwards. Returns the number of resources written.
+    """
+    count = 0
+    codec = compression.compression_of(file_path)
+    file = open(file_path, 'wb', buffering=buffer_size) if codec is None else compression.open_write(file_path, codec)
+    with file:
+        for resource in resources:
+            if isinstance(resource, bytes):
+                file.write(resource + b"\n")
+            else:
+                file.write(orjson.dumps(to_resource_dict(resource), option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY))
+            count += 1
+    remove_stale_variants(file_path)
+    return count
+
+
 def remove_empty_dicts(data):
     """
     Recursively remove empty dictionaries and lists from nested data structures.
@@ -161,19 +445,6 @@ def remove_empty_dicts(data):
         return data
 
 
-def validate_fhir_resource_from_type(resource_type: str, resource_data: dict) -> FHIRAbstractModel:
-    """
-    Generalized function to validate any FHIR resource type using its name.
-    """
-    try:
-        resource_module = importlib.import_module(f"fhir.resources.{resource_type.lower()}")
-        resource_class = getattr(resource_module, resource_type)
-        return resource_class.model_validate(resource_data)
-
-    except (ImportError, AttributeError) as e:
-        raise ValueError(f"Invalid resource type: {resource_type}. Error: {str(e)}")
-
-
 def convert_decimal_to_float(data):
     """Convert pydantic Decimal to float"""
     if isinstance(data, dict):
@@ -186,6 +457,19 @@ def convert_decimal_to_float(data):
         return data
 
 
+_INT_STRING = re.compile(r'-?\d+')
+_FLOAT_STRING = re.compile(r'-?(?:\d+\.\d*|\.\d+)')
+
+
+def coerce_numeric_string(value: str):
+    """'12' -> 12, '-1.5' -> -1.5, anything else is returned unchanged."""
+    if _INT_STRING.fullmatch(value):
+        return int(value)
+    if _FLOAT_STRING.fullmatch(value):
+        return float(value)
+    return value
+
+
 def convert_value_to_float(data):
     """
     Recursively converts all general 'entity' -> 'value' fields in a nested dictionary or list
@@ -197,36 +481,81 @@ def convert_value_to_float(data):
         for key, value in data.items():
             if isinstance(value, dict) and 'value' in value:
                 if isinstance(value['value'], str):
-                    if value['value'].replace('.', '').replace('-', '', 1).isdigit() and "." in value['value']:
-                        value['value'] = float(value['value'])
-                    elif value['value'].replace('.', '').replace('-', '', 1).isdigit() and "." not in value['value']:
-                        value['value'] = int(value['value'])
+                    value['value'] = coerce_numeric_string(value['value'])
             else:
                 data[key] = convert_value_to_float(value)
     return data
 
 
-def clean_resources(entities):
-    cleaned_resource = []
-    for resource in entities:
-        if hasattr(resource, "dict"):
-            resource_dict = resource.dict()
-        else:
-            resource_dict = resource
+def normalize_resource(data):
+    """
+    One traversal equivalent to convert_value_to_float(convert_decimal_to_float(data)): Decimals become floats and
+    the numeric 'value' string of every dict-valued entity (e.g. valueQuantity) becomes an int or float.
+    Like convert_value_to_float, such an entity is not descended into any further.
+    """
+    if isinstance(data, dict):
+        normalized = {}
+        for key, value in data.items():
+            if isinstance(value, dict) and 'value' in value:
+                value = convert_decimal_to_float(value)
+                if isinstance(value['value'], str):
+                    value['value'] = coerce_numeric_string(value['value'])
+                normalized[key] = value
+            else:
+                normalized[key] = normalize_resource(value)
+        return normalized
+    elif isinstance(data, list):
+        return [normalize_resource(item) for item in data]
+    elif isinstance(data, decimal.Decimal):
+        return float(data)
+    else:
+        return data
 
-        resource_type = resource_dict["resourceType"]
-        cleaned_resource_dict = remove_empty_dicts(resource_dict)
-        try:
-            validated_resource = validate_fhir_resource_from_type(resource_type, cleaned_resource_dict).model_dump_json()
-        except ValueError as e:
-            print(f"Validation failed for {resource_type}: {e}")
-            continue
 
-        # Handle pydantic Decimal cases
-        validated_resource = convert_decimal_to_float(orjson.loads(validated_resource))
-        validated_resource = convert_value_to_float(validated_resource)
-        validated_resource = orjson.loads(orjson.dumps(validated_resource).decode("utf-8"))
-        cleaned_resource.append(validated_resource)
+ValidationFailure = namedtuple('ValidationFailure', ['index', 'resource_type', 'resource_id', 'error'])
+
+CLEAN_CHUNK_SIZE = 256
 
-    return cleaned_resource
 
+def clean_resource(resource):
+    """
+    Prune empty values, validate against the fhir.resources model and normalize numbers.
+    The validated model is dumped once, straight to JSON-ready python (no JSON string round-trips).
+    Returns (cleaned resource, None) or (None, error message); errors are returned as text so they pickle across processes.
+    """
+    resource_dict = to_resource_dict(resource)
+    resource_type = resource_dict["resourceType"]
+    cleaned_resource_dict = remove_empty_dicts(resource_dict)
+    try:
+        validated_resource = validate_fhir_resource_from_type(resource_type, cleaned_resource_dict)
+    except ValueError as e:
+        return None, str(e)
+    return normalize_resource(validated_resource.model_dump(mode="json")), None
+
+
+def clean_resources(entities, executor=None, errors=None, chunk_size=CLEAN_CHUNK_SIZE):
+    """
+    clean_resource() every entity, returning the cleaned resources in input order.
+    With an executor (e.g. parallel.pool(n)) validation of large batches fans out across its workers.
+    Failures are skipped and appended to errors as ValidationFailure(index, resource_type, resource_id, error);
+    without an errors list only their count is reported.
+    """
+    entities = [to_resource_dict(resource) for resource in entities]
+    if executor is None:
+        results = map(clean_resource, entities)
+    else:
+        results = executor.map(clean_resource, entities, chunksize=chunk_size)
+
+    cleaned_resource = []
+    failures = 0
+    for index, (cleaned, error) in enumerate(results):
+        if error is None:
+            cleaned_resource.append(cleaned)
+            continue
+        failures += 1
+        if errors is not None:
+            errors.append(ValidationFailure(index, entities[index].get("resourceType"), entities[index].get("id"), error))
+
+    if failures and errors is None:
+        print(f"Validation failed for {failures} of {len(entities)} resources")
+    return cleaned_resource
@@ -0,0 +1,134 @@
+import os
+from collections import Counter, namedtuple
+from pathlib import Path
+
+import orjson
+
+from fhir_etl import builder
+from fhir_etl import parallel
+from fhir_etl import compression
+from fhir_etl.refcheck import iter_references
+
+# -------------------------
+# streaming META validator
+# -------------------------
+# Every *.ndjson file under a directory is split into byte ranges that start and end on line boundaries,
+# and the ranges are validated in a process pool (parallel.pool) against the cached fhir.resources model
+# classes (builder.get_resource_class). Results come back in file order, so errors are reported as soon as
+# their range is done with the 0-based line number of the resource in its file. Blank lines are skipped.
+# Compressed files (.ndjson.gz/.zst) cannot be split and are validated one file per task. Once every file
+# is read, references are checked against the ids of the valid resources and duplicate ids are reported.
+
+CHUNK_BYTES = 4 << 20  # 4 MiB of NDJSON per task
+NDJSON_SUFFIX = '.ndjson'
+
+ValidationIssue = namedtuple('ValidationIssue', ['path', 'offset', 'exception', 'json_obj'])
+ValidationResult = namedtuple('ValidationResult', ['resources', 'exceptions'])
+
+
+def ndjson_files(directory_path) -> list:
+    suffixes = [NDJSON_SUFFIX] + [NDJSON_SUFFIX + codec_suffix for codec_suffix in compression.SUFFIXES.values()]
+    return sorted(path for path in Path(directory_path).expanduser().rglob(f"*{NDJSON_SUFFIX}*")
+                  if path.is_file() and any(path.name.endswith(file_suffix) for file_suffix in suffixes))
+
+
+def byte_ranges(file_path, chunk_bytes=CHUNK_BYTES) -> list:
+    """[(start, end)] covering file_path, each range ending just after a newline (or at the end of the file)."""
+    size = os.path.getsize(file_path)
+    if compression.compression_of(file_path):
+        return [(0, size)]
+    ranges = []
+    start = 0
+    with open(file_path, 'rb') as file:
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def validate_range(file_path, start, end) -> dict:
+    """Validate the lines of file_path[start:end]; line offsets in the result are relative to the range."""
+    if compression.compression_of(file_path):
+        with compression.open_read(file_path) as file:
+            data = file.read()
+    else:
+        with open(file_path, 'rb') as file:
+            file.seek(start)
+            data = file.read(end - start)
+
+    lines = data.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    resources = Counter()
+    ids = []
+    references = set()
+    errors = []
+    for offset, line in enumerate(lines):
+        if not line.strip():
+            continue
+        json_obj = None
+        try:
+            json_obj = orjson.loads(line)
+            assert isinstance(json_obj, dict) and 'resourceType' in json_obj, "Dict missing `resourceType`, is it a FHIR dict?"
+            resource = builder.get_resource_class(json_obj['resourceType']).model_validate(json_obj)
+        except Exception as e:
+            errors.append((offset, str(e), json_obj))
+            continue
+        resources[resource.get_resource_type()] += 1
+        ids.append(f"{resource.get_resource_type()}/{resource.id}")
+        references.update(reference for _, reference in iter_references(json_obj, json_obj['resourceType']))
+    return {'lines': len(lines), 'resources': resources, 'ids': ids, 'references': references, 'errors': errors}
+
+
+def _validate_task(task):
+    return validate_range(*task)
+
+
+def validate_directory(directory_path, workers=None, chunk_bytes=CHUNK_BYTES, on_error=None, on_progress=None) -> ValidationResult:
+    """
+    Validate every NDJSON file under directory_path with `workers` processes (default: one per CPU).
+    on_error(issue) is called for every ValidationIssue as it is found, on_progress(bytes) after every range.
+    Returns resources={'summary': {resource type: valid resources}} and the list of issues.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    tasks = [(str(file_path), start, end) for file_path in ndjson_files(directory_path)
+             for start, end in byte_ranges(file_path, chunk_bytes)]
+
+    summary = {}
+    exceptions = []
+    seen_ids = set()
+    duplicate_ids = {}
+    references = set()
+    line_offsets = Counter()  # file -> lines in the ranges already merged
+
+    def report_issue(issue):
+        exceptions.append(issue)
+        if on_error:
+            on_error(issue)
+
+    with parallel.pool(workers) as executor:
+        results = executor.map(_validate_task, tasks) if executor else map(_validate_task, tasks)
+        for (file_path, start, end), result in zip(tasks, results):
+            for offset, error, json_obj in result['errors']:
+                report_issue(ValidationIssue(Path(file_path), line_offsets[file_path] + offset, error, json_obj))
+            line_offsets[file_path] += result['lines']
+            for resource_type, count in result['resources'].items():
+                summary[resource_type] = summary.get(resource_type, 0) + count
+            for resource_id in result['ids']:
+                if resource_id in seen_ids:
+                    duplicate_ids[resource_id] = True
+                seen_ids.add(resource_id)
+            references.update(result['references'])
+            if on_progress:
+                on_progress(end - start)
+
+    missing = references - seen_ids
+    if missing:
+        report_issue(ValidationIssue(Path(directory_path), 0, f"references not found {missing}", None))
+    if duplicate_ids:
+        report_issue(ValidationIssue(Path(directory_path), 0, f"Duplicate ids found {list(duplicate_ids)}", None))
+
+    return ValidationResult(resources={'summary': summary}, exceptions=exceptions)
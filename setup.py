@@ -29,9 +29,13 @@ setup(
         'pandas',
         'inflection',
         'iteration_utilities',
-        'gen3-tracker>=0.0.7rc2',
         'fhir.resources==8.0.0b4'  # FHIR® (Release R5, version 5.0.0)
     ],
+    extras_require={
+        'bench': ['pyftpdlib'],  # local FTP stand-in for `fhir_etl bench`
+        'zstd': ['zstandard'],  # transform --compress zstd
+        'parquet': ['pyarrow'],  # export --format parquet
+    },
     tests_require=['pytest'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,28 @@
+import pytest
+
+from fhir_etl import bench
+from fhir_etl import cache
+from fhir_etl import pipeline
+
+SCALE = 0.02  # about 860 GTEx samples, 70 1000 Genomes samples
+
+
+@pytest.fixture(scope='session')
+def fixtures_path(tmp_path_factory):
+    """A source cache seeded with the synthetic bench fixtures of both fhirizers."""
+    path = tmp_path_factory.mktemp('fixtures')
+    bench.seed_fixtures(str(path), scale=SCALE)
+    return path
+
+
+@pytest.fixture
+def transform(fixtures_path, tmp_path, monkeypatch):
+    """transform(name, **options): run every fhirizer offline from the fixtures into <tmp_path>/<name>/<project>;
+    returns {project: META path}."""
+    def run(name, **options):
+        output = tmp_path / name
+        monkeypatch.setattr(pipeline, 'meta_path', lambda fhirizer: str(output / fhirizer.name))
+        cache.configure(path=str(fixtures_path), offline=True)
+        pipeline.run(sorted(pipeline.FHIRIZERS), **options)
+        return {name: output / name for name in sorted(pipeline.FHIRIZERS)}
+    return run
@@ -0,0 +1,47 @@
+import pandas as pd
+
+from fhir_etl import builder
+from fhir_etl import parallel
+
+
+def picked(row):
+    """A converter reporting whether builder.checked would validate the resource of row."""
+    return row.id, builder.should_validate(row.id, builder._position.get())
+
+
+def setup_function():
+    builder.configure(validate_first=10, sample_rate=0.05)
+
+
+def teardown_function():
+    builder.configure()
+
+
+def test_first_rows_and_an_id_sample_are_validated():
+    frame = pd.DataFrame({'id': [f"resource-{i}" for i in range(2000)]})
+    results = list(parallel.convert_rows(frame, picked))
+    assert all(validated for _, validated in results[:10])
+    sampled = sum(validated for _, validated in results[10:])
+    assert 0 < sampled < 300
+
+
+def test_same_resources_are_validated_with_workers():
+    frame = pd.DataFrame({'id': [f"resource-{i}" for i in range(500)]})
+    serial = list(parallel.convert_rows(frame, picked))
+    with parallel.pool(3) as executor:
+        pooled = list(parallel.convert_rows(frame, picked, executor=executor, chunk_size=7))
+        again = list(parallel.convert_rows(frame, picked, executor=executor, chunk_size=64))
+    assert pooled == serial == again
+
+
+def test_positions_continue_across_chunks():
+    frame = pd.DataFrame({'id': [f"resource-{i}" for i in range(20)]})
+    results = list(parallel.convert_rows(frame, picked, positions=range(100, 120)))
+    assert [validated for _, validated in results] == [builder.should_validate(f"resource-{i}", 100 + i) for i in range(20)]
+    assert not all(validated for _, validated in results)
+
+
+def test_resources_outside_of_rows_and_strict_mode_are_always_validated():
+    assert builder.should_validate("any", None)
+    builder.configure(strict=True, validate_first=0, sample_rate=0)
+    assert builder.should_validate("any", 10 ** 6)
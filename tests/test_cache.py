@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from fhir_etl.cache import SourceCache, OfflineCacheMiss
+
+URL = 'https://example.org/data.tsv'
+
+
+class Response:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class Upstream:
+    """Stand-in for a requests session serving one payload with an ETag and Last-Modified."""
+
+    def __init__(self, content=b'a\tb\n1\t2\n', etag='"v1"', last_modified='Mon, 01 Jan 2024 00:00:00 GMT'):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag or headers.get('If-Modified-Since') == self.last_modified:
+            return Response(304)
+        return Response(200, self.content, {'ETag': self.etag, 'Last-Modified': self.last_modified})
+
+
+def test_hit_is_read_from_disk_in_a_new_process(tmp_path):
+    upstream = Upstream()
+    source_cache = SourceCache(tmp_path)
+    assert source_cache.fetch(URL, session=upstream) == upstream.content
+    assert source_cache.downloaded_bytes(URL) == len(upstream.content)
+    source_cache.flush()
+
+    reopened = SourceCache(tmp_path)
+    assert reopened.get(URL) == upstream.content
+    assert reopened.used_sources(URL)[URL]['etag'] == '"v1"'
+
+
+def test_put_does_not_rewrite_the_index_until_flush(tmp_path):
+    source_cache = SourceCache(tmp_path)
+    for page in range(3):
+        source_cache.put(SourceCache.request_key(URL, {'page': page}), f'page {page}'.encode())
+    assert not (tmp_path / 'index.json').exists()
+
+    source_cache.flush()
+    with open(tmp_path / 'index.json') as f:
+        assert len(json.load(f)) == 3
+
+
+def test_revalidation_sends_etag_and_if_modified_since(tmp_path):
+    upstream = Upstream()
+    source_cache = SourceCache(tmp_path)
+    source_cache.fetch(URL, session=upstream)
+
+    assert source_cache.fetch(URL, session=upstream) == upstream.content
+    assert upstream.requests[-1] == {'If-None-Match': '"v1"', 'If-Modified-Since': upstream.last_modified}
+    assert source_cache.downloaded_bytes(URL) == len(upstream.content)  # the 304 transferred nothing new
+
+
+def test_changed_source_is_downloaded_again(tmp_path):
+    upstream = Upstream()
+    source_cache = SourceCache(tmp_path)
+    source_cache.fetch(URL, session=upstream)
+
+    upstream.content, upstream.etag, upstream.last_modified = b'a\tb\n3\t4\n', '"v2"', 'Tue, 02 Jan 2024 00:00:00 GMT'
+    assert source_cache.fetch(URL, session=upstream) == b'a\tb\n3\t4\n'
+    assert source_cache.used_sources(URL)[URL]['etag'] == '"v2"'
+
+
+def test_offline_serves_cached_sources_and_raises_on_a_miss(tmp_path):
+    source_cache = SourceCache(tmp_path)
+    source_cache.fetch(URL, session=Upstream())
+    source_cache.flush()
+
+    offline = SourceCache(tmp_path, offline=True)
+    assert offline.fetch(URL) == Upstream().content
+    with pytest.raises(OfflineCacheMiss):
+        offline.fetch('https://example.org/missing.tsv')
+    with pytest.raises(OfflineCacheMiss):
+        offline.remember('ftp://example.org/listing', lambda: b'[]')
+
+
+def test_eviction_drops_least_recently_used_entries(tmp_path):
+    source_cache = SourceCache(tmp_path, max_bytes=25)
+    source_cache.put('a', b'a' * 10)
+    source_cache.put('b', b'b' * 10)
+    source_cache.get('a')  # b is now the least recently used
+    source_cache.put('c', b'c' * 10)
+
+    assert source_cache.get('b') is None
+    assert source_cache.get('a') == b'a' * 10
+    assert source_cache.get('c') == b'c' * 10
+    assert len([path for path in (tmp_path / 'objects').rglob('*') if path.is_file()]) == 2
+
+
+def test_identical_payloads_share_one_object(tmp_path):
+    source_cache = SourceCache(tmp_path, max_bytes=15)
+    source_cache.put('a', b'x' * 10)
+    source_cache.put('b', b'x' * 10)
+    assert source_cache.get('a') == source_cache.get('b') == b'x' * 10
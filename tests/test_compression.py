@@ -0,0 +1,71 @@
+import orjson
+import pytest
+
+from fhir_etl import compression
+from fhir_etl import refcheck
+from fhir_etl import utils
+from fhir_etl import validator
+
+
+@pytest.fixture(params=compression.CODECS)
+def codec(request):
+    if request.param == 'zstd':
+        pytest.importorskip('zstandard')
+    compression.configure(compression=request.param, threads=2)
+    yield request.param
+    compression.configure()
+
+
+def patient(i, name='Smith'):
+    return {'resourceType': 'Patient', 'id': f"patient-{i}", 'name': [{'family': name}]}
+
+
+def read_lines(file_path) -> list:
+    with compression.open_read(file_path) as file:
+        return [orjson.loads(line) for line in file]
+
+
+def test_open_write_and_open_read_round_trip(codec, tmp_path):
+    file_path = str(tmp_path / f"Patient.ndjson{compression.suffix(codec)}")
+    content = b"".join(orjson.dumps(patient(i)) + b"\n" for i in range(50))
+    with compression.open_write(file_path, codec) as file:
+        file.write(content)
+    with compression.open_write(file_path, codec, append=True) as file:
+        file.write(orjson.dumps(patient(50)) + b"\n")
+
+    with compression.open_read(file_path) as file:
+        assert file.read() == content + orjson.dumps(patient(50)) + b"\n"
+    assert compression.compression_of(file_path) == codec
+
+
+def test_create_or_extend_appends_to_a_compressed_file(codec, tmp_path):
+    utils.create_or_extend([patient(i) for i in range(10)], str(tmp_path), 'Patient')
+    file_path = utils.ndjson_path(str(tmp_path), 'Patient')
+    assert file_path.endswith(compression.suffix(codec))
+    with open(file_path, 'rb') as file:
+        written = file.read()
+
+    utils.create_or_extend([patient(3, 'Jones'), patient(10), patient(11)], str(tmp_path), 'Patient')
+    with open(file_path, 'rb') as file:
+        assert file.read().startswith(written)  # the new ids went into a new member / frame
+    assert read_lines(file_path) == [patient(i) for i in range(12)]
+
+    utils.create_or_extend([patient(3, 'Jones')], str(tmp_path), 'Patient', update_existing=True)
+    assert read_lines(file_path) == [patient(i) for i in range(3)] + [patient(3, 'Jones')] + [patient(i) for i in range(4, 12)]
+
+
+def test_validate_and_check_refs_read_compressed_files(codec, tmp_path):
+    utils.write_ndjson([patient(1)], utils.ndjson_path(str(tmp_path), 'Patient'))
+    utils.write_ndjson([{'resourceType': 'Specimen', 'id': 's1', 'subject': {'reference': 'Patient/patient-1'}},
+                        {'resourceType': 'Specimen', 'id': 's2', 'subject': {'reference': 'Patient/patient-2'}}],
+                       utils.ndjson_path(str(tmp_path), 'Specimen'))
+    files = validator.ndjson_files(str(tmp_path))
+    assert [path.name for path in files] == [f"{name}.ndjson{compression.suffix(codec)}" for name in ('Patient', 'Specimen')]
+
+    result = validator.validate_directory(str(tmp_path), workers=1)
+    assert result.resources == {'summary': {'Patient': 1, 'Specimen': 2}}
+    assert len(result.exceptions) == 1  # the dangling Patient/patient-2
+
+    references = refcheck.check_references(files)
+    assert references.resources == {'Patient': 1, 'Specimen': 2}
+    assert [(dangling.field, dangling.count) for dangling in references.dangling] == [('Specimen.subject', 1)]
@@ -0,0 +1,81 @@
+import ftplib
+
+import pytest
+
+from fhir_etl import bench
+from fhir_etl.oneKgenomes import document_references
+
+LISTING = [{'file': f"ALL.chr{chromosome}.genotypes.vcf.gz", 'size': 1000 + i, 'last_modified': '2014-09-12T14:21:07'}
+           for i, chromosome in enumerate([*range(1, 23), 'X'])]
+OTHER_FILES = [{'file': 'README.txt', 'size': 10, 'last_modified': '2014-09-12T14:21:07'}]
+
+
+class Listing:
+    """MLSD data connection that counts the lines read from it."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+
+    def makefile(self, mode, encoding=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+
+class ListingFTP:
+    encoding = 'utf-8'
+
+    def __init__(self, listing):
+        self.listing = listing
+
+    def sendcmd(self, cmd):
+        return '200 OK'
+
+    def transfercmd(self, cmd):
+        assert cmd == 'MLSD'
+        return self.listing
+
+    def voidresp(self):
+        return '226 Transfer complete'
+
+
+def test_mlsd_entries_are_yielded_as_they_arrive():
+    listing = Listing([f"type=file;size={entry['size']};modify=20140912142107; {entry['file']}\r\n" for entry in LISTING])
+    entries = document_references._iter_mlsd(ListingFTP(listing))
+    assert next(entries) == (LISTING[0]['file'], {'type': 'file', 'size': '1000', 'modify': '20140912142107'})
+    assert listing.read == 1
+    assert len(list(entries)) == len(LISTING) - 1
+
+
+@pytest.fixture(params=[True, False], ids=['mlsd', 'nlst'])
+def ftp_server(request, tmp_path):
+    pytest.importorskip('pyftpdlib')
+    with bench.ftp_stand_in(LISTING + OTHER_FILES, str(tmp_path / 'ftp'), mlsd=request.param) as server:
+        yield server
+
+
+def test_release_files_are_listed_with_size_and_modification_time(ftp_server):
+    release_files = list(document_references.iter_release_files(ftp_server, '/', workers=3))
+    assert sorted(release_files, key=lambda entry: entry['file']) == sorted(LISTING, key=lambda entry: entry['file'])
+
+
+def test_nlst_fallback_when_the_server_has_no_mlsd(tmp_path):
+    pytest.importorskip('pyftpdlib')
+    with bench.ftp_stand_in(LISTING, str(tmp_path / 'ftp'), mlsd=False) as server:
+        ftp = document_references._ftp_session(server, '/')
+        try:
+            with pytest.raises(ftplib.error_perm):
+                list(document_references._iter_mlsd(ftp))
+        finally:
+            document_references._quit(ftp)
+        assert len(list(document_references.iter_release_files(server, '/'))) == len(LISTING)
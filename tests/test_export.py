@@ -0,0 +1,56 @@
+import orjson
+import pytest
+
+from fhir_etl import export
+
+SEX_URL = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-sex'
+PATIENT = {
+    'resourceType': 'Patient', 'id': 'p1',
+    'identifier': [{'system': 'https://example.org', 'value': 'A'}, {'system': 'https://example.org', 'value': 'B'}],
+    'extension': [{'url': SEX_URL, 'valueCode': 'F'},
+                  {'url': 'http://example.org/StructureDefinition/age', 'valueQuantity': {'value': 41, 'unit': 'a'}}],
+    'deceasedBoolean': False,
+}
+GROUP = {'resourceType': 'Group', 'id': 'g1', 'type': 'person', 'membership': 'definitional',
+         'member': [{'entity': {'reference': 'Patient/p1'}}]}
+
+
+def test_flatten_names_list_items_counts_members_and_pivots_extensions():
+    extensions = {}
+    assert export.flatten(PATIENT, extensions=extensions) == {
+        'resourceType': 'Patient', 'id': 'p1',
+        'identifier.system': 'https://example.org', 'identifier.value': 'A',
+        'identifier[1].system': 'https://example.org', 'identifier[1].value': 'B',
+        'extension.us-core-sex': 'F', 'extension.age.value': 41, 'extension.age.unit': 'a',
+        'deceasedBoolean': False,
+    }
+    assert extensions == {'us-core-sex': SEX_URL, 'age': 'http://example.org/StructureDefinition/age'}
+    assert export.flatten(GROUP)['member.count'] == 1
+    assert export.flatten({'code': [{'text': str(i)} for i in range(export.MAX_LIST_ITEMS + 1)]}) == {'code.count': 6}
+
+
+def test_export_parquet_reads_back_rows_and_references(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    meta = tmp_path / 'META'
+    meta.mkdir()
+    (meta / 'Group.ndjson').write_bytes(orjson.dumps(GROUP) + b"\n")
+    patients = [dict(PATIENT, id=f"p{i}") for i in range(1, 4)]
+    (meta / 'Patient.0.ndjson').write_bytes(b"".join(orjson.dumps(patient) + b"\n" for patient in patients[:2]))
+    (meta / 'Patient.1.ndjson').write_bytes(orjson.dumps(patients[2]) + b"\n")
+
+    output = tmp_path / 'parquet'
+    written = export.export_parquet(str(meta), str(output))
+    assert written == {str(output / 'Group.parquet'): 1, str(output / 'Patient.0.parquet'): 2,
+                       str(output / 'Patient.1.parquet'): 1, str(output / export.REFERENCES_FILE): 1}
+
+    patient_table = pq.read_table(output / 'Patient.0.parquet')
+    assert patient_table.column('id').to_pylist() == ['p1', 'p2']
+    assert patient_table.schema.field('extension.age.value').type == pa.int64()
+    assert pa.types.is_dictionary(patient_table.schema.field('extension.us-core-sex').type)
+    assert orjson.loads(patient_table.schema.metadata[export.EXTENSIONS_METADATA])['us-core-sex'] == SEX_URL
+    assert pq.read_table(output / 'Group.parquet').column('member.count').to_pylist() == [1]
+
+    references = pq.read_table(output / export.REFERENCES_FILE).to_pylist()
+    assert references == [{'resourceType': 'Group', 'id': 'g1', 'field': 'Group.member.entity',
+                           'reference': 'Patient/p1', 'target_type': 'Patient', 'target_id': 'p1'}]
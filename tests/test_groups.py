@@ -0,0 +1,63 @@
+import uuid
+
+import orjson
+
+from fhir_etl import builder
+from fhir_etl import groups
+
+GROUP = {"resourceType": "Group", "id": str(uuid.uuid4()),
+         "identifier": [{"system": "https://example.org", "value": "all-samples"}],
+         "type": "specimen", "membership": "definitional"}
+SPECIMEN_IDS = [str(uuid.uuid5(uuid.NAMESPACE_DNS, f"specimen-{i}")) for i in range(25)]
+
+
+def lines(max_members=None) -> list:
+    keys = groups.member_keys(SPECIMEN_IDS)
+    part_id = lambda number: str(uuid.uuid5(uuid.NAMESPACE_DNS, f"part-{number}"))  # noqa: E731
+    return [(resource_id, orjson.loads(line)) for resource_id, line in groups.group_lines(GROUP, "Specimen", keys, max_members, part_id)]
+
+
+def members(group) -> list:
+    return [member["entity"]["reference"] for member in group.get("member", [])]
+
+
+def test_group_lists_its_specimens():
+    [(resource_id, group)] = lines()
+    assert resource_id == GROUP["id"]
+    assert members(group) == [f"Specimen/{specimen_id}" for specimen_id in SPECIMEN_IDS]
+    builder.validate_fhir_resource_from_type("Group", group)
+
+
+def test_split_group_links_its_parts_and_rejoins_to_the_same_membership():
+    [(parent_id, parent), *parts] = lines(max_members=10)
+    assert parent_id == GROUP["id"] and parent["type"] == "specimen"
+    assert "member" not in parent and parent["quantity"] == len(SPECIMEN_IDS)
+    assert [extension["valueReference"]["reference"] for extension in parent["extension"]
+            if extension["url"] == groups.PART_EXTENSION_URL] == [f"Group/{part_id}" for part_id, _ in parts]
+
+    assert [len(members(part)) for _, part in parts] == [10, 10, 5]
+    assert [part["identifier"][0]["value"] for _, part in parts] == [f"all-samples-part-{n}" for n in (1, 2, 3)]
+    assert all(part["type"] == "specimen" for _, part in parts)
+    rejoined = [reference for _, part in parts for reference in members(part)]
+    assert rejoined == members(lines()[0][1])
+
+    for _, group in [(parent_id, parent), *parts]:
+        builder.validate_fhir_resource_from_type("Group", group)
+
+
+def read_groups(meta_path) -> list:
+    return [orjson.loads(line) for line in (meta_path / "Group.ndjson").read_bytes().splitlines()]
+
+
+def test_1kgenomes_group_is_rewritten_when_the_split_changes(transform):
+    [unsplit] = read_groups(transform("groups")["1kgenomes"])
+    specimens = members(unsplit)
+    assert len(specimens) > 20
+
+    [parent, *parts] = read_groups(transform("groups", group_max_members=20)["1kgenomes"])
+    assert parent["id"] == unsplit["id"] and "member" not in parent
+    assert parent["quantity"] == len(specimens) and len(parts) == -(-len(specimens) // 20)
+    assert [reference for part in parts for reference in members(part)] == specimens
+    assert all(len(members(part)) <= 20 and groups.PART_EXTENSION_URL not in str(part) for part in parts)
+
+    assert read_groups(transform("groups")["1kgenomes"]) == [unsplit]
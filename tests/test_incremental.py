@@ -0,0 +1,66 @@
+import pandas as pd
+
+from fhir_etl import incremental
+from fhir_etl import utils
+
+converted = []
+
+
+def convert(row, study):
+    converted.append(row.patient_id)
+    return {'resourceType': 'Patient', 'id': row.patient_id, 'gender': row.gender,
+            'meta': {'source': study}}
+
+
+def frame(genders) -> pd.DataFrame:
+    return pd.DataFrame({'patient_id': [f"patient-{i}" for i in range(len(genders))], 'gender': genders})
+
+
+def build(meta_path, source, incremental_run=False) -> bytes:
+    meta_path.mkdir(exist_ok=True)
+    manifest = incremental.Manifest(str(meta_path), incremental=incremental_run)
+    output_path = manifest.output_path('Patient')
+    utils.write_ndjson(manifest.rows('Patient', source, convert, 'study-1', inputs=incremental.fingerprint(source.values.tolist()),
+                                     id_column='patient_id'), output_path)
+    manifest.save()
+    with open(output_path, 'rb') as file:
+        return file.read()
+
+
+def test_unchanged_incremental_rerun_skips_every_output(transform, capsys):
+    meta_paths = transform('rerun')
+    before = {path: path.read_bytes() for meta_path in meta_paths.values() for path in meta_path.glob('*.ndjson')}
+    capsys.readouterr()
+
+    transform('rerun', incremental=True)
+    out = capsys.readouterr().out
+    assert len(before) == 12
+    for path, content in before.items():
+        assert f"{path.name} is up to date, skipping" in out
+        assert path.read_bytes() == content
+    assert 'rows changed since the last run' not in out
+
+
+def test_one_changed_row_is_the_only_row_converted(tmp_path, capsys):
+    genders = ['male', 'female', 'unknown', 'other', 'female']
+    build(tmp_path / 'incremental', frame(genders))
+    converted.clear()
+    capsys.readouterr()
+
+    genders[2] = 'female'
+    content = build(tmp_path / 'incremental', frame(genders), incremental_run=True)
+    assert converted == ['patient-2']
+    assert "Patient: 1 of 5 rows changed since the last run" in capsys.readouterr().out
+    assert content == build(tmp_path / 'full', frame(genders))
+
+
+def test_hand_edited_output_is_not_current(tmp_path):
+    source = frame(['male', 'female'])
+    build(tmp_path, source)
+    inputs = incremental.fingerprint(source.values.tolist())
+    assert incremental.Manifest(str(tmp_path), incremental=True).is_current('Patient', inputs)
+    assert not incremental.Manifest(str(tmp_path)).is_current('Patient', inputs)
+
+    output_path = tmp_path / 'Patient.ndjson'
+    output_path.write_bytes(output_path.read_bytes().replace(b'"female"', b'"male"'))
+    assert not incremental.Manifest(str(tmp_path), incremental=True).is_current('Patient', inputs)
@@ -0,0 +1,96 @@
+import threading
+
+import orjson
+import pytest
+
+from fhir_etl import bench
+from fhir_etl import groups
+from fhir_etl import loader
+
+
+@pytest.fixture
+def meta(transform, monkeypatch):
+    """GTEx META with its Group split into linked sub-Groups."""
+    monkeypatch.setattr(loader, 'BACKOFF_SECONDS', 0)
+    return transform('meta', group_max_members=100)['gtex']
+
+
+def resource_urls(meta) -> list:
+    urls = []
+    for path in sorted(meta.glob('*.ndjson')):
+        for line in path.read_bytes().splitlines():
+            resource = orjson.loads(line)
+            urls.append(f"{resource['resourceType']}/{resource['id']}")
+    return urls
+
+
+def load(meta, server, **options):
+    return loader.load_directory(str(meta), server, bundle_size=50, checkpoint_path=str(meta / loader.CHECKPOINT_NAME), **options)
+
+
+def test_types_are_loaded_in_dependency_order_with_parent_groups_last(meta):
+    bundles = []
+    with bench.fhir_stand_in(bundles=bundles) as server:
+        result = load(meta, server, concurrency=4)
+
+    assert not result.failed
+    assert sorted(url for urls in bundles for url in urls) == sorted(resource_urls(meta))
+    ranks = [loader.LOAD_ORDER.index(urls[0].split('/')[0]) for urls in bundles]
+    assert ranks == sorted(ranks)
+    assert all(len({url.split('/')[0] for url in urls}) == 1 for urls in bundles)
+
+    parent = orjson.loads((meta / 'Group.ndjson').read_bytes().splitlines()[0])
+    parts = [extension['valueReference']['reference'] for extension in parent['extension'] if extension['url'] == groups.PART_EXTENSION_URL]
+    assert len(parts) > 1
+    position = {url: index for index, urls in enumerate(bundles) for url in urls}
+    assert all(position[part] < position[f"Group/{parent['id']}"] for part in parts)
+
+
+def test_transient_failures_are_retried(meta):
+    attempts = {}
+    lock = threading.Lock()
+
+    def status(urls):
+        with lock:
+            attempt = attempts[urls[0]] = attempts.get(urls[0], 0) + 1
+        return {1: 429, 2: 503}.get(attempt, 200)
+
+    received = {}
+    with bench.fhir_stand_in(received=received, status=status) as server:
+        result = load(meta, server, retries=2)
+
+    assert not result.failed
+    assert set(attempts.values()) == {3}
+    assert sum(received.values()) == len(resource_urls(meta))
+
+
+def test_other_client_errors_fail_without_retry_and_stop_the_load(meta):
+    attempts = []
+
+    def status(urls):
+        attempts.append(urls[0])
+        return 400 if urls[0].startswith('Specimen/') else 200
+
+    received = {}
+    with bench.fhir_stand_in(received=received, status=status) as server:
+        result = load(meta, server, retries=3)
+
+    specimen_bundles = [url for url in attempts if url.startswith('Specimen/')]
+    assert len(specimen_bundles) == len(set(specimen_bundles)) == len(result.failed)
+    assert 'Specimen' not in received and 'Group' not in received and 'DocumentReference' not in received
+    assert received['Patient'] and received['ResearchSubject']
+
+
+def test_a_new_run_resumes_after_the_failed_bundle(meta):
+    failing = {'url': [url for url in resource_urls(meta) if url.startswith('Specimen/')][100]}  # in the third bundle
+    bundles = []
+    with bench.fhir_stand_in(bundles=bundles, status=lambda urls: 500 if failing['url'] in urls else 200) as server:
+        first = load(meta, server, retries=0, concurrency=1)
+        loaded_first = len(bundles)
+        failing['url'] = None
+        second = load(meta, server, retries=0, concurrency=1)
+
+    assert [(failure.path, failure.bundle) for failure in first.failed] == [('Specimen.ndjson', 3)]
+    assert not second.failed and second.skipped == loaded_first
+    loaded = [url for urls in bundles for url in urls]
+    assert sorted(loaded) == sorted(resource_urls(meta))
@@ -0,0 +1,35 @@
+from fhir_etl import parallel, utils
+
+
+def outputs(meta_paths) -> dict:
+    return {(project, path.name): path.read_bytes()
+            for project, meta_path in meta_paths.items() for path in sorted(meta_path.glob('*.ndjson'))}
+
+
+def test_workers_write_the_same_bytes_as_a_serial_run(transform, monkeypatch):
+    monkeypatch.setattr(parallel, 'DEFAULT_CHUNK_SIZE', 16)  # several chunks in flight for every converter
+    serial = outputs(transform('serial', workers=1))
+    pooled = outputs(transform('pooled', workers=3))
+
+    assert {name for _, name in serial} >= {'Patient.ndjson', 'ResearchSubject.ndjson', 'Specimen.ndjson',
+                                            'DocumentReference.ndjson', 'Group.ndjson', 'ResearchStudy.ndjson'}
+    assert len(serial) == 12
+    for key, content in serial.items():
+        assert content, key
+        assert pooled[key] == content, key
+
+
+def test_clean_resources_on_a_pool_keeps_input_order_and_collects_failures():
+    entities = [{'resourceType': 'Patient', 'id': f"patient-{i}", 'gender': 'female' if i % 2 else 'male',
+                 'name': [{'family': f"Family{i}", 'given': []}]} for i in range(40)]
+    entities[7] = {'resourceType': 'Patient', 'id': 'patient-7', 'birthDate': 'not-a-date'}
+    entities[23] = {'resourceType': 'Specimen', 'id': 'specimen-23', 'subject': 'Patient/patient-1'}
+    errors = []
+    with parallel.pool(2) as executor:
+        cleaned = utils.clean_resources(entities, executor=executor, errors=errors, chunk_size=3)
+
+    assert [resource['id'] for resource in cleaned] == [f"patient-{i}" for i in range(40) if i not in (7, 23)]
+    assert cleaned == utils.clean_resources([entity for i, entity in enumerate(entities) if i not in (7, 23)])
+    assert [(failure.index, failure.resource_type, failure.resource_id) for failure in errors] == [
+        (7, 'Patient', 'patient-7'), (23, 'Specimen', 'specimen-23')]
+    assert all(isinstance(failure, utils.ValidationFailure) and failure.error for failure in errors)
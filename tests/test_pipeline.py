@@ -0,0 +1,45 @@
+import pytest
+from click.testing import CliRunner
+
+from fhir_etl import pipeline
+from fhir_etl.cli import cli
+
+
+def selected(name, *only) -> list:
+    return [stage.name for stage in pipeline.select(pipeline.FHIRIZERS[name], only)]
+
+
+def test_select_pulls_in_the_stages_an_output_needs_and_nothing_else():
+    assert selected('gtex', 'Group') == ['fetch_samples', 'group']
+    assert selected('gtex', 'Specimen', 'study') == ['fetch_samples', 'study', 'convert_samples']
+    # the 1kG Group reads Specimen.ndjson from META: ordered after convert when both run, not pulled in
+    assert selected('1kgenomes', 'Group') == ['group']
+    assert selected('1kgenomes', 'Specimen') == ['fetch', 'convert']
+    assert selected('gtex') == [stage.name for stage in pipeline.FHIRIZERS['gtex'].stages]
+
+
+def test_only_runs_the_selected_stages(transform, monkeypatch):
+    transform('only')
+    finished = []
+    run = pipeline.run
+    monkeypatch.setattr(pipeline, 'run', lambda *args, **options: finished.extend(run(*args, **options)))
+    transform('only', only=('Group',))
+    assert sorted(finished) == [('1kgenomes', 'group'), ('gtex', 'fetch_samples'), ('gtex', 'group')]
+
+
+def test_unknown_stage_or_output_is_a_clear_error():
+    with pytest.raises(ValueError, match='No stage or output named Observation in gtex'):
+        pipeline.run(['gtex'], only=('Group', 'Observation'))
+    with pytest.raises(ValueError, match='No stage or output named convert in gtex'):
+        pipeline.run(['gtex'], only=('convert',))
+
+
+def test_transform_all_runs_every_project(monkeypatch, tmp_path):
+    runs = []
+    monkeypatch.setattr(pipeline, 'run', lambda names, **options: runs.append((names, options['only'])))
+    result = CliRunner().invoke(cli, ['transform', '-p', pipeline.ALL, '--only', 'Group', '--offline', '--cache-dir', str(tmp_path)])
+    assert result.exit_code == 0, result.output
+    assert runs == [(sorted(pipeline.FHIRIZERS), ('Group',))]
+
+    result = CliRunner().invoke(cli, ['transform', '-p', 'nope'])
+    assert result.exit_code == 2 and "'nope' is not one of" in result.output
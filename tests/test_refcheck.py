@@ -0,0 +1,35 @@
+from click.testing import CliRunner
+
+from fhir_etl import refcheck
+from fhir_etl.cli import cli
+from fhir_etl.validator import ndjson_files
+
+PATIENT_ID = 'b7c1e2a4-5d6f-4a8b-9c0d-1e2f3a4b5c6d'
+
+
+def write_meta(path):
+    (path / 'Patient.ndjson').write_text(f'{{"resourceType": "Patient", "id": "{PATIENT_ID}"}}\n')
+    (path / 'Specimen.ndjson').write_text(
+        f'{{"resourceType": "Specimen", "id": "s1", "subject": {{"reference": "Patient/{PATIENT_ID}"}}}}\n'
+        '{"resourceType": "Specimen", "id": "s2", "subject": {"reference": "Patient/missing-1"}}\n'
+        '{"resourceType": "Specimen", "id": "s3", "subject": {"reference": "Patient/missing-2"},'
+        ' "parent": [{"reference": "#contained"}]}\n')
+
+
+def test_dangling_subject_reference_is_reported(tmp_path):
+    write_meta(tmp_path)
+    result = refcheck.check_references(ndjson_files(str(tmp_path)), examples=1)
+
+    assert result.resources == {'Patient': 1, 'Specimen': 3}
+    assert result.references == 3 and result.skipped == 1
+    assert result.dangling == [refcheck.DanglingReferences('Specimen.subject', 'Patient', 2,
+                                                           ['Specimen/s2 -> Patient/missing-1'])]
+
+
+def test_check_refs_exits_with_status_1_on_dangling_references(tmp_path):
+    write_meta(tmp_path)
+    assert CliRunner().invoke(cli, ['check-refs', '-p', str(tmp_path)]).exit_code == 1
+
+    (tmp_path / 'Specimen.ndjson').write_text(
+        f'{{"resourceType": "Specimen", "id": "s1", "subject": {{"reference": "Patient/{PATIENT_ID}"}}}}\n')
+    assert CliRunner().invoke(cli, ['check-refs', '-p', str(tmp_path)]).exit_code == 0
@@ -0,0 +1,65 @@
+import time
+import threading
+import tracemalloc
+
+from fhir_etl import report
+
+
+def teardown_function():
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    report.configure()
+
+
+def by_name() -> dict:
+    return {stage['name']: stage for stage in report.stages()}
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_stage_opened_while_producing_an_item_is_nested_in_the_timed_stage():
+    report.configure()
+
+    def produce():
+        with report.stage("prepare"):
+            busy(0.05)
+        busy(0.05)
+        yield 'resource'
+
+    with report.stage("write"):
+        for _ in report.timed("convert", produce()):
+            busy(0.05)
+
+    stages = by_name()
+    for name in ('prepare', 'convert', 'write'):
+        assert 0.04 < stages[name]['wall_seconds'] < 0.09, name
+        assert 0.03 < stages[name]['cpu_seconds'] < 0.09, name
+
+
+def test_concurrent_stages_count_their_own_cpu_and_are_marked_overlapped():
+    report.configure(trace_memory=True)
+    started = threading.Barrier(2)
+
+    def run(name, work):
+        with report.stage(name):
+            started.wait()
+            work(0.2)
+
+    threads = [threading.Thread(target=run, args=(name, work)) for name, work in (('waiting', time.sleep), ('busy', busy))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with report.stage("alone"):
+        buffer = bytearray(1 << 20)
+        del buffer
+
+    stages = by_name()
+    assert stages['waiting']['overlapped'] and stages['busy']['overlapped'] and not stages['alone']['overlapped']
+    assert stages['waiting']['cpu_seconds'] < 0.05 < stages['busy']['cpu_seconds']
+    assert stages['waiting']['tracemalloc_peak_bytes'] is None
+    assert stages['alone']['tracemalloc_peak_bytes'] >= 1 << 20
@@ -0,0 +1,92 @@
+import zlib
+
+import orjson
+import pytest
+
+from fhir_etl import shards
+
+RESOURCES = [{'resourceType': 'Patient', 'id': f"patient-{i}", 'gender': 'female'} for i in range(200)]
+
+
+@pytest.fixture
+def sharded():
+    def configure(count):
+        shards.configure(shards=count)
+        return count
+    yield configure
+    shards.configure()
+
+
+def read_resources(file_path) -> list:
+    with open(file_path, 'rb') as file:
+        return [orjson.loads(line) for line in file]
+
+
+def read_ids(file_path) -> list:
+    return [resource['id'] for resource in read_resources(file_path)]
+
+
+def test_every_id_lands_in_its_crc32_shard(sharded, tmp_path):
+    sharded(4)
+    count, paths = shards.write(RESOURCES, str(tmp_path), 'Patient')
+    assert count == len(RESOURCES)
+    assert paths == [str(tmp_path / f"Patient.{shard}.ndjson") for shard in range(4)]
+    for shard, file_path in enumerate(paths):
+        ids = read_ids(file_path)
+        assert ids and all(zlib.crc32(resource_id.encode()) % 4 == shard for resource_id in ids)
+    assert sorted(resource_id for file_path in paths for resource_id in read_ids(file_path)) == sorted(r['id'] for r in RESOURCES)
+
+    entry = shards.load_manifest(str(tmp_path))['outputs']['Patient']
+    assert entry['shards'] == 4 and entry['records'] == len(RESOURCES)
+    assert entry['files'] == [shards.file_entry(file_path, len(read_ids(file_path))) for file_path in paths]
+    assert shards.is_intact(str(tmp_path), 'Patient')
+
+
+def test_a_different_shard_count_removes_stale_shards(sharded, tmp_path):
+    sharded(4)
+    shards.write(RESOURCES, str(tmp_path), 'Patient')
+    sharded(3)
+    _, paths = shards.write(RESOURCES, str(tmp_path), 'Patient')
+    assert sorted(path.name for path in tmp_path.glob('Patient*')) == ['Patient.0.ndjson', 'Patient.1.ndjson', 'Patient.2.ndjson']
+    assert shards.find_outputs(str(tmp_path), 'Patient') == paths
+    assert shards.is_intact(str(tmp_path), 'Patient')
+    sharded(4)
+    assert not shards.is_intact(str(tmp_path), 'Patient')
+
+    sharded(1)
+    _, [file_path] = shards.write(RESOURCES, str(tmp_path), 'Patient')
+    assert [path.name for path in tmp_path.glob('Patient*')] == ['Patient.ndjson']
+    assert shards.find_outputs(str(tmp_path), 'Patient') == [file_path]
+    assert not (tmp_path / shards.MANIFEST_NAME).exists()
+
+
+def test_an_edited_shard_is_not_intact(sharded, tmp_path):
+    sharded(4)
+    _, paths = shards.write(RESOURCES, str(tmp_path), 'Patient')
+    assert shards.file_sha256(paths[2]) is not None
+
+    with open(paths[2], 'rb') as file:
+        content = file.read()
+    with open(paths[2], 'wb') as file:
+        file.write(content.replace(b'"female"', b'"f-male"', 1))  # same size, different bytes
+    assert not shards.is_intact(str(tmp_path), 'Patient')
+
+    with open(paths[1], 'ab') as file:
+        file.write(b"\n")
+    assert shards.file_sha256(paths[1]) is None
+
+
+def test_create_or_extend_merges_per_shard_and_across_shard_counts(sharded, tmp_path):
+    sharded(4)
+    shards.create_or_extend(RESOURCES[:150], str(tmp_path), 'Patient')
+    paths = shards.create_or_extend(RESOURCES[100:], str(tmp_path), 'Patient')
+    assert sorted(resource_id for file_path in paths for resource_id in read_ids(file_path)) == sorted(r['id'] for r in RESOURCES)
+    assert shards.is_intact(str(tmp_path), 'Patient')
+
+    sharded(2)
+    paths = shards.create_or_extend([dict(RESOURCES[0], gender='male')], str(tmp_path), 'Patient', update_existing=True)
+    assert sorted(path.name for path in tmp_path.glob('Patient*.ndjson')) == ['Patient.0.ndjson', 'Patient.1.ndjson']
+    resources = [resource for file_path in paths for resource in read_resources(file_path)]
+    assert len(resources) == len(RESOURCES)
+    assert [resource['gender'] for resource in resources if resource['id'] == 'patient-0'] == ['male']
+    assert shards.is_intact(str(tmp_path), 'Patient')
@@ -0,0 +1,46 @@
+import pandas as pd
+
+from fhir_etl import sources
+
+SCHEMA = sources.SourceSchema('test source', {'Sample': 'str', 'Gender': 'category'})
+TABLE = b"Sample\tGender\tComment\n" + b"".join(f"HG{i:05d}\t{'female' if i % 3 else 'male'}\tnote {i}\n".encode() for i in range(25))
+
+
+def outputs(meta_paths) -> dict:
+    return {(project, path.name): path.read_bytes()
+            for project, meta_path in meta_paths.items() for path in sorted(meta_path.glob('*.ndjson'))}
+
+
+def test_read_table_loads_only_the_typed_schema_columns():
+    frame = sources.read_table(TABLE, SCHEMA)
+    assert list(frame.columns) == ['Sample', 'Gender']
+    assert isinstance(frame['Gender'].dtype, pd.CategoricalDtype)
+    assert list(frame['Gender'].cat.categories) == ['female', 'male']
+    assert frame['Sample'].tolist() == [f"HG{i:05d}" for i in range(25)]
+
+    chunked = list(sources.read_table(TABLE, SCHEMA, chunksize=10))
+    assert [len(chunk) for chunk in chunked] == [10, 10, 5]
+    records = frame.astype(object).to_dict('records')
+    assert sources.from_pages([records[:10], records[10:]], SCHEMA).equals(frame)
+
+
+def test_prepared_chunks_prepare_each_chunk_on_every_pass():
+    frame = sources.read_table(TABLE, SCHEMA)
+    prepared = []
+    chunked = sources.PreparedChunks(frame, lambda chunk: prepared.append(len(chunk)) or chunk, 'prepare', chunksize=10)
+    assert len(chunked) == 25 and prepared == []
+    for _ in range(2):
+        assert pd.concat(list(chunked)).equals(frame)
+    assert prepared == [10, 10, 5, 10, 10, 5]
+
+    single = sources.PreparedChunks(frame, lambda chunk: prepared.append(len(chunk)) or chunk, 'prepare')
+    assert list(single)[0] is list(single)[0] and prepared[6:] == [25]
+
+
+def test_chunked_conversion_writes_the_same_output_as_a_single_frame(transform, monkeypatch):
+    single = outputs(transform('single'))
+    monkeypatch.setattr(sources, 'CHUNK_SIZE', 7)  # every PreparedChunks source spans several chunks
+    chunked = outputs(transform('chunked'))
+
+    assert len(single) == 12
+    assert chunked == single
@@ -0,0 +1,107 @@
+import orjson
+import pandas as pd
+import pytest
+from fhir.resources.identifier import Identifier
+
+from fhir_etl import utils
+
+
+def patient(i, name='Smith'):
+    return {'resourceType': 'Patient', 'id': f"patient-{i}", 'name': [{'family': name}]}
+
+
+def full_rewrite(tmp_path, items) -> bytes:
+    path = str(tmp_path / 'expected.ndjson')
+    utils.write_ndjson(items, path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def meta(tmp_path):
+    folder = tmp_path / 'META'
+    folder.mkdir()
+    utils.create_or_extend(new_items=[patient(i) for i in range(10)], folder_path=str(folder), resource_type='Patient')
+    return folder
+
+
+def merged(meta, items, update_existing=True) -> bytes:
+    utils.create_or_extend(new_items=items, folder_path=str(meta), resource_type='Patient', update_existing=update_existing)
+    path = str(meta / 'Patient.ndjson')
+    assert utils.load_ndjson_index(path) == utils.scan_ndjson_index(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_append(meta, tmp_path):
+    content = merged(meta, [patient(10), patient(3), patient(11)], update_existing=False)
+    assert content == full_rewrite(tmp_path, [patient(i) for i in range(12)])
+
+
+def test_unchanged(meta, tmp_path):
+    before = (meta / 'Patient.ndjson').stat().st_mtime_ns
+    content = merged(meta, [patient(i) for i in range(10)])
+    assert content == full_rewrite(tmp_path, [patient(i) for i in range(10)])
+    assert (meta / 'Patient.ndjson').stat().st_mtime_ns == before
+
+
+def test_update_in_place(meta, tmp_path):
+    content = merged(meta, [patient(4, 'Jones')])  # same length as Smith
+    expected = [patient(i) for i in range(10)]
+    expected[4] = patient(4, 'Jones')
+    assert content == full_rewrite(tmp_path, expected)
+
+
+def test_update_grow_and_shrink_keep_the_original_order(meta, tmp_path):
+    content = merged(meta, [patient(2, 'Longer-Name'), patient(10), patient(7, 'Li')])
+    expected = [patient(i) for i in range(11)]
+    expected[2] = patient(2, 'Longer-Name')
+    expected[7] = patient(7, 'Li')
+    assert content == full_rewrite(tmp_path, expected)
+    assert b"\n\n" not in content and b" \n" not in content
+
+
+def test_compaction_of_dead_lines_left_by_an_older_run(meta, tmp_path):
+    path = meta / 'Patient.ndjson'
+    lines = path.read_bytes().splitlines(keepends=True)
+    path.write_bytes(b"".join(lines[:3]) + b" " * 40 + b"\n" + b"".join(lines[3:]) + lines[5])  # blank and shadowed lines
+    content = merged(meta, [patient(1, 'Jones')])
+    expected = [patient(i) for i in range(10) if i != 5] + [patient(5)]
+    expected[1] = patient(1, 'Jones')
+    assert content == full_rewrite(tmp_path, expected)
+    assert utils.load_ndjson_index(str(path))['dead_bytes'] == 0
+
+
+def test_mint_ids_equals_mint_per_value_and_is_stable():
+    helper = utils.IDHelper('1KG', utils.THOUSAND_GENOMES)
+    system = 'https://example.org/samples'
+    values = ['HG00096', 'HG00097', 'HG00096', 'NA12878', 42]
+    expected = [helper.mint(system, str(value), 'Specimen') for value in values]
+
+    assert helper.mint_ids(values, 'Specimen', system) == expected
+    for series in (pd.Series(values, dtype=object), pd.Series([str(value) for value in values], dtype='category')):
+        assert helper.mint_ids(series, 'Specimen', system).tolist() == expected
+    assert utils.IDHelper('1KG', utils.THOUSAND_GENOMES).mint_ids(values, 'Specimen', system) == expected
+    assert expected[0] == expected[2] != expected[1]
+    assert expected[0] == helper.mint_id(Identifier(system=system, value='HG00096'), 'Specimen')
+    assert helper.mint_ids(values, 'Patient', system) != expected
+
+
+def test_clean_resource_matches_the_old_clean_and_convert_path():
+    resource = {
+        'resourceType': 'Observation', 'id': 'o1', 'status': 'final', 'note': [],
+        'code': {'coding': [{'system': 'http://loinc.org', 'code': '1234-5', 'display': ''}], 'text': ''},
+        'subject': {'reference': 'Patient/p1', 'display': None},
+        'valueQuantity': {'value': '12.50', 'unit': 'mg'},
+        'component': [{'code': {'text': 'a'}, 'valueQuantity': {'value': 7}},
+                      {'code': {'text': 'b'}, 'valueInteger': 0, 'extension': [{}]}],
+        'extension': [{'url': 'http://example.org/score', 'valueDecimal': '0.10'}],
+    }
+    validated = utils.validate_fhir_resource_from_type('Observation', utils.remove_empty_dicts(resource))
+    expected = utils.convert_value_to_float(utils.convert_decimal_to_float(orjson.loads(validated.model_dump_json())))
+    expected = orjson.loads(orjson.dumps(expected))
+
+    cleaned, error = utils.clean_resource(resource)
+    assert error is None
+    assert orjson.dumps(cleaned) == orjson.dumps(expected)
+    assert cleaned['valueQuantity']['value'] == 12.5 and 'note' not in cleaned
@@ -0,0 +1,23 @@
+import sys
+import json
+import subprocess
+
+from fhir_etl import validator
+
+HEAVY_MODULES = ('pandas', 'numpy', 'requests', 'ftplib')
+
+
+def test_validator_does_not_import_the_fhirizer_dependencies():
+    script = f"import sys, json, fhir_etl.validator; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    completed = subprocess.run([sys.executable, '-c', script], capture_output=True, check=True, text=True)
+    assert json.loads(completed.stdout) == []
+
+
+def test_invalid_resources_and_dangling_references_are_reported(tmp_path):
+    (tmp_path / 'Patient.ndjson').write_text('{"resourceType": "Patient", "id": "p1"}\n'
+                                              '{"resourceType": "Patient", "id": "p2", "gender": 1}\n')
+    (tmp_path / 'Specimen.ndjson').write_text('{"resourceType": "Specimen", "id": "s1", "subject": {"reference": "Patient/p1"}}\n'
+                                               '{"resourceType": "Specimen", "id": "s2", "subject": {"reference": "Patient/p3"}}\n')
+    result = validator.validate_directory(str(tmp_path), workers=1)
+    assert result.resources == {'summary': {'Patient': 1, 'Specimen': 2}}
+    assert len(result.exceptions) == 2